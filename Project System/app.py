@@ -1,31 +1,157 @@
 import os
+import re
+import atexit
+import json
+import math
+import statistics
+import time
+import hashlib
+import hmac
+import queue
+import random
+import asyncio
+import sqlite3
+import sys
+import threading
+import zlib
+import click
+from contextlib import contextmanager
 from dotenv import load_dotenv
-from flask import Flask, render_template, request, jsonify, redirect, url_for
+from flask import Blueprint, Flask, current_app, render_template, request, jsonify, redirect, url_for, Response, stream_with_context, g, has_request_context
+from flask.json.provider import DefaultJSONProvider
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, UserMixin, current_user, login_required, login_user, logout_user
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from collections import Counter, OrderedDict, defaultdict
 from flask_bcrypt import Bcrypt 
-from sqlalchemy import func
+from sqlalchemy import and_, event, func, insert, inspect, or_
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
 from google import genai
 from google.genai import types
 
 # Load environment variables from .env file
 load_dotenv()
 
-app = Flask(__name__)
+def load_config(app):
+    """Reads the settings below from the environment (and .env) into app.config."""
+    # --- Database & Login Setup ---
+    app.config['SECRET_KEY'] = os.getenv('FLASK_SECRET_KEY', 'your_super_secret_key_default') 
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL')
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_POOL_RECYCLE'] = 290
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    if os.getenv('DB_POOL_SIZE'):
+        # Threaded serving holds more requests per worker; give each worker a bigger connection pool
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+            'pool_size': int(os.getenv('DB_POOL_SIZE')),
+            'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', 10)),
+            'pool_recycle': 290
+        }
 
-# --- Database & Login Setup ---
-app.config['SECRET_KEY'] = os.getenv('FLASK_SECRET_KEY', 'your_super_secret_key_default') 
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL')
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_POOL_RECYCLE'] = 290
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    # --- Context Window Settings (how much history is sent to Gemini per turn) ---
+    # Last K user/model turns are sent verbatim; older turns are folded into ChatSession.summary
+    app.config['CONTEXT_RECENT_TURNS'] = int(os.getenv('CONTEXT_RECENT_TURNS', 6))
+    # Upper bound on characters of verbatim history (roughly 4 characters per token)
+    app.config['CONTEXT_CHAR_BUDGET'] = int(os.getenv('CONTEXT_CHAR_BUDGET', 12000))
+    # Upper bound on the stored rolling summary; the oldest summary lines are dropped first
+    app.config['CONTEXT_SUMMARY_CHAR_BUDGET'] = int(os.getenv('CONTEXT_SUMMARY_CHAR_BUDGET', 2000))
 
+    # --- Shared Store & Response Cache Settings ---
+    # SQLite file shared by all gunicorn workers on this host
+    app.config['SHARED_STORE_PATH'] = os.getenv('SHARED_STORE_PATH', os.path.join(app.instance_path, 'shared_store.sqlite3'))
+    app.config['RESPONSE_CACHE_ENABLED'] = os.getenv('RESPONSE_CACHE_ENABLED', '1') == '1'
+    app.config['RESPONSE_CACHE_TTL'] = int(os.getenv('RESPONSE_CACHE_TTL', 6 * 60 * 60))  # seconds
+    app.config['RESPONSE_CACHE_MAX_ENTRIES'] = int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', 5000))
+    # How long a duplicate request waits for the in-flight identical request before calling upstream itself
+    app.config['RESPONSE_CACHE_WAIT_TIMEOUT'] = int(os.getenv('RESPONSE_CACHE_WAIT_TIMEOUT', 30))
 
-db = SQLAlchemy(app)
-bcrypt = Bcrypt(app) # Initialize Bcrypt
-login_manager = LoginManager(app)
-login_manager.login_view = 'login' 
+    # --- Serving / Concurrency Settings (per gunicorn worker) ---
+    # '1' sends Gemini calls through the async client (client.aio) on one event loop per worker
+    app.config['GEMINI_ASYNC'] = os.getenv('GEMINI_ASYNC', '0') == '1'
+    # Optional API endpoint override, e.g. a local fake Gemini server for load tests
+    app.config['GEMINI_BASE_URL'] = os.getenv('GEMINI_BASE_URL')
+    app.config['GEMINI_TIMEOUT'] = int(os.getenv('GEMINI_TIMEOUT', 120))  # seconds
+    # Chats allowed to talk to Gemini at once, and how many more may wait for a slot before we answer 503
+    app.config['MAX_INFLIGHT_CHATS'] = int(os.getenv('MAX_INFLIGHT_CHATS', 64))
+    app.config['MAX_QUEUED_CHATS'] = int(os.getenv('MAX_QUEUED_CHATS', 64))
+    app.config['CHAT_QUEUE_TIMEOUT'] = float(os.getenv('CHAT_QUEUE_TIMEOUT', 5))  # seconds
+
+    # --- Upstream Quota Settings (shared by all workers; 0 disables a limit) ---
+    app.config['GEMINI_GLOBAL_RPM'] = int(os.getenv('GEMINI_GLOBAL_RPM', 60))
+    app.config['GEMINI_GLOBAL_TPM'] = int(os.getenv('GEMINI_GLOBAL_TPM', 1000000))
+    app.config['GEMINI_USER_RPM'] = int(os.getenv('GEMINI_USER_RPM', 10))
+    app.config['GEMINI_USER_TPM'] = int(os.getenv('GEMINI_USER_TPM', 100000))
+    # Longest a chat may wait for budget before it gets a 429
+    app.config['GEMINI_SCHEDULER_MAX_WAIT'] = float(os.getenv('GEMINI_SCHEDULER_MAX_WAIT', 10))
+    # Prompts up to this many tokens count as "short"; long ones may not use the last GEMINI_SHORT_RESERVE of global budget
+    app.config['GEMINI_SHORT_REQUEST_TOKENS'] = int(os.getenv('GEMINI_SHORT_REQUEST_TOKENS', 1000))
+    app.config['GEMINI_SHORT_RESERVE'] = float(os.getenv('GEMINI_SHORT_RESERVE', 0.2))
+    # Retries for transient 429/5xx errors (jittered exponential backoff, in seconds)
+    app.config['GEMINI_MAX_RETRIES'] = int(os.getenv('GEMINI_MAX_RETRIES', 3))
+    app.config['GEMINI_BACKOFF_BASE'] = float(os.getenv('GEMINI_BACKOFF_BASE', 0.5))
+    app.config['GEMINI_BACKOFF_CAP'] = float(os.getenv('GEMINI_BACKOFF_CAP', 8))
+
+    # --- Local Recommender Settings (co-occurrence index over parsed recommendations) ---
+    app.config['LOCAL_RECOMMENDER_ENABLED'] = os.getenv('LOCAL_RECOMMENDER_ENABLED', '1') == '1'
+    # Songs needed to answer locally; with fewer, the ones found are passed to Gemini as hints
+    app.config['RECOMMENDER_LOCAL_SONGS'] = int(os.getenv('RECOMMENDER_LOCAL_SONGS', 5))
+    # Evidence required before answering locally: sessions two songs must share to count as related
+    app.config['RECOMMENDER_MIN_SUPPORT'] = int(os.getenv('RECOMMENDER_MIN_SUPPORT', 2))
+    # Requests pick up new recommendations every REFRESH seconds; a background thread rebuilds the index every REBUILD
+    app.config['RECOMMENDER_REFRESH_SECONDS'] = float(os.getenv('RECOMMENDER_REFRESH_SECONDS', 5))
+    app.config['RECOMMENDER_REBUILD_SECONDS'] = float(os.getenv('RECOMMENDER_REBUILD_SECONDS', 3600))
+
+    # --- Message Write Settings (durability of chat history) ---
+    # 'sync'         : each turn is committed in one transaction before the reply is returned
+    # 'write_behind' : turns are queued in memory and written in batches by a background thread;
+    #                  a worker that is killed outright (SIGKILL, OOM, crash) loses the turns it still holds
+    app.config['MESSAGE_WRITE_MODE'] = os.getenv('MESSAGE_WRITE_MODE', 'sync')
+    app.config['MESSAGE_BATCH_SIZE'] = int(os.getenv('MESSAGE_BATCH_SIZE', 100))
+    app.config['MESSAGE_FLUSH_INTERVAL'] = float(os.getenv('MESSAGE_FLUSH_INTERVAL', 0.5))  # seconds
+    # Past this many queued turns, requests write the queue themselves instead of waiting for the thread
+    app.config['MESSAGE_MAX_QUEUED'] = int(os.getenv('MESSAGE_MAX_QUEUED', 5000))
+
+    # --- Instrumentation Settings ---
+    # Server-Timing headers and the Prometheus /metrics endpoint
+    app.config['METRICS_ENABLED'] = os.getenv('METRICS_ENABLED', '1') == '1'
+    # How often each worker merges its counters into the shared store that /metrics reads
+    app.config['METRICS_FLUSH_INTERVAL'] = float(os.getenv('METRICS_FLUSH_INTERVAL', 5))  # seconds
+    # '1' exposes GET /debug/profile?seconds=N, a sampling profiler for the worker that serves it.
+    # It only works with threaded workers (SERVING_MODE=async): a sync worker has no other request to sample.
+    app.config['PROFILER_ENABLED'] = os.getenv('PROFILER_ENABLED', '0') == '1'
+    app.config['PROFILER_INTERVAL'] = float(os.getenv('PROFILER_INTERVAL', 0.01))  # seconds between samples
+    # Longest profile one request may take; keep it below gunicorn's --timeout (30s unless start.sh sets one)
+    app.config['PROFILER_MAX_SECONDS'] = float(os.getenv('PROFILER_MAX_SECONDS', 20))
+    # /metrics and /debug/profile require "Authorization: Bearer <OPS_TOKEN>" and are off (404) while it is unset
+    app.config['OPS_TOKEN'] = os.getenv('OPS_TOKEN')
+
+    # --- Login Cache Settings (per gunicorn worker; 0 disables) ---
+    # How long a logged-in user's identity is served from memory before it is reloaded from the database
+    app.config['USER_CACHE_TTL'] = float(os.getenv('USER_CACHE_TTL', 300))  # seconds
+    app.config['USER_CACHE_MAX_ENTRIES'] = int(os.getenv('USER_CACHE_MAX_ENTRIES', 1024))
+
+    # --- History Archive Settings ---
+    # "flask compact-history" moves sessions idle for longer than this into cold storage
+    app.config['ARCHIVE_AFTER_DAYS'] = float(os.getenv('ARCHIVE_AFTER_DAYS', 90))
+    # Sessions archived per transaction
+    app.config['ARCHIVE_BATCH_SIZE'] = int(os.getenv('ARCHIVE_BATCH_SIZE', 100))
+
+
+# Extensions are bound to the app in create_app()
+db = SQLAlchemy()
+bcrypt = Bcrypt()
+login_manager = LoginManager()
+login_manager.login_view = 'main.login'
+# Every route, hook and CLI command lives on this blueprint; cli_group=None keeps "flask init-db" etc. top level
+bp = Blueprint('main', __name__, cli_group=None)
+
+
+def service(name):
+    """The current app's `name` service, as built by init_services(); None when it is disabled."""
+    return current_app.extensions['services'][name]
 
 # --- Database Models ---
 
@@ -52,8 +178,204 @@ class Message(db.Model):
     content = db.Column(db.Text, nullable=False)
     timestamp = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
 
+    __table_args__ = (
+        # History load, load_session and delete_chat: WHERE user_id = ? AND session_id = ? ORDER BY timestamp
+        db.Index('ix_message_user_session_timestamp', 'user_id', 'session_id', 'timestamp'),
+        # Per-user scans in timestamp order (session aggregates, backfill)
+        db.Index('ix_message_user_timestamp', 'user_id', 'timestamp'),
+    )
+
+
+class ChatSession(db.Model):
+    """Denormalized per-conversation summary row that backs the sidebar."""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    session_id = db.Column(db.String(50), nullable=False)
+    title = db.Column(db.String(100), nullable=False, default='New Chat')
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    last_message_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    message_count = db.Column(db.Integer, nullable=False, default=0)
+    # Rolling summary of the turns that no longer fit in the verbatim context window
+    summary = db.Column(db.Text, nullable=True)
+    # Timestamp of the newest message already folded into the summary
+    summary_through_at = db.Column(db.DateTime, nullable=True)
+    # Set while the messages live in ArchivedSession instead of the Message table
+    archived_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'session_id', name='uq_chat_session_user_session'),
+        # Serves the sidebar query: WHERE user_id = ? ORDER BY last_message_at DESC
+        db.Index('ix_chat_session_user_last_message', 'user_id', 'last_message_at'),
+    )
+
+
+class ArchivedSession(db.Model):
+    """
+    Cold storage for an idle conversation: its Message and Recommendation rows as one
+    zlib-compressed NDJSON blob, moved back into the hot tables when the chat is opened again.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    session_id = db.Column(db.String(50), nullable=False)
+    message_count = db.Column(db.Integer, nullable=False)
+    first_message_at = db.Column(db.DateTime, nullable=False)
+    last_message_at = db.Column(db.DateTime, nullable=False)
+    archived_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    raw_bytes = db.Column(db.Integer, nullable=False)  # size before compression
+    payload = db.Column(db.LargeBinary, nullable=False)
+
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'session_id', name='uq_archived_session_user_session'),
+    )
+
+
+class Artist(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(200), nullable=False)
+    # Lowercased, punctuation-free name used for matching ("Ben&Ben" == "ben ben")
+    name_key = db.Column(db.String(200), unique=True, nullable=False)
+
+
+class Song(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    artist_id = db.Column(db.Integer, db.ForeignKey('artist.id'), nullable=False)
+    title = db.Column(db.String(200), nullable=False)
+    title_key = db.Column(db.String(200), nullable=False, index=True)
+    year = db.Column(db.Integer, nullable=True)
+    artist = db.relationship('Artist', lazy='joined')
+
+    __table_args__ = (
+        db.UniqueConstraint('artist_id', 'title_key', name='uq_song_artist_title'),
+    )
+
+
+class Recommendation(db.Model):
+    """One song suggested in one model reply (parsed from the "Title - Artist (Year)" list)."""
+    id = db.Column(db.Integer, primary_key=True)
+    message_id = db.Column(db.Integer, db.ForeignKey('message.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    session_id = db.Column(db.String(50), nullable=False)
+    song_id = db.Column(db.Integer, db.ForeignKey('song.id'), nullable=False)
+    rank = db.Column(db.Integer, nullable=False)
+    # Mood of the preset request that produced it ("chill", "workout", ...), if any
+    mood = db.Column(db.String(30), nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    message = db.relationship('Message')
+    song = db.relationship('Song')
+
+    __table_args__ = (
+        db.Index('ix_recommendation_user_session', 'user_id', 'session_id'),
+        db.Index('ix_recommendation_song', 'song_id'),
+    )
+
+
+class CachedUser:
+    """
+    Detached, read-only copy of the User columns the routes and templates read.
+    Stands in for current_user on cached requests; it never holds the password hash.
+    """
+    __slots__ = ('id', 'name', 'username', 'email', 'age', 'birthday')
+
+    is_authenticated = True
+    is_active = True
+    is_anonymous = False
+
+    def __init__(self, user):
+        self.id = user.id
+        self.name = user.name
+        self.username = user.username
+        self.email = user.email
+        self.age = user.age
+        self.birthday = user.birthday
+
+    def get_id(self):
+        return str(self.id)
+
+    def __eq__(self, other):
+        return isinstance(other, (CachedUser, User)) and self.id == other.id
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __repr__(self):
+        return f"CachedUser('{self.username}')"
+
+
+class UserCache:
+    """
+    Per-worker LRU of CachedUser objects with a TTL, so the primary-key lookup behind
+    Flask-Login's user_loader runs once per user per TTL instead of once per request.
+    Entries are dropped on logout and whenever this worker updates or deletes the User;
+    other workers pick the change up when their entry expires.
+    """
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()   # user id -> (loaded_at, CachedUser)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, user_id):
+        """The cached identity, or one freshly loaded from the database (None if the user is gone)."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and now - entry[0] < self.ttl:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return entry[1]
+
+        user = User.query.get(user_id)
+        with self._lock:
+            self.misses += 1
+            if user is None:
+                self._entries.pop(user_id, None)
+                return None
+            cached = CachedUser(user)
+            self._entries[user_id] = (now, cached)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return cached
+
+    def invalidate(self, user_id):
+        with self._lock:
+            if self._entries.pop(user_id, None) is not None:
+                self.invalidations += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+            # Every hit is a user_loader query the database did not see
+            'db_queries_saved': self.hits,
+            'db_queries_saved_per_request': round(self.hits / lookups, 3) if lookups else 0.0
+        }
+
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def invalidate_cached_user(mapper, connection, target):
+    """Profile or password changes (and deleted accounts) must not be served from the cache."""
+    user_cache = service('user_cache')
+    if user_cache is not None:
+        user_cache.invalidate(target.id)
+
+
 @login_manager.user_loader
 def load_user(user_id):
+    user_cache = service('user_cache')
+    if user_cache is not None:
+        return user_cache.get(int(user_id))
     return User.query.get(int(user_id))
 
 
@@ -63,7 +385,7 @@ def unauthorized():
     Handles unauthorized access, specifically for AJAX/API requests.
     If the request is JSON, return a custom JSON error instead of redirecting.
     """
-    if request.is_json or request.path == '/chat':
+    if request.is_json or request.path.startswith('/chat'):
         # Return the specific error message the frontend needs to display.
         return jsonify({
             'response': 'The user needs to login',
@@ -72,45 +394,111 @@ def unauthorized():
         }), 401 # HTTP 401 Unauthorized
     
     # Otherwise, perform the standard redirect for regular page access
-    return redirect(url_for('login'))
+    return redirect(url_for('main.login'))
 
 
 
 # --- Sidebar/History Management Routes ---
 
-@app.route("/get_chat_list", methods=["GET"])
+SIDEBAR_PAGE_SIZE = 50
+SIDEBAR_MAX_PAGE_SIZE = 200
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 200
+
+
+def parse_utc_timestamp(value):
+    """
+    Parses an ISO timestamp into the naive UTC datetime the database stores. Values with
+    an offset ("+08:00", "Z") are converted to UTC; naive values are taken as UTC already.
+    """
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def parse_since(value):
+    """Parses the ?since= ISO timestamp used by the delta endpoints; None if absent or invalid."""
+    if not value:
+        return None
+    try:
+        return parse_utc_timestamp(value)
+    except ValueError:
+        return None
+
+
+def conditional_json(state, build_payload):
+    """
+    JSON response with a strong ETag derived from `state`, a cheap fingerprint of everything
+    the payload depends on. A matching If-None-Match gets a 304 without building the payload.
+    """
+    fingerprint = json.dumps([request.full_path, state], default=str)
+    etag = hashlib.sha1(fingerprint.encode('utf-8')).hexdigest()
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = jsonify(build_payload())
+    response.set_etag(etag)
+    # Let the browser keep the body but revalidate it on every request
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+@bp.route("/get_chat_list", methods=["GET"])
 @login_required
 def get_chat_list():
-    """Retrieves a list of distinct chat sessions for the current user's sidebar."""
+    """
+    Retrieves a page of the current user's chat sessions for the sidebar (newest first).
+    With ?since=<timestamp>, returns only the sessions that got messages after it.
+    """
     user_id = current_user.id
-    
-    # Efficiently find the first message (title) and the latest timestamp for each session
-    latest_messages = db.session.query(
-        Message.session_id,
-        func.min(Message.timestamp).label('first_timestamp'), # Get the timestamp of the first message
-        func.max(Message.timestamp).label('latest_timestamp') # Get the timestamp of the last message
-    ).filter(
-        Message.user_id == user_id
-    ).group_by(Message.session_id).order_by(func.max(Message.timestamp).desc()).all()
-    
-    formatted_sessions = []
-    
-    for session_id, first_timestamp, latest_timestamp in latest_messages:
-        # Fetch the content of the very first message for the title
-        first_msg = Message.query.filter_by(user_id=user_id, session_id=session_id, timestamp=first_timestamp).first()
-        
-        title = first_msg.content if first_msg else "New Chat"
-        
-        formatted_sessions.append({
-            'id': session_id,
-            'title': title[:30] + '...' if len(title) > 30 else title,
-            'timestamp': latest_timestamp.isoformat()
-        })
-        
-    return jsonify({'sessions': formatted_sessions}), 200
+    settle_pending_turns(user_id)
+    limit = min(max(request.args.get('limit', SIDEBAR_PAGE_SIZE, type=int), 1), SIDEBAR_MAX_PAGE_SIZE)
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    since = parse_since(request.args.get('since'))
+    if request.args.get('since') and since is None:
+        return jsonify({'error': 'since must be an ISO timestamp'}), 400
+
+    # Any new, moved or deleted session changes the count or the newest timestamp;
+    # both come from the (user_id, last_message_at) index without touching the rows.
+    total, latest = db.session.query(func.count(), func.max(ChatSession.last_message_at)).filter(
+        ChatSession.user_id == user_id
+    ).one()
+
+    def build_payload():
+        # One indexed query on (user_id, last_message_at); fetch one extra row to know if there is more
+        query = ChatSession.query.filter_by(user_id=user_id).order_by(
+            ChatSession.last_message_at.desc(), ChatSession.id.desc()
+        )
+        if since is not None:
+            query = query.filter(ChatSession.last_message_at > since)
+        else:
+            query = query.offset(offset)
+        sessions = query.limit(limit + 1).all()
+
+        has_more = len(sessions) > limit
+        formatted_sessions = []
+
+        for chat_session in sessions[:limit]:
+            title = chat_session.title or "New Chat"
+            formatted_sessions.append({
+                'id': chat_session.session_id,
+                'title': title[:30] + '...' if len(title) > 30 else title,
+                'timestamp': chat_session.last_message_at.isoformat()
+            })
+
+        return {
+            'sessions': formatted_sessions,
+            'has_more': has_more,
+            'next_offset': offset + limit if has_more and since is None else None,
+            'total': total,
+            'latest': latest.isoformat() if latest else None
+        }
 
+    return conditional_json([user_id, total, latest], build_payload)
 
-@app.route("/new_chat", methods=["POST"])
+
+@bp.route("/new_chat", methods=["POST"])
 @login_required
 def new_chat():
     """Generates a new unique session ID for a new chat."""
@@ -120,13 +508,18 @@ def new_chat():
     return jsonify({'session_id': new_session_id}), 200
 
 
-@app.route("/delete_chat/<session_id>", methods=["POST"])
+@bp.route("/delete_chat/<session_id>", methods=["POST"])
 @login_required
 def delete_chat(session_id):
     """Deletes all messages associated with a specific session ID."""
+    # Queued turns would otherwise be written after the delete and bring the chat back
+    settle_pending_turns(current_user.id)
     try:
         # Use synchronize_session=False for efficient bulk deletion
+        Recommendation.query.filter_by(user_id=current_user.id, session_id=session_id).delete(synchronize_session=False)
         Message.query.filter_by(user_id=current_user.id, session_id=session_id).delete(synchronize_session=False)
+        ArchivedSession.query.filter_by(user_id=current_user.id, session_id=session_id).delete(synchronize_session=False)
+        ChatSession.query.filter_by(user_id=current_user.id, session_id=session_id).delete(synchronize_session=False)
         db.session.commit()
         return jsonify({'success': True}), 200
     except Exception as e:
@@ -134,38 +527,86 @@ def delete_chat(session_id):
         return jsonify({'success': False, 'error': str(e)}), 500
 
 
-@app.route("/load_session/<session_id>", methods=["GET"])
+@bp.route("/load_session/<session_id>", methods=["GET"])
 @login_required
 def load_session(session_id):
-    """Retrieves all messages for a specific session ID."""
+    """
+    Retrieves the messages of a session, oldest first, one page at a time.
+    By default the latest page; ?before=<message id> pages further back and
+    ?since=<timestamp> returns only the messages added after it.
+    """
     user_id = current_user.id
-    
-    db_history = Message.query.filter_by(user_id=user_id, session_id=session_id).order_by(Message.timestamp.asc()).all()
-    
-    formatted_history = []
-    for msg in db_history:
-        formatted_history.append({
-            'sender': msg.role, 
-            'content': msg.content 
-        })
-        
-    return jsonify({'history': formatted_history}), 200
-
-
-# --- Gemini Configuration (Defined once globally) ---
-thinking_config = types.ThinkingConfig(thinking_budget=0)
-generate_content_config = types.GenerateContentConfig(
-    temperature=1.0,
-    max_output_tokens=1500,
-    thinking_config=thinking_config, 
-    safety_settings=[
-        types.SafetySetting(category="HARM_CATEGORY_HARASSMENT", threshold="BLOCK_ONLY_HIGH"),
-        types.SafetySetting(category="HARM_CATEGORY_HATE_SPEECH", threshold="BLOCK_ONLY_HIGH"),
-        types.SafetySetting(category="HARM_CATEGORY_SEXUALLY_EXPLICIT", threshold="BLOCK_ONLY_HIGH"),
-        types.SafetySetting(category="HARM_CATEGORY_DANGEROUS_CONTENT", threshold="BLOCK_ONLY_HIGH"),
-    ],
-    system_instruction=[
-        types.Part.from_text(text="""You are the A3 Music Recommender, an expert in Original Pinoy Music (OPM).
+    settle_pending_turns(user_id)
+    limit = min(max(request.args.get('limit', HISTORY_PAGE_SIZE, type=int), 1), HISTORY_MAX_PAGE_SIZE)
+    before = request.args.get('before', type=int)
+    since = parse_since(request.args.get('since'))
+    if request.args.get('since') and since is None:
+        return jsonify({'error': 'since must be an ISO timestamp'}), 400
+
+    # Every new message bumps message_count and last_message_at, so the ChatSession row
+    # (one unique-index lookup) fingerprints the whole history
+    chat_session = ChatSession.query.filter_by(user_id=user_id, session_id=session_id).first()
+    if chat_session is not None and chat_session.archived_at is not None:
+        try:
+            rehydrate_session(user_id, session_id)
+        except RehydrationError as e:
+            print(e)
+            return jsonify({'error': 'This chat could not be restored from the archive.'}), 500
+    cursor = None
+    if request.args.get('before'):
+        cursor = Message.query.filter_by(id=before, user_id=user_id, session_id=session_id).first()
+        if cursor is None:
+            return jsonify({'error': 'before must be the id of a message in this session'}), 400
+    if chat_session is not None:
+        state = [user_id, chat_session.message_count, chat_session.last_message_at]
+    else:
+        # Sessions created before chat_session existed: aggregate over the (user, session, timestamp) index
+        state = [user_id] + list(db.session.query(func.count(), func.max(Message.timestamp)).filter(
+            Message.user_id == user_id, Message.session_id == session_id
+        ).one())
+
+    def build_payload():
+        query = Message.query.filter_by(user_id=user_id, session_id=session_id)
+        if since is not None:
+            # Delta mode: the oldest new messages first, so the client can keep asking with the last timestamp
+            db_history = query.filter(Message.timestamp > since).order_by(
+                Message.timestamp.asc(), Message.id.asc()
+            ).limit(limit + 1).all()
+            has_more = len(db_history) > limit
+            db_history = db_history[:limit]
+        else:
+            if cursor is not None:
+                query = query.filter(or_(
+                    Message.timestamp < cursor.timestamp,
+                    and_(Message.timestamp == cursor.timestamp, Message.id < cursor.id)
+                ))
+            db_history = query.order_by(Message.timestamp.desc(), Message.id.desc()).limit(limit + 1).all()
+            has_more = len(db_history) > limit
+            db_history = db_history[:limit][::-1]
+
+        formatted_history = []
+        for msg in db_history:
+            formatted_history.append({
+                'id': msg.id,
+                'sender': msg.role,
+                'content': msg.content,
+                'timestamp': msg.timestamp.isoformat()
+            })
+
+        return {
+            'history': formatted_history,
+            'has_more': has_more,
+            'next_before': db_history[0].id if db_history and has_more and since is None else None,
+            'latest': db_history[-1].timestamp.isoformat() if db_history else (since.isoformat() if since else None)
+        }
+
+    return conditional_json(state, build_payload)
+
+
+# --- Gemini Configuration (built on first use, in the worker) ---
+GEMINI_MODEL = "gemini-flash-latest"
+GEMINI_MAX_OUTPUT_TOKENS = 1500
+SYSTEM_INSTRUCTION = """You are the A3 Music Recommender, an expert in Original Pinoy Music (OPM).
 You only discuss music-related topics in the context of OPM.
 
 BEHAVIOR RULES:
@@ -193,191 +634,2712 @@ CRITICAL: Every numbered item MUST start on its own line. Use <br> tags religiou
 
 CLEANLINESS:
 - Do not use Markdown (no asterisks, no bolding). Use plain text only.
-- Answer in Tagalog if the user speaks Tagalog, otherwise use English or Taglish."""),
-    ],
-) 
-
-# Initialize the Gemini client (ONLY the client, not the chat session)
-try:
-    client = genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
-    print("🤖 Gemini Client initialized successfully.")
-except Exception as e:
-    print(f"FATAL ERROR: Failed to initialize Gemini Client: {e}")
-    client = None 
+- Answer in Tagalog if the user speaks Tagalog, otherwise use English or Taglish."""
 
-# ----------------------------------------------------
-#               FLASK ROUTES
-# ----------------------------------------------------
+_gemini_lock = threading.Lock()
 
-@app.route("/")
-def index():
-    return render_template("index.html", current_user=current_user)
 
-@app.route("/signup")
-def signup():
-    return render_template("signup.html") 
+def get_gemini():
+    """
+    Returns (client, generate_content_config), creating them on the worker's first Gemini call
+    rather than at import: the client's connection pools must not be inherited across a
+    gunicorn --preload fork, and CLI commands and routes that never reach Gemini skip them.
+    """
+    services = current_app.extensions['services']
+    with _gemini_lock:
+        if services['gemini_config'] is None:
+            services['gemini_config'] = types.GenerateContentConfig(
+                temperature=1.0,
+                max_output_tokens=GEMINI_MAX_OUTPUT_TOKENS,
+                thinking_config=types.ThinkingConfig(thinking_budget=0),
+                safety_settings=[
+                    types.SafetySetting(category="HARM_CATEGORY_HARASSMENT", threshold="BLOCK_ONLY_HIGH"),
+                    types.SafetySetting(category="HARM_CATEGORY_HATE_SPEECH", threshold="BLOCK_ONLY_HIGH"),
+                    types.SafetySetting(category="HARM_CATEGORY_SEXUALLY_EXPLICIT", threshold="BLOCK_ONLY_HIGH"),
+                    types.SafetySetting(category="HARM_CATEGORY_DANGEROUS_CONTENT", threshold="BLOCK_ONLY_HIGH"),
+                ],
+                system_instruction=[types.Part.from_text(text=SYSTEM_INSTRUCTION)],
+            )
+        if services['gemini_client'] is None:
+            base_url = current_app.config['GEMINI_BASE_URL']
+            http_options = types.HttpOptions(base_url=base_url) if base_url else None
+            try:
+                services['gemini_client'] = genai.Client(api_key=os.getenv("GEMINI_API_KEY"), http_options=http_options)
+            except Exception as e:
+                print(f"FATAL ERROR: Failed to initialize Gemini Client: {e}")
+                raise
+            print("🤖 Gemini Client initialized successfully.")
+    return services['gemini_client'], services['gemini_config']
 
-# --- USER REGISTRATION ---
-@app.route("/register", methods=["POST"])
-def register():
-    # ... (Your /register route logic remains the same) ...
-    data = request.get_json()
-    
-    name = data.get('name')
-    username = data.get('username')
-    email = data.get('email')
-    password = data.get('password')
-    age = data.get('age')
-    birthday_str = data.get('birthday')
 
-    if not all([username, email, password, name, age, birthday_str]):
-        return jsonify({'error': 'Missing required fields.'}), 400
+# --- Shared Response Cache (one SQLite file used by every gunicorn worker) ---
 
-    if User.query.filter_by(username=username).first():
-        return jsonify({'error': 'Username is already taken.'}), 409
-    
-    if User.query.filter_by(email=email).first():
-        return jsonify({'error': 'Email is already in use.'}), 409
+class SharedStore:
+    """
+    Tiny SQLite-backed store shared by all worker processes on this host.
+    Each thread gets its own autocommit connection; WAL lets readers and the writer overlap.
+    Users declare their tables with define(); they are created when a connection is opened,
+    so building the store (and its users) never touches the file.
+    """
 
-    try:
-        hashed_password = bcrypt.generate_password_hash(password).decode('utf-8')
-        birthday_date = datetime.strptime(birthday_str, '%Y-%m-%d').date() 
-        age_int = int(age)
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._pid = os.getpid()
+        self._schema = []
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.define('CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)')
 
-        user = User(
-            name=name,
-            username=username,
-            email=email,
-            password=hashed_password,
-            age=age_int,
-            birthday=birthday_date 
+    def define(self, *statements):
+        """Registers CREATE ... IF NOT EXISTS statements; call before the store is first used."""
+        self._schema.extend(statement for statement in statements if statement not in self._schema)
+
+    def connection(self):
+        if self._pid != os.getpid():
+            # Forked from a --preload master: never reuse its SQLite connections in the worker
+            self._local = threading.local()
+            self._pid = os.getpid()
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            for statement in self._schema:
+                conn.execute(statement)
+            self._local.conn = conn
+        return conn
+
+    def execute(self, sql, params=()):
+        return self.connection().execute(sql, params)
+
+    def incr(self, name, amount=1):
+        self.execute(
+            'INSERT INTO counters (name, value) VALUES (?, ?) '
+            'ON CONFLICT(name) DO UPDATE SET value = value + excluded.value',
+            (name, amount)
         )
-        
-        db.session.add(user)
-        db.session.commit()
-        
-        return jsonify({'message': 'User registered successfully', 'redirect_url': url_for('login')}), 201
 
-    except ValueError:
-        return jsonify({'error': 'Invalid format for age or birthday.'}), 400
-    except Exception as e:
-        db.session.rollback()
-        print(f"Database error during registration: {e}")
-        return jsonify({'error': 'Internal server error during registration.'}), 500
+    def counters(self, prefix):
+        rows = self.execute('SELECT name, value FROM counters WHERE name LIKE ?', (prefix + '%',)).fetchall()
+        return {name[len(prefix):]: value for name, value in rows}
 
 
-# --- LOGIN ROUTE ---
-@app.route("/login", methods=['GET', 'POST'])
-def login():
-    if current_user.is_authenticated:
-        return redirect(url_for('index'))
-    
-    if request.method == 'GET':
-        return render_template('login.html', title='Login')
-    
-    data = request.get_json()
-    username = data.get('username')
-    password = data.get('password')
-    
-    user = User.query.filter_by(username=username).first()
-    
-    if user and bcrypt.check_password_hash(user.password, password):
-        login_user(user)
-        return jsonify({
-            'success': True, 
-            'message': 'Login successful!',
-            'redirect_url': url_for('index') 
-        }), 200
-    else:
-        return jsonify({
-            'success': False, 
-            'error': 'Login failed. Check username and password.'
-        }), 401
+class CacheClaim:
+    """
+    The result of ResponseCache.lookup() for a miss: the right to make the upstream call for
+    `key` (or, if another request kept it, permission to call unclaimed). store() caches the
+    reply; release() gives the claim up and may be called any number of times. Usable as a
+    context manager, and also by streaming routes that release it after the response is sent.
+    """
 
-# --- LOGOUT ROUTE ---
-@app.route("/logout")
-def logout():
-    logout_user()
-    return redirect(url_for('index')) 
+    def __init__(self, cache, key, started_at):
+        self.cache = cache
+        self.key = key
+        self.started_at = started_at
 
+    def store(self, response):
+        if self.cache is not None:
+            self.cache.set(self.key, response)
 
-# --- PERSISTENT CHAT ROUTE (The core logic) ---
-@app.route("/chat", methods=["POST"])
-@login_required 
-def chat():
-    # Check if client failed to initialize at startup
-    if client is None:
-        return jsonify({"response": "Error: AI service client not available."}), 503
+    def release(self):
+        if self.started_at is not None:
+            self.cache.release(self.key, self.started_at)
+            self.started_at = None
 
-    user_input = request.json.get("message")
-    user_id = current_user.id 
-    session_id = request.json.get("session_id")
-    
-    # CRITICAL: Get session_id from the frontend request
-    session_id = request.json.get("session_id")
-    if not session_id:
-        # If no session ID is provided (e.g., first message ever), create one.
-        session_id = str(datetime.now().timestamp()).replace('.', '')
+    def __enter__(self):
+        return self
 
-    if not user_input:
-        return jsonify({"response": "Please enter a message."}), 400
+    def __exit__(self, *exc_info):
+        self.release()
 
-    # 1. Retrieve History for the SPECIFIC SESSION
-    db_history = Message.query.filter_by(user_id=user_id, session_id=session_id).order_by(Message.timestamp.asc()).all()
-    
-    # 2. Convert DB messages into the Gemini API format
-    history_for_gemini = [
-        types.Content(
-            role=msg.role,
-            parts=[types.Part.from_text(text=msg.content)]
+
+class ResponseCache:
+    """
+    TTL + LRU cache of model replies, keyed on the normalized prompt plus a
+    fingerprint of the exact context sent to Gemini. Concurrent identical
+    requests are coalesced: one caller (in any worker) becomes the leader and
+    calls upstream, the others wait for its stored reply.
+    """
+
+    def __init__(self, store, ttl, max_entries, wait_timeout):
+        self.store = store
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.wait_timeout = wait_timeout
+        self.store.define(
+            'CREATE TABLE IF NOT EXISTS response_cache ('
+            'key TEXT PRIMARY KEY, response TEXT NOT NULL, created_at REAL NOT NULL, last_access REAL NOT NULL)',
+            'CREATE INDEX IF NOT EXISTS ix_response_cache_last_access ON response_cache (last_access)',
+            'CREATE TABLE IF NOT EXISTS cache_inflight (key TEXT PRIMARY KEY, started_at REAL NOT NULL)'
         )
-        for msg in db_history
-    ]
 
-    # --- Database Operations (Within a try block for safety) ---
+    @staticmethod
+    def make_key(prompt, history):
+        """Hashes the normalized prompt together with the context actually sent upstream."""
+        normalized_prompt = ' '.join((prompt or '').lower().split())
+        context = [(content.role, [part.text for part in content.parts or []]) for content in history]
+        fingerprint = json.dumps([GEMINI_MODEL, normalized_prompt, context], ensure_ascii=False)
+        return hashlib.sha256(fingerprint.encode('utf-8')).hexdigest()
+
+    def get(self, key, count=True):
+        """Returns the cached reply, or None if missing or expired."""
+        now = time.time()
+        row = self.store.execute(
+            'SELECT response FROM response_cache WHERE key = ? AND created_at > ?', (key, now - self.ttl)
+        ).fetchone()
+        if row is not None:
+            self.store.execute('UPDATE response_cache SET last_access = ? WHERE key = ?', (now, key))
+        if count:
+            self.store.incr('response_cache.hits' if row is not None else 'response_cache.misses')
+        return row[0] if row is not None else None
+
+    def set(self, key, response):
+        now = time.time()
+        self.store.execute(
+            'INSERT OR REPLACE INTO response_cache (key, response, created_at, last_access) VALUES (?, ?, ?, ?)',
+            (key, response, now, now)
+        )
+        # Drop expired entries, then the least recently used ones beyond max_entries
+        expired = self.store.execute('DELETE FROM response_cache WHERE created_at <= ?', (now - self.ttl,)).rowcount
+        evicted = self.store.execute(
+            'DELETE FROM response_cache WHERE key IN ('
+            'SELECT key FROM response_cache ORDER BY last_access DESC LIMIT -1 OFFSET ?)',
+            (self.max_entries,)
+        ).rowcount
+        self.store.incr('response_cache.stores')
+        if expired + evicted:
+            self.store.incr('response_cache.evictions', expired + evicted)
+
+    def acquire(self, key):
+        """
+        Claims the upstream call for `key` and returns the claim to pass to release().
+        None means another request is already making it.
+        """
+        now = time.time()
+        claimed = self.store.execute(
+            'INSERT OR IGNORE INTO cache_inflight (key, started_at) VALUES (?, ?)', (key, now)
+        ).rowcount
+        if not claimed:
+            # Take over claims abandoned by a crashed or timed-out leader
+            claimed = self.store.execute(
+                'UPDATE cache_inflight SET started_at = ? WHERE key = ? AND started_at < ?',
+                (now, key, now - self.wait_timeout)
+            ).rowcount
+        return now if claimed else None
+
+    def release(self, key, claim):
+        """Drops our claim, unless a later leader has already taken it over."""
+        self.store.execute('DELETE FROM cache_inflight WHERE key = ? AND started_at = ?', (key, claim))
+
+    def wait(self, key):
+        """Polls for the leader's reply. Returns None if the leader failed or timed out."""
+        deadline = time.time() + self.wait_timeout
+        while time.time() < deadline:
+            response = self.get(key, count=False)
+            if response is not None:
+                self.store.incr('response_cache.coalesced')
+                return response
+            if self.store.execute('SELECT 1 FROM cache_inflight WHERE key = ?', (key,)).fetchone() is None:
+                # Leader finished without storing (upstream error): one last look, then give up
+                return self.get(key, count=False)
+            time.sleep(0.05)
+        return None
+
+    def lookup(self, key):
+        """
+        Returns (cached reply, None) on a hit, else (None, CacheClaim). If an identical request
+        is already calling upstream, waits for its reply first.
+        """
+        cached = self.get(key)
+        if cached is not None:
+            return cached, None
+        claim = self.acquire(key)
+        if claim is None:
+            cached = self.wait(key)
+            if cached is not None:
+                return cached, None
+            # The leader failed or stalled: take its claim over if it is free, else call upstream unclaimed
+            claim = self.acquire(key)
+        return None, CacheClaim(self, key, claim)
+
+    def stats(self):
+        counters = self.store.counters('response_cache.')
+        lookups = counters.get('hits', 0) + counters.get('misses', 0)
+        counters['entries'] = self.store.execute('SELECT COUNT(*) FROM response_cache').fetchone()[0]
+        # Share of lookups answered without an upstream call of their own
+        served = counters.get('hits', 0) + counters.get('coalesced', 0)
+        counters['hit_ratio'] = round(served / lookups, 4) if lookups else 0.0
+        return counters
+
+
+# --- Instrumentation (Server-Timing spans, Prometheus metrics, sampling profiler) ---
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+@contextmanager
+def span(name):
+    """
+    Adds the time spent inside to the current request's `name` span (reported in
+    Server-Timing and /metrics). Works as a decorator too; outside a request it does nothing.
+    """
+    spans = g.get('spans') if has_request_context() else None
+    if spans is None:
+        yield
+        return
+    started = time.perf_counter()
     try:
-        # 3. Save User Message with the session_id
-        user_message_db = Message(user_id=user_id, session_id=session_id, role='user', content=user_input)
-        db.session.add(user_message_db)
-        db.session.commit()
+        yield
+    finally:
+        spans[name] += time.perf_counter() - started
+
 
-        # 4. Create a transient chat session with the full history
-        chat_session = client.chats.create(
-            model="gemini-flash-latest",
-            config=generate_content_config,
-            history=history_for_gemini 
+def timed_iteration(iterable, name):
+    """Yields from `iterable`, counting the time spent waiting for each item as span `name`."""
+    iterator = iter(iterable)
+    while True:
+        with span(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    # Kept on the execution context, which is dropped with the statement, so a failed
+    # statement (never reaching after_cursor_execute) leaves nothing behind
+    context.query_started = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def stop_query_timer(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, 'query_started', None)
+    if started is not None and has_request_context() and g.get('spans') is not None:
+        g.spans['db'] += time.perf_counter() - started
+        g.db_queries += 1
+
+
+class TimedJSONProvider(DefaultJSONProvider):
+    """Counts JSON serialization of responses as the 'json' span."""
+
+    def dumps(self, obj, **kwargs):
+        with span('json'):
+            return super().dumps(obj, **kwargs)
+
+
+class Metrics:
+    """
+    Per-worker counters, gauges and histograms, merged into the shared store every
+    METRICS_FLUSH_INTERVAL seconds so /metrics reports the sum over all workers on this
+    host. Counters are flushed as deltas; gauges are kept per worker (worker="<pid>") and
+    dropped from the output once that worker stops refreshing them.
+    """
+
+    def __init__(self, store, flush_interval):
+        self.store = store
+        self.flush_interval = flush_interval
+        self._counters = defaultdict(float)   # (family, type, name, labels) -> delta since the last flush
+        self._sources = []                    # (family prefix, stats function, counter keys, gauge keys)
+        self._last_seen = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self.store.define(
+            'CREATE TABLE IF NOT EXISTS metrics ('
+            'name TEXT NOT NULL, labels TEXT NOT NULL, family TEXT NOT NULL, type TEXT NOT NULL, '
+            'value REAL NOT NULL, updated_at REAL NOT NULL, PRIMARY KEY (name, labels))'
         )
-        
-        # 5. Send the message and get response
-        response = chat_session.send_message(user_input)
-        response_text = response.text
 
-        import re 
-        clean_text = re.sub(r'\*+', '', response_text)
-        # --- TEXT CLEANING LOGIC END ---
+    @staticmethod
+    def _labels(labels):
+        return json.dumps(sorted((key, str(value)) for key, value in labels.items()))
 
-        # 6. Save the CLEAN Model Response with the session_id
-        model_message_db = Message(user_id=user_id, session_id=session_id, role='model', content=clean_text)
-        db.session.add(model_message_db)
-        db.session.commit()
-        
-        # Return the CLEAN response AND the session_id
-        return jsonify({"response": clean_text, "session_id": session_id}), 200
+    def _start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='metrics-flush', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                print(f"Metrics flush failed: {e}")
+
+    def inc(self, family, value=1, **labels):
+        with self._lock:
+            self._start()
+            self._counters[(family, 'counter', family, self._labels(labels))] += value
+
+    def observe(self, family, value, buckets, **labels):
+        with self._lock:
+            self._start()
+            for bound in buckets:
+                if value <= bound:
+                    self._counters[(family, 'histogram', family + '_bucket', self._labels(dict(labels, le=bound)))] += 1
+            self._counters[(family, 'histogram', family + '_bucket', self._labels(dict(labels, le='+Inf')))] += 1
+            self._counters[(family, 'histogram', family + '_sum', self._labels(labels))] += value
+            self._counters[(family, 'histogram', family + '_count', self._labels(labels))] += 1
+
+    def add_source(self, prefix, stats, counters=(), gauges=()):
+        """Exports an in-process stats() dict: `counters` keys as cumulative totals, `gauges` per worker."""
+        self._sources.append((prefix, stats, counters, gauges))
+
+    def flush(self):
+        now = time.time()
+        worker = self._labels({'worker': os.getpid()})
+        gauges = []
+        with self._lock:
+            for prefix, stats, counter_keys, gauge_keys in self._sources:
+                values = stats()
+                for key in counter_keys:
+                    family = f'{prefix}_{key}_total'
+                    delta = values[key] - self._last_seen.get(family, 0)
+                    self._last_seen[family] = values[key]
+                    if delta:
+                        self._counters[(family, 'counter', family, self._labels({}))] += delta
+                for key in gauge_keys:
+                    gauges.append((f'{prefix}_{key}', worker, f'{prefix}_{key}', 'gauge', values[key], now))
+            pending, self._counters = self._counters, defaultdict(float)
+        if not pending and not gauges:
+            return
+
+        connection = self.store.connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.executemany(
+                'INSERT INTO metrics (name, labels, family, type, value, updated_at) VALUES (?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT(name, labels) DO UPDATE SET value = value + excluded.value, updated_at = excluded.updated_at',
+                [(name, labels, family, kind, value, now) for (family, kind, name, labels), value in pending.items()]
+            )
+            connection.executemany(
+                'INSERT INTO metrics (name, labels, family, type, value, updated_at) VALUES (?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT(name, labels) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at',
+                gauges
+            )
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+
+    def render(self):
+        """All workers' metrics, plus the shared cache and scheduler counters, in Prometheus text format."""
+        self.flush()
+        stale_before = time.time() - 3 * self.flush_interval
+        rows = self.store.execute(
+            "SELECT name, labels, family, type, value FROM metrics WHERE type != 'gauge' OR updated_at >= ?",
+            (stale_before,)
+        ).fetchall()
+        for name, value in self.store.execute('SELECT name, value FROM counters').fetchall():
+            family = 'app_' + re.sub(r'[^a-zA-Z0-9_]', '_', name) + '_total'
+            rows.append((family, '[]', family, 'counter', value))
+
+        def sort_key(row):
+            labels = dict(json.loads(row[1]))
+            bound = labels.pop('le', None)
+            bound = math.inf if bound == '+Inf' else float(bound) if bound is not None else -1
+            return row[2], sorted(labels.items()), row[0], bound
+
+        lines, last_family = [], None
+        for name, labels, family, kind, value in sorted(rows, key=sort_key):
+            if family != last_family:
+                lines.append(f'# TYPE {family} {kind}')
+                last_family = family
+            label_text = ','.join(f'{key}="{value_}"' for key, value_ in json.loads(labels))
+            lines.append(f'{name}{{{label_text}}} {value:g}' if label_text else f'{name} {value:g}')
+        return '\n'.join(lines) + '\n'
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler that is cheap enough for production: while running, a thread
+    samples the stacks of the threads currently serving requests (sys._current_frames)
+    every PROFILER_INTERVAL seconds and counts them as collapsed stacks, the text format
+    flamegraph.pl and speedscope read. Idle server threads are never sampled.
+    """
+
+    def __init__(self, interval, max_depth=64):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.request_threads = set()
+        self._lock = threading.Lock()
+
+    def _stack(self, frame):
+        names = []
+        while frame is not None and len(names) < self.max_depth:
+            code = frame.f_code
+            names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+            frame = frame.f_back
+        return ';'.join(reversed(names))
+
+    def sample(self, seconds):
+        """Samples for `seconds` and returns (samples taken, Counter of collapsed stacks)."""
+        stacks = Counter()
+        samples = 0
+        with self._lock:  # one profile at a time per worker
+            deadline = time.perf_counter() + seconds
+            while time.perf_counter() < deadline:
+                frames = sys._current_frames()
+                for thread_id in list(self.request_threads):
+                    if thread_id != threading.get_ident() and thread_id in frames:
+                        stacks[self._stack(frames[thread_id])] += 1
+                samples += 1
+                time.sleep(self.interval)
+        return samples, stacks
+
+
+@bp.before_app_request
+def start_request_timing():
+    profiler = service('profiler')
+    if service('metrics') is not None:
+        g.spans = defaultdict(float)
+        g.db_queries = 0
+        g.request_started = time.perf_counter()
+    if profiler is not None:
+        profiler.request_threads.add(threading.get_ident())
+
+
+@bp.teardown_app_request
+def stop_request_profiling(exc):
+    profiler = service('profiler')
+    if profiler is not None:
+        profiler.request_threads.discard(threading.get_ident())
+
+
+@bp.after_app_request
+def add_server_timing(response):
+    """Adds the Server-Timing header and records the request in /metrics once the body is sent."""
+    spans = g.get('spans')
+    if spans is None:
+        return response
+    started, route = g.request_started, request.url_rule.rule if request.url_rule else 'unmatched'
+    timings = [f'db;dur={spans["db"] * 1000:.1f};desc="{g.db_queries} queries"']
+    timings += [f'{name};dur={seconds * 1000:.1f}' for name, seconds in spans.items() if name != 'db']
+    timings.append(f'total;dur={(time.perf_counter() - started) * 1000:.1f}')
+    # For streamed replies this covers the work before the first byte; /metrics gets the full duration
+    response.headers['Server-Timing'] = ', '.join(timings)
+
+    method, status = request.method, response.status_code
+    db_queries = g.db_queries
+    metrics = service('metrics')  # record() runs after the app context is gone
+
+    def record():
+        metrics.observe('app_http_request_duration_seconds', time.perf_counter() - started, LATENCY_BUCKETS,
+                        method=method, route=route, status=status)
+        metrics.observe('app_db_queries_per_request', g.db_queries if has_request_context() else db_queries,
+                        QUERY_COUNT_BUCKETS, route=route)
+        for name, seconds in list(spans.items()):
+            metrics.inc('app_span_seconds_total', seconds, route=route, span=name)
+
+    response.call_on_close(record)
+    return response
+
+
+def record_token_usage(usage):
+    """Counts the prompt/output tokens Gemini reports for a call."""
+    metrics = service('metrics')
+    if metrics is None or usage is None:
+        return
+    metrics.inc('app_gemini_tokens_total', getattr(usage, 'prompt_token_count', None) or 0, kind='prompt')
+    metrics.inc('app_gemini_tokens_total', getattr(usage, 'candidates_token_count', None) or 0, kind='output')
+
+
+def ops_guard():
+    """
+    Gatekeeper for the ops endpoints. Returns an error response, or None to proceed.
+    Fails closed: without OPS_TOKEN they do not exist.
+    """
+    token = current_app.config['OPS_TOKEN']
+    if not token:
+        return jsonify({'message': 'Set OPS_TOKEN to enable this endpoint.'}), 404
+    if not hmac.compare_digest(request.headers.get('Authorization', '').encode(), f'Bearer {token}'.encode()):
+        return jsonify({'message': 'Unauthorized.'}), 401
+    return None
+
+
+# --- Upstream Quota Scheduler (token buckets shared by all workers) ---
+
+class QuotaExceeded(Exception):
+    """Raised when a call would have to wait longer than GEMINI_SCHEDULER_MAX_WAIT for budget."""
+
+    def __init__(self, scope, retry_after):
+        self.scope = scope
+        self.retry_after = retry_after
+        super().__init__(f"Gemini {scope} budget exhausted, retry in {retry_after:.0f}s")
+
+
+def is_rate_limited(e):
+    """Gemini answered 429 RESOURCE_EXHAUSTED: a per-minute burst limit or a daily quota."""
+    code = getattr(e, 'code', None)
+    if isinstance(code, int):
+        return code == 429
+    return '429 RESOURCE_EXHAUSTED' in str(e)
+
+
+def is_daily_quota_error(e):
+    """A 429 for a daily quota (RPD / tokens per day): its quota id reads ...PerDay..."""
+    return is_rate_limited(e) and 'PerDay' in str(e)
+
+
+def is_transient_error(e):
+    """429 burst limits and 5xx upstream errors are worth retrying; daily quota exhaustion is not."""
+    error_str = str(e)
+    if is_daily_quota_error(e):
+        return False
+    code = getattr(e, 'code', None)
+    if isinstance(code, int):
+        return code == 429 or code in (500, 502, 503, 504)
+    return '429' in error_str or '503 UNAVAILABLE' in error_str
+
+
+def estimate_tokens(history, user_input):
+    """Rough prompt size in tokens (about 4 characters per token)."""
+    chars = len(user_input or '') + sum(
+        len(part.text or '') for content in history for part in content.parts or []
+    )
+    return chars // 4 + 1
+
+
+class UpstreamScheduler:
+    """
+    Admits Gemini calls against global and per-user requests-per-minute and
+    tokens-per-minute buckets kept in the SharedStore, so all workers draw from
+    the same budget. Callers wait (up to max_wait) for budget to refill.
+
+    Priority: long requests may not drain the last `short_reserve` share of the
+    global buckets, which stays available to short requests. Transient upstream
+    errors are retried with jittered exponential backoff.
+    """
+
+    def __init__(self, store, limits, max_wait, short_request_tokens, short_reserve,
+                 output_tokens, max_retries, backoff_base, backoff_cap):
+        self.store = store
+        self.limits = limits
+        self.max_wait = max_wait
+        self.short_request_tokens = short_request_tokens
+        self.short_reserve = short_reserve
+        self.output_tokens = output_tokens
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.store.define(
+            'CREATE TABLE IF NOT EXISTS rate_buckets (name TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)'
+        )
+
+    def _buckets(self, user_id, include_user=True):
+        """(bucket name, capacity per minute, is_token_bucket); a capacity of 0 disables the bucket."""
+        buckets = [
+            ('global:rpm', self.limits['global_rpm'], False),
+            ('global:tpm', self.limits['global_tpm'], True),
+        ]
+        if include_user:
+            buckets += [
+                (f'user:{user_id}:rpm', self.limits['user_rpm'], False),
+                (f'user:{user_id}:tpm', self.limits['user_tpm'], True),
+            ]
+        return [bucket for bucket in buckets if bucket[1] > 0]
+
+    @staticmethod
+    def _level(row, capacity, now):
+        if row is None:
+            return float(capacity)
+        tokens, updated_at = row
+        return min(float(capacity), tokens + (now - updated_at) * capacity / 60.0)
+
+    def _try_take(self, user_id, tokens, short, include_user):
+        """One atomic attempt on every bucket. Returns (0, None) on success, else (seconds to wait, scope)."""
+        now = time.time()
+        conn = self.store.connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            wait, scope, levels = 0.0, None, []
+            for name, capacity, is_token_bucket in self._buckets(user_id, include_user):
+                row = conn.execute('SELECT tokens, updated_at FROM rate_buckets WHERE name = ?', (name,)).fetchone()
+                level = self._level(row, capacity, now)
+                floor = capacity * self.short_reserve if not short and name.startswith('global') else 0.0
+                # A request bigger than the whole bucket waits for a full bucket rather than forever
+                cost = min(tokens if is_token_bucket else 1, capacity - floor)
+                levels.append((name, level - cost))
+                deficit = cost + floor - level
+                if deficit > 0 and deficit * 60.0 / capacity > wait:
+                    wait, scope = deficit * 60.0 / capacity, name.split(':')[0]
+            if wait == 0:
+                conn.executemany(
+                    'INSERT OR REPLACE INTO rate_buckets (name, tokens, updated_at) VALUES (?, ?, ?)',
+                    [(name, level, now) for name, level in levels]
+                )
+            conn.execute('COMMIT')
+            return wait, scope
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def acquire(self, user_id, prompt_tokens, retry=False):
+        """
+        Blocks until the call fits in every bucket. Returns the tokens reserved for it.
+        Retries only draw from the global buckets: the user did not ask for them.
+        """
+        tokens = prompt_tokens + self.output_tokens
+        short = prompt_tokens <= self.short_request_tokens
+        deadline = time.time() + self.max_wait
+        while True:
+            wait, scope = self._try_take(user_id, tokens, short, include_user=not retry)
+            if wait == 0:
+                return tokens
+            if time.time() + wait > deadline:
+                self.store.incr('scheduler.throttled')
+                raise QuotaExceeded(scope, wait)
+            # Short requests re-check more often, so they win races for freshly refilled budget
+            time.sleep(min(wait, 0.1 if short else 0.5))
+
+    def settle(self, user_id, reserved, used, retry=False):
+        """Returns over-reserved tokens (or charges the shortfall) once the real usage is known."""
+        refund = reserved - used
+        if not refund:
+            return
+        now = time.time()
+        conn = self.store.connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for name, capacity, is_token_bucket in self._buckets(user_id, include_user=not retry):
+                if not is_token_bucket:
+                    continue
+                row = conn.execute('SELECT tokens, updated_at FROM rate_buckets WHERE name = ?', (name,)).fetchone()
+                level = min(float(capacity), self._level(row, capacity, now) + refund)
+                conn.execute(
+                    'INSERT OR REPLACE INTO rate_buckets (name, tokens, updated_at) VALUES (?, ?, ?)', (name, level, now)
+                )
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def backoff(self, attempt):
+        """Full-jitter exponential backoff delay for the given retry attempt (0-based)."""
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * (2 ** attempt)))
+
+    def call(self, user_id, prompt_tokens, send):
+        """Runs send() under the budget, retrying transient errors. Returns send()'s response."""
+        for attempt in range(self.max_retries + 1):
+            retry = attempt > 0
+            with span('quota'):
+                reserved = self.acquire(user_id, prompt_tokens, retry)
+            try:
+                response = send()
+            except Exception as e:
+                self.settle(user_id, reserved, 0, retry)
+                if attempt >= self.max_retries or not is_transient_error(e):
+                    raise
+                self.store.incr('scheduler.retries')
+                time.sleep(self.backoff(attempt))
+                continue
+            usage = getattr(response, 'usage_metadata', None)
+            self.settle(user_id, reserved, getattr(usage, 'total_token_count', None) or reserved, retry)
+            record_token_usage(usage)
+            return response
+
+    def stream(self, user_id, prompt_tokens, start_stream):
+        """
+        Like call() for streaming responses. Budget for the first attempt is taken
+        eagerly (so QuotaExceeded surfaces before any output); a failed attempt is
+        retried only if it broke before the first chunk was relayed.
+        """
+        with span('quota'):
+            reserved = self.acquire(user_id, prompt_tokens)
+
+        def chunks():
+            nonlocal reserved
+            attempt = 0
+            while True:
+                relayed, usage = False, None
+                try:
+                    for chunk in start_stream():
+                        relayed = True
+                        usage = getattr(chunk, 'usage_metadata', None) or usage
+                        yield chunk
+                except Exception as e:
+                    self.settle(user_id, reserved, getattr(usage, 'total_token_count', None) or 0, attempt > 0)
+                    if relayed or attempt >= self.max_retries or not is_transient_error(e):
+                        raise
+                    self.store.incr('scheduler.retries')
+                    time.sleep(self.backoff(attempt))
+                    attempt += 1
+                    reserved = self.acquire(user_id, prompt_tokens, retry=True)
+                    continue
+                self.settle(user_id, reserved, getattr(usage, 'total_token_count', None) or reserved, attempt > 0)
+                record_token_usage(usage)
+                return
+
+        return chunks()
+
+    def remaining(self, user_id):
+        """Current budget left in each bucket (after refill), without consuming anything."""
+        now = time.time()
+        report = {}
+        for name, capacity, _ in self._buckets(user_id):
+            row = self.store.execute('SELECT tokens, updated_at FROM rate_buckets WHERE name = ?', (name,)).fetchone()
+            scope, _, unit = name.rpartition(':')
+            key = f"{'user' if scope.startswith('user') else 'global'}_{unit}"
+            report[key] = {'remaining': int(self._level(row, capacity, now)), 'limit': capacity}
+        return report
+
+    def stats(self):
+        return self.store.counters('scheduler.')
+
+
+# --- Upstream Calls (sync client, or client.aio on a per-worker event loop) ---
+
+class AsyncBridge:
+    """
+    Runs one asyncio event loop in a background thread of this worker so request
+    threads can await client.aio calls. All in-flight Gemini calls of the worker
+    then share a single async HTTP connection pool instead of one blocking socket each.
+    """
+
+    def __init__(self):
+        self._loop = None
+        self._lock = threading.Lock()
+
+    @property
+    def loop(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name='gemini-aio', daemon=True).start()
+            return self._loop
+
+    def run(self, coro, timeout):
+        """Runs a coroutine on the loop and blocks the calling thread for its result."""
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        try:
+            return future.result(timeout)
+        except BaseException:
+            future.cancel()
+            raise
+
+    def iterate(self, make_async_iterator, timeout):
+        """Turns an async iterator into a blocking generator; closing it cancels the upstream call."""
+        items = queue.Queue()
+
+        async def pump():
+            try:
+                async for item in await make_async_iterator():
+                    items.put(('item', item))
+            except BaseException as e:
+                items.put(('error', e))
+            finally:
+                items.put(('end', None))
+
+        future = asyncio.run_coroutine_threadsafe(pump(), self.loop)
+        try:
+            while True:
+                kind, value = items.get(timeout=timeout)
+                if kind == 'item':
+                    yield value
+                elif kind == 'error':
+                    raise value
+                else:
+                    return
+        finally:
+            future.cancel()
+
+
+def gemini_send(user_id, history, user_input):
+    """Sends one turn to Gemini through the quota scheduler and returns the full response object."""
+    client, config = get_gemini()
+    async_bridge, upstream_scheduler = service('async_bridge'), service('upstream_scheduler')
+    use_async, timeout = current_app.config['GEMINI_ASYNC'], current_app.config['GEMINI_TIMEOUT']
+
+    def send():
+        if use_async:
+            async def send_async():
+                chat_session = client.aio.chats.create(model=GEMINI_MODEL, config=config, history=history)
+                return await chat_session.send_message(user_input)
+            return async_bridge.run(send_async(), timeout)
+
+        chat_session = client.chats.create(model=GEMINI_MODEL, config=config, history=history)
+        return chat_session.send_message(user_input)
+
+    with span('upstream'):
+        return upstream_scheduler.call(user_id, estimate_tokens(history, user_input), send)
+
+
+def gemini_stream(user_id, history, user_input):
+    """Sends one turn to Gemini through the quota scheduler and returns an iterator of response chunks."""
+    client, config = get_gemini()
+    async_bridge, upstream_scheduler = service('async_bridge'), service('upstream_scheduler')
+    use_async, timeout = current_app.config['GEMINI_ASYNC'], current_app.config['GEMINI_TIMEOUT']
+
+    def start_stream():
+        if use_async:
+            def start_async_stream():
+                chat_session = client.aio.chats.create(model=GEMINI_MODEL, config=config, history=history)
+                return chat_session.send_message_stream(user_input)
+            return async_bridge.iterate(start_async_stream, timeout)
+
+        chat_session = client.chats.create(model=GEMINI_MODEL, config=config, history=history)
+        return chat_session.send_message_stream(user_input)
+
+    return upstream_scheduler.stream(user_id, estimate_tokens(history, user_input), start_stream)
+
+
+class ChatAdmission:
+    """
+    Per-worker concurrency limit for chats with a bounded wait queue.
+    When every slot is busy and the queue is full, callers are turned away
+    immediately so the route can answer 503 instead of piling up.
+    """
+
+    def __init__(self, max_inflight, max_queued, queue_timeout):
+        self.max_inflight = max_inflight
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self._slots = threading.BoundedSemaphore(max_inflight)
+        self._lock = threading.Lock()
+        self.inflight = 0
+        self.waiting = 0
+        self.rejected = 0
+
+    def enter(self):
+        """Takes a slot, waiting up to queue_timeout. Returns False if the caller should get a 503."""
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                if self.waiting >= self.max_queued:
+                    self.rejected += 1
+                    return False
+                self.waiting += 1
+            try:
+                acquired = self._slots.acquire(timeout=self.queue_timeout)
+            finally:
+                with self._lock:
+                    self.waiting -= 1
+            if not acquired:
+                with self._lock:
+                    self.rejected += 1
+                return False
+        with self._lock:
+            self.inflight += 1
+        return True
+
+    def leave(self):
+        with self._lock:
+            self.inflight -= 1
+        self._slots.release()
+
+    def stats(self):
+        return {
+            'inflight': self.inflight,
+            'waiting': self.waiting,
+            'rejected': self.rejected,
+            'max_inflight': self.max_inflight,
+            'max_queued': self.max_queued
+        }
+
+
+def quota_response(e):
+    """429 returned when the scheduler could not fit the call into the Gemini budget in time."""
+    if e.scope == 'user':
+        message = "🤖 You're sending requests a bit fast! Please wait a moment and try again."
+    else:
+        message = "🤖 The recommender is getting a lot of requests right now. Please try again shortly."
+    response = jsonify({"response": message})
+    response.headers['Retry-After'] = str(max(int(e.retry_after), 1))
+    return response, 429
+
+
+BUSY_MESSAGE = "🤖 The recommender is busy right now. Please try again in a few seconds."
+
+
+def busy_response():
+    """503 returned when this worker's chat slots and wait queue are full, or Gemini still throttles us."""
+    response = jsonify({"response": BUSY_MESSAGE})
+    response.headers['Retry-After'] = '2'
+    return response, 503
+
+
+# --- Chat Helpers (shared by /chat and /chat/stream) ---
+
+# Matches one recommendation line: "1. Song Title - Artist (Year)"
+SONG_LINE_PATTERN = re.compile(
+    r'^\s*\d+\.\s*(?P<title>.+?)\s+[-\u2013\u2014]\s+(?P<artist>.+?)\s*\((?P<year>\d{4})\)'
+)
+LINE_BREAK_PATTERN = re.compile(r'<br\s*/?>|\n', re.IGNORECASE)
+
+
+def strip_html(text):
+    """Collapses <br> tags and whitespace so stored replies read as plain text."""
+    return ' '.join(LINE_BREAK_PATTERN.sub(' ', text or '').split())
+
+
+def extract_song_lines(text):
+    """Returns (title, artist, year) tuples for every numbered song entry in a model reply."""
+    songs = []
+    for line in LINE_BREAK_PATTERN.split(text or ''):
+        match = SONG_LINE_PATTERN.match(line)
+        if match:
+            songs.append((match.group('title').strip(), match.group('artist').strip(), match.group('year')))
+    return songs
+
+
+def summarize_messages(messages):
+    """
+    Cheap extractive summary of older turns (no extra model call):
+    what the user asked for, and which songs were already recommended.
+    """
+    lines = []
+    for msg in messages:
+        if msg.role == 'user':
+            lines.append(f"- User asked: {strip_html(msg.content)[:150]}")
+            continue
+        songs = extract_song_lines(msg.content)
+        if songs:
+            lines.append("- You recommended: " + "; ".join(f"{title} - {artist} ({year})" for title, artist, year in songs))
+        else:
+            lines.append(f"- You replied: {strip_html(msg.content)[:150]}")
+    return lines
+
+
+def fold_into_summary(summary, messages, char_budget):
+    """Appends the summary lines for `messages` and drops the oldest lines past the budget."""
+    lines = (summary.splitlines() if summary else []) + summarize_messages(messages)
+    while lines and len("\n".join(lines)) > char_budget:
+        lines.pop(0)
+    return "\n".join(lines)
+
+
+@span('history')
+def build_gemini_history(user_id, session_id):
+    """
+    Builds a bounded context for one turn: the stored rolling summary plus the last
+    CONTEXT_RECENT_TURNS turns verbatim (capped at CONTEXT_CHAR_BUDGET characters).
+    Returns (history, summary_update). Turns that fall out of the window are folded into
+    a new summary; summary_update is (summary, summary_through_at) for the caller to save
+    with its turn, or None when the stored summary is still current.
+    """
+    settle_pending_turns(user_id)
+    chat_session = ChatSession.query.filter_by(user_id=user_id, session_id=session_id).first()
+
+    # Only messages newer than the summary are read: an index range scan of bounded size
+    query = Message.query.filter_by(user_id=user_id, session_id=session_id)
+    if chat_session is not None and chat_session.summary_through_at is not None:
+        query = query.filter(Message.timestamp > chat_session.summary_through_at)
+    unsummarized = query.order_by(Message.timestamp.asc()).all()
+
+    window_size = current_app.config['CONTEXT_RECENT_TURNS'] * 2
+    split = max(len(unsummarized) - window_size, 0)
+    char_budget = current_app.config['CONTEXT_CHAR_BUDGET']
+    while split < len(unsummarized) and sum(len(msg.content) for msg in unsummarized[split:]) > char_budget:
+        split += 1
+    # Never start the verbatim window on a model reply
+    while split < len(unsummarized) and unsummarized[split].role != 'user':
+        split += 1
+
+    overflow, recent = unsummarized[:split], unsummarized[split:]
+    summary = chat_session.summary if chat_session is not None else None
+    summary_update = None
+    # Also for chats without a ChatSession row yet: persist_turns saves it on the row it creates
+    if overflow:
+        summary = fold_into_summary(summary, overflow, current_app.config['CONTEXT_SUMMARY_CHAR_BUDGET'])
+        summary_update = (summary, overflow[-1].timestamp)
+
+    history = []
+    if summary:
+        history.append(types.Content(
+            role='user',
+            parts=[types.Part.from_text(text="Summary of our earlier conversation, for context:\n" + summary)]
+        ))
+        history.append(types.Content(
+            role='model',
+            parts=[types.Part.from_text(text="Got it, I'll keep that in mind.")]
+        ))
+
+    history.extend(
+        types.Content(
+            role=msg.role,
+            parts=[types.Part.from_text(text=msg.content)]
+        )
+        for msg in recent
+    )
+    return history, summary_update
+
+
+@span('cleanup')
+def clean_model_text(text):
+    """Strips Markdown asterisks from model output (safe to apply chunk by chunk)."""
+    return re.sub(r'\*+', '', text or '')
+
+
+def sse_event(data, event=None):
+    """Formats a JSON payload as a single Server-Sent Event."""
+    payload = f"data: {json.dumps(data)}\n\n"
+    if event:
+        payload = f"event: {event}\n" + payload
+    return payload
+
+
+def sse_replay(session_id, text):
+    """A complete reply sent as a single-chunk event stream (cache hits and local answers)."""
+    def replay():
+        yield sse_event({"session_id": session_id}, event="start")
+        yield sse_event({"delta": text})
+        yield sse_event({"session_id": session_id}, event="done")
+    return Response(replay(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+
+def upstream_error_response(e):
+    """
+    Response for a failed Gemini call (or save): an exhausted daily quota as 429, a burst
+    limit that outlasted the retries as the 503 busy response, anything else as 500.
+    """
+    error_str = str(e)
+    if is_daily_quota_error(e):
+        return jsonify({"response": quota_error_message(e)}), 429
+    if is_rate_limited(e):
+        return busy_response()
+    print(f"General API Error: {error_str}")
+    return jsonify({"response": f"An API error occurred: {error_str}"}), 500
+
+
+class ChatRequest:
+    """A /chat or /chat/stream request that start_chat_turn() has made ready for Gemini."""
+    __slots__ = ('user_id', 'session_id', 'user_input', 'upstream_input', 'asked_at', 'history', 'summary_update')
+
+    def __init__(self, user_id, session_id, user_input, upstream_input, asked_at, history, summary_update):
+        self.user_id = user_id
+        self.session_id = session_id
+        self.user_input = user_input
+        self.upstream_input = upstream_input
+        self.asked_at = asked_at
+        self.history = history
+        self.summary_update = summary_update
+
+    def turn(self, reply):
+        return ChatTurn(self.user_id, self.session_id, self.user_input, reply, self.asked_at, self.summary_update)
+
+
+def start_chat_turn(local_reply_response):
+    """
+    Everything /chat and /chat/stream do before calling Gemini: make sure the client exists,
+    parse the request, restore an archived chat, answer from the song index when it can, and
+    build the Gemini history. Returns (response, None) when the request is already answered,
+    else (None, ChatRequest). `local_reply_response(session_id, reply)` formats a local answer.
+    """
+    # The worker's first chat creates the Gemini client; fail fast if it cannot be created
+    try:
+        get_gemini()
+    except Exception:
+        return (jsonify({"response": "Error: AI service client not available."}), 503), None
+
+    user_input = request.json.get("message")
+    user_id = current_user.id
+    # CRITICAL: Get session_id from the frontend request
+    session_id = request.json.get("session_id")
+    if not session_id:
+        # If no session ID is provided (e.g., first message ever), create one.
+        session_id = str(datetime.now().timestamp()).replace('.', '')
+
+    if not user_input:
+        return (jsonify({"response": "Please enter a message."}), 400), None
+
+    asked_at = datetime.utcnow()
+    # An archived chat moves back into the hot tables before anything reads its history
+    try:
+        rehydrate_session(user_id, session_id)
+    except RehydrationError as e:
+        print(e)
+        return (jsonify({"response": "Error: this chat could not be restored from the archive."}), 500), None
+
+    # "More like X" and mood requests may be answered from the local song index
+    local_reply, upstream_input = local_recommendation(user_id, session_id, user_input)
+    if local_reply is not None:
+        try:
+            save_turn(ChatTurn(user_id, session_id, user_input, local_reply, asked_at, extract_songs=False))
+        except Exception as e:
+            print(f"Database error while saving local reply: {e}")
+            return (jsonify({"response": f"An API error occurred: {e}"}), 500), None
+        return local_reply_response(session_id, local_reply), None
+
+    # Retrieve History for the SPECIFIC SESSION in the Gemini API format
+    history_for_gemini, summary_update = build_gemini_history(user_id, session_id)
+    # Nothing is written until the reply is back: return the connection to the pool while we wait
+    db.session.close()
+    return None, ChatRequest(user_id, session_id, user_input, upstream_input, asked_at, history_for_gemini, summary_update)
+
+
+def lookup_cached_reply(chat_request):
+    """
+    Identical prompt + context (e.g. preset buttons) is answered from the shared cache, and
+    concurrent identical requests share a single upstream call. Returns (cached reply, None),
+    or (None, CacheClaim) to release once the upstream call is done; a no-op claim when the
+    cache is disabled.
+    """
+    response_cache = service('response_cache')
+    if response_cache is None:
+        return None, CacheClaim(None, None, None)
+    return response_cache.lookup(response_cache.make_key(chat_request.upstream_input, chat_request.history))
+
+
+def quota_error_message(e):
+    """Returns the friendly message for an upstream 429 (daily quota or only throttled), else None."""
+    if is_daily_quota_error(e):
+        return "🤖 Error: Daily quota limit reached! Please upgrade your plan or wait until tomorrow."
+    if is_rate_limited(e):
+        return BUSY_MESSAGE
+    return None
+
+
+# --- Recommendation Extraction & Local Recommender ---
+
+# "Recommend OPM music for a Chill mood/playlist." (the preset buttons)
+MOOD_REQUEST_PATTERN = re.compile(r'recommend opm music for an? (?P<mood>[\w\s-]{1,30}?) mood', re.IGNORECASE)
+# "more like Buwan", "songs similar to Tadhana by Up Dharma Down"
+SIMILAR_REQUEST_PATTERN = re.compile(
+    r'\b(?:more|songs?|music|something|tracks?)\s+(?:similar to|like)\s+["“]?(?P<query>[^"”?!.,]{2,100})',
+    re.IGNORECASE
+)
+
+
+def normalize_key(text):
+    """Lowercased, punctuation-free form of a title or artist name used for matching."""
+    return ' '.join(re.sub(r'[^\w]+', ' ', (text or '').lower()).split())[:200]
+
+
+def parse_mood(user_input):
+    match = MOOD_REQUEST_PATTERN.search(user_input or '')
+    return normalize_key(match.group('mood'))[:30] if match else None
+
+
+def insert_ignoring_conflicts(model, rows):
+    """
+    INSERT ... ON CONFLICT DO NOTHING of `rows` (column dicts) in the current transaction,
+    so a row a concurrent request inserted first is skipped instead of failing the turn.
+    Not a SAVEPOINT: pysqlite emits no BEGIN before one, and its RELEASE would commit the
+    row on its own even if the rest of the turn then rolled back.
+    """
+    dialect = db.session.get_bind().dialect.name
+    dialect_insert = sqlite_insert if dialect == 'sqlite' else postgresql_insert
+    db.session.execute(dialect_insert(model).values(rows).on_conflict_do_nothing())
+
+
+def get_or_create(model, lookup, defaults):
+    """Fetches a row by its unique key, inserting it first if it is missing (a concurrent insert wins quietly)."""
+    instance = model.query.filter_by(**lookup).first()
+    if instance is None:
+        insert_ignoring_conflicts(model, [{**lookup, **defaults}])
+        instance = model.query.filter_by(**lookup).first()
+    return instance
+
+
+def get_or_create_all(model, criteria, key, new_rows):
+    """
+    Batched get_or_create: returns {key: row} for every key of `new_rows` ({key: column values}).
+    One SELECT (`criteria` must match at least those rows); if some are missing, one INSERT
+    of all of them (rows a concurrent insert added first are skipped) and the SELECT again.
+    """
+    found = {key(row): row for row in model.query.filter(criteria)}
+    missing = [values for row_key, values in new_rows.items() if row_key not in found]
+    if missing:
+        insert_ignoring_conflicts(model, missing)
+        found = {key(row): row for row in model.query.filter(criteria)}
+    return {row_key: found[row_key] for row_key in new_rows if row_key in found}
+
+
+def record_recommendations(model_message, user_input):
+    """
+    Parses a model reply into Song/Artist/Recommendation rows, looking up all of the
+    reply's artists and songs with one query each and inserting only the new ones.
+    Does NOT commit: the rows are saved in the same transaction as the reply.
+    """
+    entries = [(normalize_key(title), title, normalize_key(artist_name), artist_name, int(year))
+               for title, artist_name, year in extract_song_lines(model_message.content)]
+    if not entries:
+        return []
+
+    artist_rows = {}
+    for _, _, artist_key, artist_name, _ in entries:
+        artist_rows.setdefault(artist_key, {'name_key': artist_key, 'name': artist_name[:200]})
+    artists = get_or_create_all(Artist, Artist.name_key.in_(artist_rows), lambda artist: artist.name_key, artist_rows)
+
+    song_rows = {}
+    for title_key, title, artist_key, _, year in entries:
+        artist_id = artists[artist_key].id
+        song_rows.setdefault((artist_id, title_key),
+                             {'artist_id': artist_id, 'title_key': title_key, 'title': title[:200], 'year': year})
+    songs = list(get_or_create_all(
+        Song,
+        and_(Song.artist_id.in_({artist_id for artist_id, _ in song_rows}),
+             Song.title_key.in_({title_key for _, title_key in song_rows})),
+        lambda song: (song.artist_id, song.title_key),
+        song_rows
+    ).values())
+
+    mood = parse_mood(user_input)
+    db.session.flush()  # assigns model_message.id if no query above has flushed it yet
+    db.session.execute(insert(Recommendation), [
+        {
+            'message_id': model_message.id,
+            'user_id': model_message.user_id,
+            'session_id': model_message.session_id,
+            'song_id': song.id,
+            'rank': rank,
+            'mood': mood
+        }
+        for rank, song in enumerate(songs, start=1)
+    ])
+    return songs
+
+
+class SongGraph:
+    """Co-occurrence counts over Recommendation rows, as read by SongIndex."""
+
+    def __init__(self):
+        self.last_id = 0
+        self.song_sessions = Counter()        # song id -> sessions it appeared in
+        self.pairs = defaultdict(Counter)     # song id -> related song id -> sessions shared
+        self.mood_songs = defaultdict(Counter)
+        self.session_songs = defaultdict(set)
+        self.songs = {}                       # song id -> (title, artist, year)
+
+    def load(self):
+        """Reads the Recommendation rows after last_id, and the songs not described yet. Changes nothing."""
+        rows = db.session.query(
+            Recommendation.id, Recommendation.user_id, Recommendation.session_id,
+            Recommendation.song_id, Recommendation.mood
+        ).filter(Recommendation.id > self.last_id).order_by(Recommendation.id.asc()).all()
+        new_song_ids = {row.song_id for row in rows if row.song_id not in self.songs}
+        songs = {}
+        if new_song_ids:
+            for song in Song.query.filter(Song.id.in_(new_song_ids)).all():
+                songs[song.id] = (song.title, song.artist.name, song.year)
+        return rows, songs
+
+    def add(self, rows, songs):
+        for rec_id, user_id, session_id, song_id, mood in rows:
+            if rec_id <= self.last_id:
+                continue
+            self.last_id = rec_id
+            seen = self.session_songs[(user_id, session_id)]
+            if song_id in seen:
+                continue
+            for other in seen:
+                self.pairs[song_id][other] += 1
+                self.pairs[other][song_id] += 1
+            seen.add(song_id)
+            self.song_sessions[song_id] += 1
+            if mood:
+                self.mood_songs[mood][song_id] += 1
+        self.songs.update(songs)
+
+
+class SongIndex:
+    """
+    In-process similarity index over Recommendation rows. Two songs are related
+    when they were recommended in the same conversation; similarity is the cosine
+    of their co-occurrence counts across every session and user.
+
+    Requests refresh the graph incrementally (new Recommendation ids only), querying
+    outside the lock and holding it just to apply the rows. The first build and the
+    periodic rebuild, which let deleted chats drop out, read the whole table in a
+    background thread into a fresh SongGraph that is swapped in when done. Until the
+    first build finishes, nothing is answered locally.
+    """
+
+    def __init__(self, refresh_interval, rebuild_interval, min_support):
+        self.refresh_interval = refresh_interval
+        self.rebuild_interval = rebuild_interval
+        self.min_support = min_support
+        self._lock = threading.Lock()             # guards self.graph; readers hold it too
+        self._refresh_lock = threading.Lock()     # one incremental refresh at a time
+        self._rebuilding = False
+        self.graph = SongGraph()
+        self.built_at = None
+        self.refreshed_at = 0.0
+
+    def refresh(self):
+        now = time.time()
+        if self.built_at is None or now - self.built_at > self.rebuild_interval:
+            self._start_rebuild()
+        if self.built_at is None or now - self.refreshed_at < self.refresh_interval:
+            return
+        if not self._refresh_lock.acquire(blocking=False):
+            return  # another request is refreshing: answer from the graph as it is
+        try:
+            if time.time() - self.refreshed_at < self.refresh_interval:
+                return
+            graph = self.graph
+            rows, songs = graph.load()
+            with self._lock:
+                if graph is self.graph:  # else a rebuild swapped in a newer graph meanwhile
+                    graph.add(rows, songs)
+            self.refreshed_at = time.time()
+        finally:
+            self._refresh_lock.release()
+
+    def _start_rebuild(self):
+        with self._lock:
+            if self._rebuilding:
+                return
+            self._rebuilding = True
+        app = current_app._get_current_object()
+        threading.Thread(target=self._rebuild, args=(app,), name='song-index-rebuild', daemon=True).start()
+
+    def _rebuild(self, app):
+        started = time.perf_counter()
+        graph = SongGraph()
+        try:
+            with app.app_context():
+                graph.add(*graph.load())
+            with self._lock:
+                self.graph = graph
+            self.refreshed_at = time.time()
+            print(f"Song index rebuilt: {len(graph.song_sessions)} songs in {time.perf_counter() - started:.2f}s")
+        except Exception as e:
+            print(f"Song index rebuild failed: {e}")
+        finally:
+            # A failed rebuild is retried after another rebuild_interval, keeping the old graph meanwhile
+            self.built_at = time.time()
+            self._rebuilding = False
+
+    def similar(self, seed_ids, exclude=(), k=5):
+        """Songs most often recommended together with the seeds, best first."""
+        scores = Counter()
+        with self._lock:
+            graph = self.graph
+            for seed in seed_ids:
+                for other, together in graph.pairs.get(seed, {}).items():
+                    if together < self.min_support:
+                        continue
+                    scores[other] += together / math.sqrt(graph.song_sessions[seed] * graph.song_sessions[other])
+        skip = set(seed_ids) | set(exclude)
+        return [song_id for song_id, _ in scores.most_common() if song_id not in skip][:k]
+
+    def for_mood(self, mood, exclude=(), k=5):
+        """
+        A varied pick among the songs most often recommended for a mood. Until the
+        mood has at least 3*k songs, returns fewer than k so Gemini keeps adding variety.
+        """
+        with self._lock:
+            ranked = self.graph.mood_songs.get(mood, Counter()).most_common(k * 3)
+        top = [song_id for song_id, _ in ranked if song_id not in exclude]
+        if len(top) < k * 3:
+            return top[:k - 1]
+        return random.sample(top, k)
+
+    def session_recommended(self, user_id, session_id):
+        """Songs already recommended in this chat."""
+        with self._lock:
+            return set(self.graph.session_songs.get((user_id, session_id), ()))
+
+    def describe(self, song_ids):
+        with self._lock:
+            songs = self.graph.songs
+            return [songs[song_id] for song_id in song_ids if song_id in songs]
+
+    def stats(self):
+        with self._lock:
+            graph = self.graph
+            return {'songs': len(graph.song_sessions), 'sessions': len(graph.session_songs),
+                    'last_recommendation_id': graph.last_id, 'rebuilding': self._rebuilding}
+
+
+def resolve_seed_songs(query):
+    """
+    Song ids matching "Title", "Title by Artist", "Title - Artist", or an artist's name,
+    plus the part of the query that matched. Trailing words are dropped until
+    something matches ("Buwan please" -> "Buwan"). Every candidate is looked up at
+    once: one query for the titles, and one for the artist names if no title matched.
+    """
+    words = query.split()[:8]
+    candidates = []  # (text, title key, artist key or None), longest first
+    for length in range(len(words), 0, -1):
+        candidate = ' '.join(words[:length])
+        title, artist = candidate, None
+        for separator in (' by ', ' - '):
+            if separator in candidate:
+                title, artist = candidate.split(separator, 1)
+                break
+        candidates.append((candidate, normalize_key(title), normalize_key(artist) if artist else None))
+    if not candidates:
+        return [], query
+
+    rows = db.session.query(Song.id, Song.title_key, Artist.name_key).join(Artist).filter(
+        Song.title_key.in_({title_key for _, title_key, _ in candidates})
+    ).order_by(Song.id).all()
+    for candidate, title_key, artist_key in candidates:
+        seed_ids = [song_id for song_id, song_title_key, song_artist_key in rows
+                    if song_title_key == title_key and artist_key in (None, song_artist_key)][:20]
+        if seed_ids:
+            return seed_ids, candidate
+
+    artist_ids = dict(db.session.query(Artist.name_key, Artist.id).filter(
+        Artist.name_key.in_({normalize_key(candidate) for candidate, _, _ in candidates})
+    ).all())
+    for candidate, _, _ in candidates:
+        artist_id = artist_ids.get(normalize_key(candidate))
+        if artist_id is not None:
+            return [song_id for (song_id,) in db.session.query(Song.id).filter_by(artist_id=artist_id).limit(20)], candidate
+    return [], query
+
+
+def compose_local_reply(intro, songs, reason):
+    """Formats locally picked songs exactly like the model's numbered list."""
+    lines = [f"{number}. {title} - {artist} ({year}). {reason}<br>" for number, (title, artist, year) in enumerate(songs, start=1)]
+    return f"{intro}\n<br><br>\n" + "\n".join(lines) + "\n<br>\nWant me to find more songs with this vibe?"
+
+
+@span('recommender')
+def local_recommendation(user_id, session_id, user_input):
+    """
+    Tries to answer "more like X" and mood requests from the song index.
+    Returns (reply, upstream_input): a full local reply when there are enough
+    candidates, otherwise None plus the prompt to send to Gemini, enriched with
+    any candidates we did find.
+    """
+    song_index = service('song_index')
+    if song_index is None:
+        return None, user_input
+    song_index.refresh()
+
+    already_recommended = song_index.session_recommended(user_id, session_id)
+    similar_match = SIMILAR_REQUEST_PATTERN.search(user_input)
+    mood = parse_mood(user_input)
+    candidates, intro, reason = [], None, None
+    if similar_match:
+        seed_ids, seed_label = resolve_seed_songs(similar_match.group('query'))
+        candidates = song_index.similar(seed_ids, already_recommended, current_app.config['RECOMMENDER_LOCAL_SONGS'])
+        intro = f"Fans of {seed_label} keep coming back to these OPM gems!"
+        reason = f"Often recommended alongside {seed_label} by fellow listeners."
+    elif mood:
+        candidates = song_index.for_mood(mood, already_recommended, current_app.config['RECOMMENDER_LOCAL_SONGS'])
+        intro = f"Here's a {mood} OPM lineup our listeners love!"
+        reason = f"A favorite pick for a {mood} mood."
+
+    songs = song_index.describe(candidates)
+    if len(songs) >= current_app.config['RECOMMENDER_LOCAL_SONGS']:
+        return compose_local_reply(intro, songs, reason), user_input
+    if songs:
+        hint = "; ".join(f"{title} - {artist} ({year})" for title, artist, year in songs)
+        return None, f"{user_input}\n\n(Listeners with similar taste also enjoyed: {hint}. Include them if they fit.)"
+    return None, user_input
+
+
+# --- Chat Turn Persistence (one transaction per turn, or batched write-behind) ---
+class ChatTurn:
+    """One finished user/model exchange, ready to be written."""
+    __slots__ = ('user_id', 'session_id', 'user_input', 'reply', 'asked_at', 'answered_at',
+                 'summary_update', 'extract_songs', 'attempts')
+
+    def __init__(self, user_id, session_id, user_input, reply, asked_at, summary_update=None, extract_songs=True):
+        self.user_id = user_id
+        self.session_id = session_id
+        self.user_input = user_input
+        self.reply = reply
+        self.asked_at = asked_at
+        self.answered_at = datetime.utcnow()
+        self.summary_update = summary_update
+        # Local replies are not fed back into the song index
+        self.extract_songs = extract_songs
+        self.attempts = 0
+
+
+def new_chat_session_values(turn):
+    """
+    Columns for a chat's first ChatSession row. A chat saved before the table existed
+    already has messages, so its title, start and count come from those, not from this turn.
+    """
+    first_timestamp, message_count = db.session.query(
+        func.min(Message.timestamp), func.count(Message.id)
+    ).filter_by(user_id=turn.user_id, session_id=turn.session_id).one()
+    if not message_count:
+        return {
+            'title': (turn.user_input or 'New Chat')[:100],
+            'created_at': turn.asked_at,
+            'last_message_at': turn.answered_at,
+            'message_count': 0
+        }
+    title = db.session.query(func.min(Message.content)).filter_by(
+        user_id=turn.user_id, session_id=turn.session_id, timestamp=first_timestamp
+    ).scalar()
+    return {
+        'title': (title or 'New Chat')[:100],
+        'created_at': first_timestamp,
+        'last_message_at': turn.answered_at,
+        'message_count': message_count
+    }
+
+
+@span('commit')
+def persist_turns(turns):
+    """
+    Writes finished turns in a single transaction: both messages of every turn, the
+    ChatSession counters and rolling summary, and the songs each reply recommends.
+    Rolls back and re-raises on failure, so a turn is either saved whole or not at all.
+    """
+    try:
+        chat_sessions = {}
+        for turn in turns:
+            key = (turn.user_id, turn.session_id)
+            if key not in chat_sessions:
+                chat_sessions[key] = ChatSession.query.filter_by(
+                    user_id=turn.user_id, session_id=turn.session_id
+                ).first() or get_or_create(
+                    ChatSession,
+                    {'user_id': turn.user_id, 'session_id': turn.session_id},
+                    new_chat_session_values(turn)
+                )
+
+        # All messages are added before the next query, so they go out as one batched INSERT
+        model_messages = []
+        added = Counter()
+        for turn in turns:
+            db.session.add(Message(
+                user_id=turn.user_id, session_id=turn.session_id, role='user',
+                content=turn.user_input, timestamp=turn.asked_at
+            ))
+            model_message = Message(
+                user_id=turn.user_id, session_id=turn.session_id, role='model',
+                content=turn.reply, timestamp=turn.answered_at
+            )
+            db.session.add(model_message)
+            model_messages.append(model_message)
+            added[(turn.user_id, turn.session_id)] += 2
+
+            chat_session = chat_sessions[(turn.user_id, turn.session_id)]
+            if chat_session.last_message_at is None or chat_session.last_message_at < turn.answered_at:
+                chat_session.last_message_at = turn.answered_at
+            if turn.summary_update is not None:
+                summary, summary_through_at = turn.summary_update
+                # Another worker may already have saved a newer summary
+                if chat_session.summary_through_at is None or chat_session.summary_through_at < summary_through_at:
+                    chat_session.summary = summary
+                    chat_session.summary_through_at = summary_through_at
+
+        for key, count in added.items():
+            # Increment in SQL so concurrent turns don't lose updates
+            chat_sessions[key].message_count = ChatSession.message_count + count
+
+        for turn, model_message in zip(turns, model_messages):
+            if turn.extract_songs:
+                record_recommendations(model_message, turn.user_input)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+class MessageWriter:
+    """
+    Write-behind queue for finished turns (MESSAGE_WRITE_MODE=write_behind). Routes
+    return as soon as their turn is queued; a background thread of this worker writes
+    the queue in batches of MESSAGE_BATCH_SIZE turns, at least every MESSAGE_FLUSH_INTERVAL
+    seconds, and once more when the worker exits normally (gunicorn graceful shutdown).
+    """
+
+    MAX_ATTEMPTS = 3
+
+    def __init__(self, app, batch_size, flush_interval, max_queued):
+        self.app = app
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queued = max_queued
+        self._queued = []        # turns waiting, oldest first
+        self._writing = []       # the batch being written right now
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self.turns_written = 0
+        self.batches = 0
+        self.failed_turns = 0
+        self.forced_flushes = 0
+
+    def _start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='message-writer', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if len(self._queued) < self.batch_size:
+                    self._cond.wait(self.flush_interval)
+            self.flush()
+
+    def submit(self, turn):
+        with self._cond:
+            self._start()
+            self._queued.append(turn)
+            if len(self._queued) >= self.batch_size:
+                self._cond.notify()
+            overloaded = len(self._queued) >= self.max_queued
+        if overloaded:
+            # The writer has fallen behind: this request pays for a flush instead of growing the queue
+            self.forced_flushes += 1
+            self.flush()
+
+    def has_pending(self, user_id):
+        with self._cond:
+            return any(turn.user_id == user_id for turn in self._queued + self._writing)
+
+    def flush(self):
+        """Writes every queued turn before returning (waits for a batch already being written)."""
+        while True:
+            with self._flush_lock:
+                with self._cond:
+                    batch = self._queued[:self.batch_size]
+                    del self._queued[:len(batch)]
+                    self._writing = batch
+                if not batch:
+                    return
+                try:
+                    written = self._write(batch)
+                finally:
+                    with self._cond:
+                        self._writing = []
+                if not written:
+                    # Failed turns were put back; the thread tries again after the next interval
+                    return
+
+    def _write(self, batch):
+        """Writes one batch; returns False if some turns had to be put back in the queue."""
+        with self.app.app_context():
+            try:
+                persist_turns(batch)
+                self.turns_written += len(batch)
+                self.batches += 1
+                return True
+            except Exception as e:
+                print(f"Batch write of {len(batch)} turns failed, retrying one by one: {e}")
+
+            retry = []
+            for turn in batch:
+                try:
+                    persist_turns([turn])
+                    self.turns_written += 1
+                except Exception as e:
+                    turn.attempts += 1
+                    if turn.attempts < self.MAX_ATTEMPTS:
+                        retry.append(turn)
+                    else:
+                        self.failed_turns += 1
+                        print(f"Dropping chat turn for session {turn.session_id} after {turn.attempts} attempts: {e}")
+            if retry:
+                with self._cond:
+                    self._queued[:0] = retry
+            return not retry
+
+    def stats(self):
+        return {
+            'queued': len(self._queued) + len(self._writing),
+            'turns_written': self.turns_written,
+            'batches': self.batches,
+            'avg_batch_size': round(self.turns_written / self.batches, 1) if self.batches else 0.0,
+            'failed_turns': self.failed_turns,
+            'forced_flushes': self.forced_flushes
+        }
+
+
+def save_turn(turn):
+    """Commits a finished turn now, or queues it for the write-behind thread."""
+    message_writer = service('message_writer')
+    if message_writer is not None:
+        message_writer.submit(turn)
+    else:
+        persist_turns([turn])
+
+
+def settle_pending_turns(user_id):
+    """Read-your-writes: before reading a user's history, write any turns this worker still queues for them."""
+    message_writer = service('message_writer')
+    if message_writer is not None and message_writer.has_pending(user_id):
+        message_writer.flush()
+
+
+# --- History Archive (idle sessions in cold storage, NDJSON export/import) ---
+ARCHIVE_CHUNK_ROWS = 500                  # rows per SELECT page / INSERT when moving history
+IMPORT_MAX_LINE_BYTES = 1024 * 1024       # longest NDJSON line /import accepts
+EXPORT_VERSION = 1
+
+
+def ndjson_line(record):
+    return json.dumps(record, separators=(',', ':'), ensure_ascii=False) + '\n'
+
+
+def iter_archive(payload):
+    """Decompresses an ArchivedSession payload piece by piece, yielding one record per line."""
+    decompressor = zlib.decompressobj()
+    pending = b''
+    for start in range(0, len(payload), 64 * 1024):
+        pending += decompressor.decompress(payload[start:start + 64 * 1024])
+        *lines, pending = pending.split(b'\n')
+        for line in lines:
+            yield json.loads(line)
+    pending += decompressor.flush()
+    if pending.strip():
+        yield json.loads(pending)
+
+
+def iter_in_chunks(values, size=ARCHIVE_CHUNK_ROWS):
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def archive_session(chat_session):
+    """
+    Moves one session's messages (and the recommendations parsed from them) into an
+    ArchivedSession blob and deletes them from the hot tables; the ChatSession row stays, so
+    the sidebar does not change. Only the rows read here are deleted: a turn saved meanwhile
+    stays hot and is merged with the archive when the session is rehydrated.
+    Returns (messages archived, raw bytes, compressed bytes). The caller commits.
+    """
+    key = {'user_id': chat_session.user_id, 'session_id': chat_session.session_id}
+    compressor = zlib.compressobj(6)
+    chunks, raw_bytes, message_ids, recommendation_ids = [], 0, [], []
+    first_at = last_at = None
+
+    def add(record):
+        nonlocal raw_bytes
+        line = ndjson_line(record).encode('utf-8')
+        raw_bytes += len(line)
+        chunks.append(compressor.compress(line))
+
+    for msg in Message.query.filter_by(**key).order_by(Message.timestamp, Message.id).yield_per(ARCHIVE_CHUNK_ROWS):
+        add({'type': 'message', 'id': msg.id, 'role': msg.role, 'content': msg.content,
+             'timestamp': msg.timestamp.isoformat()})
+        message_ids.append(msg.id)
+        first_at = first_at or msg.timestamp
+        last_at = msg.timestamp
+    if not message_ids:
+        return 0, 0, 0
+    for rec in Recommendation.query.filter_by(**key).order_by(Recommendation.id).yield_per(ARCHIVE_CHUNK_ROWS):
+        add({'type': 'recommendation', 'id': rec.id, 'message_id': rec.message_id, 'song_id': rec.song_id,
+             'rank': rec.rank, 'mood': rec.mood, 'created_at': rec.created_at.isoformat()})
+        recommendation_ids.append(rec.id)
+
+    payload = b''.join(chunks) + compressor.flush()
+    db.session.add(ArchivedSession(
+        message_count=len(message_ids), first_message_at=first_at, last_message_at=last_at,
+        raw_bytes=raw_bytes, payload=payload, **key
+    ))
+    # Recommendations reference the messages, so they go first
+    for ids in iter_in_chunks(recommendation_ids):
+        Recommendation.query.filter(Recommendation.id.in_(ids)).delete(synchronize_session=False)
+    for ids in iter_in_chunks(message_ids):
+        Message.query.filter(Message.id.in_(ids)).delete(synchronize_session=False)
+    chat_session.archived_at = datetime.utcnow()
+    return len(message_ids), raw_bytes, len(payload)
+
+
+class RehydrationError(Exception):
+    """An archived session could not be moved back into the hot tables."""
+
+
+def rehydrate_session(user_id, session_id):
+    """
+    Moves an archived session back into the hot tables the first time it is touched again,
+    with its original message ids so paging cursors and recommendation links still match.
+    Returns True if this call restored it. For sessions that are not archived this is one
+    indexed lookup. Raises RehydrationError (after rolling back) if the rows cannot be restored.
+    """
+    archived_at = db.session.query(ChatSession.archived_at).filter_by(
+        user_id=user_id, session_id=session_id
+    ).scalar()
+    if archived_at is None:
+        return False
+
+    with span('rehydrate'):
+        try:
+            archive = ArchivedSession.query.filter_by(user_id=user_id, session_id=session_id).first()
+            # Whoever deletes the archive row restores it; a concurrent request for the same
+            # session finds it gone and only has to clear archived_at
+            restored = archive is not None and ArchivedSession.query.filter_by(id=archive.id).delete(
+                synchronize_session=False
+            ) == 1
+            if restored:
+                messages, recommendations = [], []
+
+                def write():
+                    if messages:
+                        db.session.execute(insert(Message), messages)
+                        messages.clear()
+                    if recommendations:
+                        db.session.execute(insert(Recommendation), recommendations)
+                        recommendations.clear()
+
+                for record in iter_archive(archive.payload):
+                    if record['type'] == 'message':
+                        messages.append({
+                            'id': record['id'], 'user_id': user_id, 'session_id': session_id, 'role': record['role'],
+                            'content': record['content'], 'timestamp': datetime.fromisoformat(record['timestamp'])
+                        })
+                    else:
+                        recommendations.append({
+                            'id': record['id'], 'message_id': record['message_id'], 'user_id': user_id,
+                            'session_id': session_id, 'song_id': record['song_id'], 'rank': record['rank'],
+                            'mood': record['mood'], 'created_at': datetime.fromisoformat(record['created_at'])
+                        })
+                    if len(messages) + len(recommendations) >= ARCHIVE_CHUNK_ROWS:
+                        write()
+                write()
+            ChatSession.query.filter_by(user_id=user_id, session_id=session_id).update(
+                {'archived_at': None}, synchronize_session=False
+            )
+            db.session.commit()
+        except IntegrityError as e:
+            db.session.rollback()
+            # Fine if another worker restored the same session meanwhile: then the archive row
+            # is gone and archived_at cleared. Otherwise (e.g. a new message reused an archived
+            # message's id) the history really is missing.
+            archive_left = ArchivedSession.query.filter_by(user_id=user_id, session_id=session_id).first()
+            still_archived = db.session.query(ChatSession.archived_at).filter_by(
+                user_id=user_id, session_id=session_id
+            ).scalar()
+            if archive_left is not None or still_archived is not None:
+                raise RehydrationError(f"Rehydrating session {session_id} failed: {e}") from e
+            return False
+        except Exception as e:
+            db.session.rollback()
+            raise RehydrationError(f"Rehydrating session {session_id} failed: {e}") from e
+    return restored
+
+
+def time_hot_queries(sessions, repeats=5):
+    """Median milliseconds of the per-session hot-path queries over the given (user_id, session_id) pairs."""
+    queries = {
+        'load_session page': lambda user_id, session_id: Message.query.filter_by(
+            user_id=user_id, session_id=session_id
+        ).order_by(Message.timestamp.desc(), Message.id.desc()).limit(HISTORY_PAGE_SIZE + 1).all(),
+        'chat history load': lambda user_id, session_id: Message.query.filter_by(
+            user_id=user_id, session_id=session_id
+        ).order_by(Message.timestamp.asc()).all(),
+        'sidebar page': lambda user_id, session_id: ChatSession.query.filter_by(user_id=user_id).order_by(
+            ChatSession.last_message_at.desc(), ChatSession.id.desc()
+        ).limit(SIDEBAR_PAGE_SIZE + 1).all(),
+        'per-user message scan': lambda user_id, session_id: db.session.query(
+            Message.session_id, func.count()
+        ).filter(Message.user_id == user_id).group_by(Message.session_id).all(),
+    }
+    timings = {}
+    for name, run in queries.items():
+        samples = []
+        for user_id, session_id in sessions:
+            for _ in range(repeats):
+                started = time.perf_counter()
+                run(user_id, session_id)
+                samples.append(time.perf_counter() - started)
+            db.session.expunge_all()
+        timings[name] = statistics.median(samples) * 1000 if samples else 0.0
+    return timings
+
+
+# ----------------------------------------------------
+#               FLASK ROUTES
+# ----------------------------------------------------
+
+@bp.route("/")
+def index():
+    return render_template("index.html", current_user=current_user)
+
+@bp.route("/signup")
+def signup():
+    return render_template("signup.html") 
+
+# --- USER REGISTRATION ---
+@bp.route("/register", methods=["POST"])
+def register():
+    # ... (Your /register route logic remains the same) ...
+    data = request.get_json()
+    
+    name = data.get('name')
+    username = data.get('username')
+    email = data.get('email')
+    password = data.get('password')
+    age = data.get('age')
+    birthday_str = data.get('birthday')
+
+    if not all([username, email, password, name, age, birthday_str]):
+        return jsonify({'error': 'Missing required fields.'}), 400
+
+    if User.query.filter_by(username=username).first():
+        return jsonify({'error': 'Username is already taken.'}), 409
+    
+    if User.query.filter_by(email=email).first():
+        return jsonify({'error': 'Email is already in use.'}), 409
+
+    try:
+        hashed_password = bcrypt.generate_password_hash(password).decode('utf-8')
+        birthday_date = datetime.strptime(birthday_str, '%Y-%m-%d').date() 
+        age_int = int(age)
+
+        user = User(
+            name=name,
+            username=username,
+            email=email,
+            password=hashed_password,
+            age=age_int,
+            birthday=birthday_date 
+        )
+        
+        db.session.add(user)
+        db.session.commit()
+        
+        return jsonify({'message': 'User registered successfully', 'redirect_url': url_for('main.login')}), 201
+
+    except ValueError:
+        return jsonify({'error': 'Invalid format for age or birthday.'}), 400
+    except Exception as e:
+        db.session.rollback()
+        print(f"Database error during registration: {e}")
+        return jsonify({'error': 'Internal server error during registration.'}), 500
+
+
+# --- LOGIN ROUTE ---
+@bp.route("/login", methods=['GET', 'POST'])
+def login():
+    if current_user.is_authenticated:
+        return redirect(url_for('main.index'))
+    
+    if request.method == 'GET':
+        return render_template('login.html', title='Login')
+    
+    data = request.get_json()
+    username = data.get('username')
+    password = data.get('password')
+    
+    user = User.query.filter_by(username=username).first()
+    
+    if user and bcrypt.check_password_hash(user.password, password):
+        login_user(user)
+        return jsonify({
+            'success': True, 
+            'message': 'Login successful!',
+            'redirect_url': url_for('main.index') 
+        }), 200
+    else:
+        return jsonify({
+            'success': False, 
+            'error': 'Login failed. Check username and password.'
+        }), 401
+
+# --- LOGOUT ROUTE ---
+@bp.route("/logout")
+def logout():
+    user_cache = service('user_cache')
+    if user_cache is not None and current_user.is_authenticated:
+        user_cache.invalidate(current_user.id)
+    logout_user()
+    return redirect(url_for('main.index')) 
+
+
+# --- PERSISTENT CHAT ROUTE (The core logic) ---
+@bp.route("/chat", methods=["POST"])
+@login_required 
+def chat():
+    response, chat_request = start_chat_turn(
+        lambda session_id, reply: (jsonify({"response": reply, "session_id": session_id}), 200)
+    )
+    if response is not None:
+        return response
+
+    # Bounded concurrency: wait briefly for a free slot, or fail fast with 503
+    chat_admission = service('chat_admission')
+    if not chat_admission.enter():
+        return busy_response()
+
+    try:
+        clean_text, claim = lookup_cached_reply(chat_request)
+        if clean_text is None:
+            with claim:
+                # Send the message with the session history and get the response
+                gemini_response = gemini_send(chat_request.user_id, chat_request.history, chat_request.upstream_input)
+                clean_text = clean_model_text(gemini_response.text)
+                claim.store(clean_text)
+
+        # Save the user message and the CLEAN model response (and the songs it recommends) in one transaction
+        save_turn(chat_request.turn(clean_text))
+
+        # Return the CLEAN response AND the session_id
+        return jsonify({"response": clean_text, "session_id": chat_request.session_id}), 200
+
+    except QuotaExceeded as e:
+        return quota_response(e)
+    except Exception as e:
+        # Nothing of the turn has been written if the API call or the save failed
+        return upstream_error_response(e)
+    finally:
+        chat_admission.leave()
+
+
+# --- STREAMING CHAT ROUTE (Server-Sent Events) ---
+@bp.route("/chat/stream", methods=["POST"])
+@login_required
+def chat_stream():
+    """
+    Streaming variant of /chat. Relays Gemini chunks to the browser as
+    Server-Sent Events so the first words show up as soon as they are generated.
+    The model reply is saved once the stream completes or is cut off.
+    """
+    response, chat_request = start_chat_turn(sse_replay)
+    if response is not None:
+        return response
+    session_id = chat_request.session_id
+
+    # Cache lookup first; if an identical request is already streaming elsewhere, wait for its reply
+    cached_text, claim = lookup_cached_reply(chat_request)
+    if cached_text is not None:
+        try:
+            save_turn(chat_request.turn(cached_text))
+        except Exception as e:
+            print(f"Database error while saving cached reply: {e}")
+            return jsonify({"response": f"An API error occurred: {e}"}), 500
+        return sse_replay(session_id, cached_text)
+
+    chat_admission = service('chat_admission')
+    if not chat_admission.enter():
+        claim.release()
+        return busy_response()
+
+    def finish():
+        # Runs after generate() is closed, even if the client left before the first chunk
+        chat_admission.leave()
+        claim.release()
+
+    try:
+        # Takes the quota budget now; the upstream request starts when generate() pulls the first chunk
+        response_stream = gemini_stream(chat_request.user_id, chat_request.history, chat_request.upstream_input)
+    except QuotaExceeded as e:
+        finish()
+        return quota_response(e)
+    except Exception as e:
+        finish()
+        return upstream_error_response(e)
+
+    def generate():
+        chunks = []
+        completed = False
+        try:
+            yield sse_event({"session_id": session_id}, event="start")
+            for chunk in timed_iteration(response_stream, 'upstream'):
+                clean_chunk = clean_model_text(chunk.text)
+                if not clean_chunk:
+                    continue
+                chunks.append(clean_chunk)
+                yield sse_event({"delta": clean_chunk})
+            completed = True
+            yield sse_event({"session_id": session_id}, event="done")
+        except GeneratorExit:
+            # Client went away mid-stream; fall through to persist what we have.
+            pass
+        except Exception as e:
+            error_str = str(e)
+            print(f"Streaming API Error: {error_str}")
+            yield sse_event({"response": quota_error_message(e) or f"An API error occurred: {error_str}"}, event="error")
+        finally:
+            # Persist the turn with its (possibly partial) model reply exactly once;
+            # a stream that failed before the first chunk leaves no trace, like /chat.
+            if chunks:
+                try:
+                    save_turn(chat_request.turn(''.join(chunks)))
+                except Exception as e:
+                    print(f"Database error while saving streamed reply: {e}")
+            # Only complete replies are cached
+            if completed and chunks:
+                claim.store(''.join(chunks))
+
+    response = Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+    response.call_on_close(finish)
+    return response
+
+
+# --- LOCAL RECOMMENDATIONS ROUTE ---
+@bp.route("/recommendations/similar", methods=["GET"])
+@login_required
+def similar_songs():
+    """Answers "more like X" from the local song index, without calling Gemini."""
+    query = request.args.get('q', '').strip()
+    song_index = service('song_index')
+    if not query or song_index is None:
+        return jsonify({'songs': []}), 200
+    song_index.refresh()
+    limit = min(max(request.args.get('limit', 10, type=int), 1), 50)
+    seed_ids, _ = resolve_seed_songs(query)
+    songs = song_index.describe(song_index.similar(seed_ids, k=limit))
+    return jsonify({
+        'songs': [{'title': title, 'artist': artist, 'year': year} for title, artist, year in songs]
+    }), 200
+
+
+# --- HISTORY EXPORT / IMPORT (NDJSON) ---
+@bp.route("/export", methods=["GET"])
+@login_required
+def export_history():
+    """
+    Streams all of the user's chats as NDJSON: a header line, then for each chat a "session"
+    line followed by its "message" lines, oldest first. History is read a page at a time and
+    archived chats straight from their compressed blobs, so memory use does not grow with it.
+    """
+    user_id, username = current_user.id, current_user.username
+    settle_pending_turns(user_id)
+
+    def generate():
+        yield ndjson_line({'type': 'export', 'version': EXPORT_VERSION, 'username': username,
+                           'exported_at': datetime.utcnow().isoformat()})
+        last_session_pk = 0
+        while True:
+            chat_sessions = ChatSession.query.filter(
+                ChatSession.user_id == user_id, ChatSession.id > last_session_pk
+            ).order_by(ChatSession.id).limit(100).all()
+            if not chat_sessions:
+                return
+            last_session_pk = chat_sessions[-1].id
+            for chat_session in chat_sessions:
+                session_id = chat_session.session_id
+                yield ndjson_line({
+                    'type': 'session', 'session_id': session_id, 'title': chat_session.title,
+                    'created_at': chat_session.created_at.isoformat(),
+                    'last_message_at': chat_session.last_message_at.isoformat(),
+                    'summary': chat_session.summary,
+                    'summary_through_at': chat_session.summary_through_at.isoformat()
+                    if chat_session.summary_through_at else None
+                })
+                if chat_session.archived_at is not None:
+                    archive = ArchivedSession.query.filter_by(user_id=user_id, session_id=session_id).first()
+                    for record in iter_archive(archive.payload if archive is not None else b''):
+                        if record['type'] == 'message':
+                            yield ndjson_line({'type': 'message', 'session_id': session_id, 'role': record['role'],
+                                               'content': record['content'], 'timestamp': record['timestamp']})
+                    db.session.expunge_all()
+
+                # Hot messages, keyset-paged on (timestamp, id)
+                cursor = None
+                while True:
+                    query = Message.query.filter_by(user_id=user_id, session_id=session_id)
+                    if cursor is not None:
+                        query = query.filter(or_(
+                            Message.timestamp > cursor[0],
+                            and_(Message.timestamp == cursor[0], Message.id > cursor[1])
+                        ))
+                    page = query.order_by(Message.timestamp, Message.id).limit(ARCHIVE_CHUNK_ROWS).all()
+                    for msg in page:
+                        yield ndjson_line({'type': 'message', 'session_id': session_id, 'role': msg.role,
+                                           'content': msg.content, 'timestamp': msg.timestamp.isoformat()})
+                    if len(page) < ARCHIVE_CHUNK_ROWS:
+                        break
+                    cursor = (page[-1].timestamp, page[-1].id)
+                    db.session.expunge_all()
+            db.session.expunge_all()
+
+    response = Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+    response.headers['Content-Disposition'] = f'attachment; filename="chat-history-{username}.ndjson"'
+    return response
+
+
+def read_ndjson(stream):
+    """Yields (line number, record) from a binary stream without reading it all into memory."""
+    line_number = 0
+    while True:
+        line = stream.readline(IMPORT_MAX_LINE_BYTES + 1)
+        if not line:
+            return
+        line_number += 1
+        if len(line) > IMPORT_MAX_LINE_BYTES:
+            raise ValueError(f"line {line_number} is longer than {IMPORT_MAX_LINE_BYTES} bytes")
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            raise ValueError(f"line {line_number} is not valid JSON")
+        if not isinstance(record, dict):
+            raise ValueError(f"line {line_number} is not a JSON object")
+        yield line_number, record
+
+
+def parse_import_time(value, line_number, field):
+    try:
+        return parse_utc_timestamp(value)
+    except (AttributeError, TypeError, ValueError):
+        raise ValueError(f"line {line_number}: {field} must be an ISO timestamp")
+
+
+@bp.route("/import", methods=["POST"])
+@login_required
+def import_history():
+    """
+    Restores chats from an /export file sent as the raw request body (application/x-ndjson),
+    read line by line and written in batches inside one transaction: either the whole file is
+    imported or nothing is. Chats whose session id the user already has are skipped.
+    """
+    user_id = current_user.id
+    settle_pending_turns(user_id)
+    imported_sessions, imported_messages, skipped_sessions = 0, 0, 0
+    current, current_count, current_last = None, 0, None   # chat being imported, None while skipping one
+    skipping, messages = False, []
+
+    def write_messages():
+        if messages:
+            db.session.execute(insert(Message), messages)
+            messages.clear()
+
+    def finish_session():
+        write_messages()
+        if current is not None:
+            ChatSession.query.filter_by(user_id=user_id, session_id=current).update(
+                {'message_count': current_count, 'last_message_at': current_last}, synchronize_session=False
+            )
+
+    try:
+        for line_number, record in read_ndjson(request.stream):
+            kind = record.get('type')
+            if kind == 'session':
+                finish_session()
+                session_id = record.get('session_id')
+                if not isinstance(session_id, str) or not 0 < len(session_id) <= 50:
+                    raise ValueError(f"line {line_number}: session_id must be 1-50 characters")
+                exists = db.session.query(ChatSession.id).filter_by(user_id=user_id, session_id=session_id).first() \
+                    or db.session.query(Message.id).filter_by(user_id=user_id, session_id=session_id).first()
+                skipping = exists is not None
+                if skipping:
+                    current = None
+                    skipped_sessions += 1
+                    continue
+                created_at = parse_import_time(record.get('created_at'), line_number, 'created_at')
+                current, current_count = session_id, 0
+                current_last = parse_import_time(record.get('last_message_at') or record.get('created_at'),
+                                                 line_number, 'last_message_at')
+                db.session.execute(insert(ChatSession).values(
+                    user_id=user_id, session_id=session_id, title=str(record.get('title') or 'New Chat')[:100],
+                    created_at=created_at, last_message_at=current_last, message_count=0,
+                    summary=record['summary'] if isinstance(record.get('summary'), str) else None,
+                    summary_through_at=parse_import_time(record['summary_through_at'], line_number, 'summary_through_at')
+                    if record.get('summary_through_at') else None
+                ))
+                imported_sessions += 1
+            elif kind == 'message':
+                if skipping:
+                    continue
+                if current is None or record.get('session_id') != current:
+                    raise ValueError(f"line {line_number}: message is not inside its session's block")
+                if record.get('role') not in ('user', 'model') or not isinstance(record.get('content'), str):
+                    raise ValueError(f"line {line_number}: role must be 'user' or 'model' and content a string")
+                timestamp = parse_import_time(record.get('timestamp'), line_number, 'timestamp')
+                messages.append({'user_id': user_id, 'session_id': current, 'role': record['role'],
+                                 'content': record['content'], 'timestamp': timestamp})
+                current_count += 1
+                current_last = max(current_last, timestamp)
+                imported_messages += 1
+                if len(messages) >= ARCHIVE_CHUNK_ROWS:
+                    write_messages()
+            elif kind == 'export':
+                if record.get('version') != EXPORT_VERSION:
+                    raise ValueError(f"line {line_number}: unsupported export version {record.get('version')!r}")
+            else:
+                raise ValueError(f"line {line_number}: unknown record type {kind!r}")
+        finish_session()
+        db.session.commit()
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+    return jsonify({
+        'success': True,
+        'sessions_imported': imported_sessions,
+        'messages_imported': imported_messages,
+        'sessions_skipped': skipped_sessions
+    }), 200
+
+
+# --- STATS ROUTE ---
+@bp.route("/stats", methods=["GET"])
+@login_required
+def stats():
+    """Reports shared cache counters (all workers on this host) and this worker's chat slots and login cache."""
+    def report(name):
+        instance = service(name)
+        return instance.stats() if instance is not None else None
+
+    return jsonify({
+        'response_cache': report('response_cache'),
+        'chat_admission': report('chat_admission'),
+        'scheduler': report('upstream_scheduler'),
+        'song_index': report('song_index'),
+        'user_cache': report('user_cache'),
+        'message_writer': report('message_writer')
+    }), 200
+
+
+@bp.route("/quota", methods=["GET"])
+@login_required
+def quota():
+    """Reports the Gemini budget left for the current user and for the whole app."""
+    return jsonify({'quota': service('upstream_scheduler').remaining(current_user.id)}), 200
+
+
+
+@bp.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    """Prometheus scrape endpoint: request latency, DB queries per request, spans, tokens and cache counters, all workers."""
+    metrics = service('metrics')
+    if metrics is None:
+        return jsonify({'message': 'Metrics are disabled.'}), 404
+    denied = ops_guard()
+    if denied:
+        return denied
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@bp.route("/debug/profile", methods=["GET"])
+def debug_profile():
+    """
+    Samples the other requests this worker serves for ?seconds=N (default 10, at most
+    PROFILER_MAX_SECONDS) and returns collapsed stacks ("frame;frame;frame count" lines) for
+    flamegraph.pl or speedscope. Needs threaded workers: a sync worker serves nothing else meanwhile.
+    """
+    profiler = service('profiler')
+    if profiler is None:
+        return jsonify({'message': 'Profiler is disabled.'}), 404
+    denied = ops_guard()
+    if denied:
+        return denied
+    if not request.environ.get('wsgi.multithread'):
+        return jsonify({'message': 'The profiler needs threaded workers (SERVING_MODE=async).'}), 409
+    seconds = min(max(request.args.get('seconds', 10, type=float), 0.1), current_app.config['PROFILER_MAX_SECONDS'])
+    samples, stacks = profiler.sample(seconds)
+    lines = [f'{stack} {count}' for stack, count in stacks.most_common()]
+    response = Response('\n'.join(lines) + '\n', mimetype='text/plain')
+    response.headers['X-Profile-Samples'] = str(samples)
+    response.headers['X-Profile-Worker'] = str(os.getpid())
+    return response
+
+# ----------------------------------------------------
+#               CLI COMMANDS
+# ----------------------------------------------------
+
+@bp.cli.command("init-db")
+def init_db():
+    """Creates any missing tables. Existing tables are left as they are: deploys run upgrade-db (start.sh does)."""
+    db.create_all()
+    print("Database tables are ready.")
+
+
+@bp.cli.command("upgrade-db")
+def upgrade_db():
+    """
+    Creates missing tables, and missing nullable columns and indexes on existing tables.
+    db.create_all() skips tables that already exist, so their new columns and indexes would never be built.
+    """
+    db.create_all()
+    inspector = inspect(db.engine)
+    preparer = db.engine.dialect.identifier_preparer
+    added_columns = []
+    created = []
+    for table in db.metadata.sorted_tables:
+        # New nullable columns on existing tables (create_all never ALTERs a table)
+        existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing_columns:
+                continue
+            if not column.nullable:
+                print(f"Skipping NOT NULL column {table.name}.{column.name}: add it manually.")
+                continue
+            column_type = column.type.compile(dialect=db.engine.dialect)
+            with db.engine.begin() as connection:
+                connection.exec_driver_sql(
+                    f"ALTER TABLE {preparer.quote(table.name)} ADD COLUMN {preparer.quote(column.name)} {column_type}"
+                )
+            added_columns.append(f"{table.name}.{column.name}")
+
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(bind=db.engine)
+                created.append(index.name)
+    print(f"Added {len(added_columns)} column(s): {', '.join(added_columns) or 'none'}")
+    print(f"Created {len(created)} index(es): {', '.join(created) or 'none'}")
+
+
+@bp.cli.command("compact-history")
+@click.option('--older-than-days', type=float, default=None,
+              help='Archive sessions idle for longer than this (default: ARCHIVE_AFTER_DAYS).')
+@click.option('--limit', type=int, default=None, help='Archive at most this many sessions.')
+@click.option('--samples', type=int, default=50, help='Hot sessions timed before and after, for the latency report.')
+def compact_history(older_than_days, limit, samples):
+    """
+    Moves idle sessions into ArchivedSession (run it from cron) and reports how much the
+    hot tables shrank and what that did to the hot-path query latency.
+    """
+    days = current_app.config['ARCHIVE_AFTER_DAYS'] if older_than_days is None else older_than_days
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    batch_size = current_app.config['ARCHIVE_BATCH_SIZE']
+
+    # Time sessions that stay hot, so both runs measure the same reads
+    sample = db.session.query(ChatSession.user_id, ChatSession.session_id).filter(
+        ChatSession.archived_at.is_(None), ChatSession.last_message_at >= cutoff
+    ).order_by(func.random()).limit(samples).all()
+    messages_before = db.session.query(func.count(Message.id)).scalar()
+    recommendations_before = db.session.query(func.count(Recommendation.id)).scalar()
+    latency_before = time_hot_queries(sample)
+
+    archived_sessions = archived_messages = raw_bytes = compressed_bytes = 0
+    started = time.perf_counter()
+    while limit is None or archived_sessions < limit:
+        size = batch_size if limit is None else min(batch_size, limit - archived_sessions)
+        candidates = ChatSession.query.filter(
+            ChatSession.archived_at.is_(None), ChatSession.last_message_at < cutoff
+        ).order_by(ChatSession.id).limit(size).all()
+        if not candidates:
+            break
+        for chat_session in candidates:
+            count, raw, compressed = archive_session(chat_session)
+            if count == 0:
+                # Nothing stored for it (or everything already archived): mark it so it is not picked again
+                chat_session.archived_at = datetime.utcnow()
+            archived_sessions += 1
+            archived_messages += count
+            raw_bytes += raw
+            compressed_bytes += compressed
+        db.session.commit()
+        db.session.expunge_all()
+    elapsed = time.perf_counter() - started
+
+    messages_after = db.session.query(func.count(Message.id)).scalar()
+    recommendations_after = db.session.query(func.count(Recommendation.id)).scalar()
+    latency_after = time_hot_queries(sample)
+
+    def shrink(before, after):
+        return f"{before} -> {after} ({(after - before) / before:+.1%})" if before else f"{before} -> {after}"
+
+    print(f"Archived {archived_sessions} session(s) idle since before {cutoff:%Y-%m-%d} in {elapsed:.1f}s: "
+          f"{archived_messages} message(s), {raw_bytes / 1024:.0f} KiB -> {compressed_bytes / 1024:.0f} KiB compressed")
+    print(f"Hot message rows:        {shrink(messages_before, messages_after)}")
+    print(f"Hot recommendation rows: {shrink(recommendations_before, recommendations_after)}")
+    print(f"Hot-path query latency, median over {len(sample)} hot session(s) (ms, before -> after):")
+    for name in latency_before:
+        print(f"  {name:24s} {latency_before[name]:8.3f} -> {latency_after[name]:8.3f}")
+
+
+@bp.cli.command("extract-recommendations")
+def extract_recommendations():
+    """Parses Song/Artist/Recommendation rows out of model replies saved before extraction existed."""
+    processed = set(message_id for (message_id,) in db.session.query(Recommendation.message_id).distinct())
+    messages = Message.query.order_by(Message.user_id, Message.session_id, Message.timestamp).yield_per(500)
+
+    previous_user_input, extracted, pending = {}, 0, []
+    for msg in messages:
+        key = (msg.user_id, msg.session_id)
+        if msg.role == 'user':
+            previous_user_input[key] = msg.content
+        elif msg.id not in processed:
+            pending.append((msg.id, previous_user_input.get(key, '')))
+
+    # Extract after the scan: writing mid-iteration would flush the session under yield_per
+    for count, (message_id, user_input) in enumerate(pending, start=1):
+        extracted += len(record_recommendations(db.session.get(Message, message_id), user_input))
+        if count % 200 == 0:
+            db.session.commit()
+    db.session.commit()
+    print(f"Extracted {extracted} recommendation(s) from {len(pending)} reply(ies).")
+
+
+@bp.cli.command("backfill-chat-sessions")
+def backfill_chat_sessions():
+    """
+    Builds ChatSession rows for conversations stored before the table existed, and repairs
+    rows a later turn created for them (that turn's question as title, counted from zero).
+    Safe to run on every deploy: rows that already match their messages are left alone.
+    """
+    first_and_last = db.session.query(
+        Message.user_id,
+        Message.session_id,
+        func.min(Message.timestamp).label('first_timestamp'),
+        func.max(Message.timestamp).label('latest_timestamp'),
+        func.count(Message.id).label('message_count')
+    ).group_by(Message.user_id, Message.session_id).subquery()
+
+    # Join back to the first message of each session to pick up its title in the same query
+    rows = db.session.query(
+        first_and_last.c.user_id,
+        first_and_last.c.session_id,
+        first_and_last.c.first_timestamp,
+        first_and_last.c.latest_timestamp,
+        first_and_last.c.message_count,
+        func.min(Message.content)
+    ).join(
+        Message,
+        (Message.user_id == first_and_last.c.user_id)
+        & (Message.session_id == first_and_last.c.session_id)
+        & (Message.timestamp == first_and_last.c.first_timestamp)
+    ).group_by(
+        first_and_last.c.user_id,
+        first_and_last.c.session_id,
+        first_and_last.c.first_timestamp,
+        first_and_last.c.latest_timestamp,
+        first_and_last.c.message_count
+    ).all()
+
+    existing = {(row.user_id, row.session_id): row for row in ChatSession.query}
+    created, repaired = 0, 0
+    for user_id, session_id, first_timestamp, latest_timestamp, message_count, title in rows:
+        chat_session = existing.get((user_id, session_id))
+        if chat_session is not None:
+            if chat_session.archived_at is None and repair_chat_session(
+                    chat_session, title, first_timestamp, latest_timestamp, message_count):
+                repaired += 1
+            continue
+        db.session.add(ChatSession(
+            user_id=user_id,
+            session_id=session_id,
+            title=(title or 'New Chat')[:100],
+            created_at=first_timestamp,
+            last_message_at=latest_timestamp,
+            message_count=message_count
+        ))
+        created += 1
+        if created % 500 == 0:
+            db.session.flush()
+
+    db.session.commit()
+    print(f"Backfilled {created} chat session(s), repaired {repaired}.")
+
+
+def repair_chat_session(chat_session, title, first_timestamp, latest_timestamp, message_count):
+    """Brings an existing ChatSession in line with its messages; returns whether anything changed."""
+    changed = False
+    # Created after its first message: the row was made by a later turn of an older chat
+    if chat_session.created_at is None or chat_session.created_at > first_timestamp:
+        chat_session.title = (title or 'New Chat')[:100]
+        chat_session.created_at = first_timestamp
+        changed = True
+    if chat_session.last_message_at is None or chat_session.last_message_at < latest_timestamp:
+        chat_session.last_message_at = latest_timestamp
+        changed = True
+    if chat_session.message_count != message_count:
+        chat_session.message_count = message_count
+        changed = True
+    return changed
+
+
+# ----------------------------------------------------
+#               APP FACTORY
+# ----------------------------------------------------
+
+def init_services(app):
+    """
+    Builds the app's caches, queues and limiters from app.config and keeps them in
+    app.extensions['services'], where the routes find them with service(name). Every
+    create_app() call therefore gets its own set, and apps built side by side (tests,
+    a CLI with overrides) never share or replace each other's.
+
+    Nothing here may start a thread or open a connection: with gunicorn --preload this runs
+    in the master, and threads do not survive fork() while inherited sockets would be shared
+    by every worker. So the metrics flusher, the write-behind writer, the asyncio loop of
+    AsyncBridge, SharedStore's SQLite connections (and the tables the cache, scheduler and
+    metrics declare on it) and the Gemini client are all created on first use, which happens
+    in the worker.
+    """
+    config = app.config
+
+    user_cache = None
+    if config['USER_CACHE_TTL'] > 0 and config['USER_CACHE_MAX_ENTRIES'] > 0:
+        user_cache = UserCache(config['USER_CACHE_TTL'], config['USER_CACHE_MAX_ENTRIES'])
+
+    shared_store = SharedStore(config['SHARED_STORE_PATH'])
+    response_cache = ResponseCache(
+        shared_store,
+        ttl=config['RESPONSE_CACHE_TTL'],
+        max_entries=config['RESPONSE_CACHE_MAX_ENTRIES'],
+        wait_timeout=config['RESPONSE_CACHE_WAIT_TIMEOUT']
+    ) if config['RESPONSE_CACHE_ENABLED'] else None
+
+    upstream_scheduler = UpstreamScheduler(
+        shared_store,
+        limits={
+            'global_rpm': config['GEMINI_GLOBAL_RPM'],
+            'global_tpm': config['GEMINI_GLOBAL_TPM'],
+            'user_rpm': config['GEMINI_USER_RPM'],
+            'user_tpm': config['GEMINI_USER_TPM'],
+        },
+        max_wait=config['GEMINI_SCHEDULER_MAX_WAIT'],
+        short_request_tokens=config['GEMINI_SHORT_REQUEST_TOKENS'],
+        short_reserve=config['GEMINI_SHORT_RESERVE'],
+        output_tokens=GEMINI_MAX_OUTPUT_TOKENS,
+        max_retries=config['GEMINI_MAX_RETRIES'],
+        backoff_base=config['GEMINI_BACKOFF_BASE'],
+        backoff_cap=config['GEMINI_BACKOFF_CAP']
+    )
+    chat_admission = ChatAdmission(config['MAX_INFLIGHT_CHATS'], config['MAX_QUEUED_CHATS'], config['CHAT_QUEUE_TIMEOUT'])
+
+    song_index = SongIndex(
+        config['RECOMMENDER_REFRESH_SECONDS'],
+        config['RECOMMENDER_REBUILD_SECONDS'],
+        config['RECOMMENDER_MIN_SUPPORT']
+    ) if config['LOCAL_RECOMMENDER_ENABLED'] else None
+
+    message_writer = None
+    if config['MESSAGE_WRITE_MODE'] == 'write_behind':
+        message_writer = MessageWriter(
+            app, config['MESSAGE_BATCH_SIZE'], config['MESSAGE_FLUSH_INTERVAL'], config['MESSAGE_MAX_QUEUED']
+        )
+        atexit.register(message_writer.flush)
+
+    profiler = SamplingProfiler(config['PROFILER_INTERVAL']) if config['PROFILER_ENABLED'] else None
+    metrics = Metrics(shared_store, config['METRICS_FLUSH_INTERVAL']) if config['METRICS_ENABLED'] else None
+    if metrics is not None:
+        metrics.add_source('app_chat_admission', chat_admission.stats, counters=('rejected',), gauges=('inflight', 'waiting'))
+        if user_cache is not None:
+            metrics.add_source('app_user_cache', user_cache.stats, counters=('hits', 'misses', 'invalidations'),
+                               gauges=('entries',))
+        if message_writer is not None:
+            metrics.add_source('app_message_writer', message_writer.stats,
+                               counters=('turns_written', 'batches', 'failed_turns'), gauges=('queued',))
+        atexit.register(metrics.flush)
+
+    app.extensions['services'] = {
+        'user_cache': user_cache,
+        'shared_store': shared_store,
+        'response_cache': response_cache,
+        'upstream_scheduler': upstream_scheduler,
+        'async_bridge': AsyncBridge(),
+        'chat_admission': chat_admission,
+        'song_index': song_index,
+        'message_writer': message_writer,
+        'profiler': profiler,
+        'metrics': metrics,
+        'gemini_client': None,   # built by get_gemini() on first use
+        'gemini_config': None,
+    }
+
+
+def create_app(config=None):
+    """
+    Builds the Flask app: settings from the environment (overridden by `config`), extensions,
+    per-process services and the routes. The schema is not created here; run "flask upgrade-db".
+    """
+    app = Flask(__name__)
+    load_config(app)
+    if config:
+        app.config.update(config)
+
+    db.init_app(app)
+    bcrypt.init_app(app)
+    login_manager.init_app(app)
+    init_services(app)
+    if app.extensions['services']['metrics'] is not None:
+        app.json = TimedJSONProvider(app)
+    app.register_blueprint(bp)
+    return app
 
-    except Exception as e:
-        # 7. If any API or database error occurs, rollback the user message
-        db.session.rollback()
-        
-        error_str = str(e)
-        if "429 RESOURCE_EXHAUSTED" in error_str:
-            error_message = "🤖 Error: Daily quota limit reached! Please upgrade your plan or wait until tomorrow."
-            return jsonify({"response": error_message}), 429
-        
-        print(f"General API Error: {error_str}")
-        return jsonify({"response": f"An API error occurred: {error_str}"}), 500
 
-with app.app_context():
-    db.create_all() 
+# The instance gunicorn serves ('Project System.app:app') and the flask CLI finds
+app = create_app()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,220 @@
+"""
+Local stand-in for the Gemini API, for load tests that must not spend real quota.
+
+Serves generateContent and streamGenerateContent (alt=sse) with configurable latency,
+and can answer with a scripted sequence of HTTP statuses (e.g. 429s) before succeeding,
+a random share of 429s, or 429s past a requests-per-minute quota like the real API.
+Point the app at it with GEMINI_BASE_URL:
+
+    python bench/fake_gemini.py --port 8089 --latency 1.5
+    python bench/fake_gemini.py --script 429,429,503   # first three calls fail, then 200s
+    python bench/fake_gemini.py --error-rate 0.05      # 5% of calls get a 429
+    python bench/fake_gemini.py --rpm 60               # 429 once 60 calls were made this minute
+    GEMINI_BASE_URL=http://127.0.0.1:8089 GEMINI_API_KEY=fake ./start.sh
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROUTE_PATTERN = re.compile(r'^/[^/]+/models/(?P<model>[^/:]+):(?P<method>generateContent|streamGenerateContent)')
+
+REPLY_TEMPLATE = (
+    "Here are some OPM picks for you!<br><br>"
+    "1. Buwan - Juan Karlos (2018). A slow-burning anthem for late nights.<br>"
+    "2. Kathang Isip - Ben&Ben (2017). Soft folk-pop for quiet moments.<br>"
+    "3. Tadhana - Up Dharma Down (2012). Dreamy and timeless.<br>"
+    "4. Hey Barbara - IV of Spades (2019). Groovy retro vibes.<br>"
+    "5. Mundo - IV of Spades (2019). A warm, swaying ballad.<br>"
+    "<br>Want more songs like these?"
+)
+
+
+ERROR_STATUSES = {
+    429: ('RESOURCE_EXHAUSTED', 'Resource has been exhausted (e.g. check quota).'),
+    500: ('INTERNAL', 'An internal error has occurred.'),
+    503: ('UNAVAILABLE', 'The model is overloaded. Please try again later.'),
+}
+
+
+class FakeGeminiState:
+    """Settings and counters shared by all handler threads."""
+
+    def __init__(self, latency, first_token_latency, chunks, script=None, error_rate=0.0, rpm=0, jitter=0.0):
+        self.latency = latency
+        self.first_token_latency = first_token_latency
+        self.chunks = chunks
+        # Statuses returned by the next calls, in order; 200 once exhausted
+        self.script = list(script or [])
+        # Share of unscripted calls answered with a 429
+        self.error_rate = error_rate
+        # Calls allowed per wall-clock minute before 429s (0 = unlimited)
+        self.rpm = rpm
+        # Latencies vary uniformly by +/- this fraction
+        self.jitter = jitter
+        self.minute = None
+        self.minute_calls = 0
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.inflight = 0
+        self.peak_inflight = 0
+        self.statuses = {}
+
+    def next_status(self):
+        with self.lock:
+            if self.script:
+                status = self.script.pop(0)
+            elif self.error_rate and random.random() < self.error_rate:
+                status = 429
+            else:
+                status = 200
+            if status == 200 and self.rpm:
+                minute = int(time.time() // 60)
+                if minute != self.minute:
+                    self.minute, self.minute_calls = minute, 0
+                self.minute_calls += 1
+                if self.minute_calls > self.rpm:
+                    status = 429
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+            return status
+
+    def delay(self, seconds):
+        """Sleeps for `seconds`, spread by the configured jitter."""
+        if self.jitter:
+            seconds *= random.uniform(1 - self.jitter, 1 + self.jitter)
+        time.sleep(max(seconds, 0))
+
+    def enter(self):
+        with self.lock:
+            self.requests += 1
+            self.inflight += 1
+            self.peak_inflight = max(self.peak_inflight, self.inflight)
+
+    def leave(self):
+        with self.lock:
+            self.inflight -= 1
+
+
+def response_body(text, prompt_chars, final=True):
+    """A GenerateContentResponse payload in the REST API's JSON shape."""
+    candidate = {'content': {'role': 'model', 'parts': [{'text': text}]}, 'index': 0}
+    if final:
+        candidate['finishReason'] = 'STOP'
+    prompt_tokens = max(prompt_chars // 4, 1)
+    output_tokens = max(len(text) // 4, 1)
+    return {
+        'candidates': [candidate],
+        'usageMetadata': {
+            'promptTokenCount': prompt_tokens,
+            'candidatesTokenCount': output_tokens,
+            'totalTokenCount': prompt_tokens + output_tokens
+        },
+        'modelVersion': 'fake-gemini'
+    }
+
+
+class FakeGeminiHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    state = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.startswith('/stats'):
+            state = self.state
+            return self.send_json(200, {
+                'requests': state.requests, 'inflight': state.inflight, 'peak_inflight': state.peak_inflight,
+                'statuses': state.statuses
+            })
+        self.send_json(404, {'error': {'code': 404, 'message': 'Not found', 'status': 'NOT_FOUND'}})
+
+    def do_POST(self):
+        match = ROUTE_PATTERN.match(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        request_body = self.rfile.read(length)
+        if not match:
+            return self.send_json(404, {'error': {'code': 404, 'message': 'Not found', 'status': 'NOT_FOUND'}})
+
+        self.state.enter()
+        try:
+            status = self.state.next_status()
+            if status != 200:
+                error_status, message = ERROR_STATUSES.get(status, ('UNKNOWN', 'Scripted failure.'))
+                return self.send_json(status, {'error': {'code': status, 'message': message, 'status': error_status}})
+            if match.group('method') == 'streamGenerateContent':
+                self.stream_reply(len(request_body))
+            else:
+                self.state.delay(self.state.latency)
+                self.send_json(200, response_body(REPLY_TEMPLATE, len(request_body)))
+        finally:
+            self.state.leave()
+
+    def stream_reply(self, prompt_chars):
+        state = self.state
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        state.delay(state.first_token_latency)
+        size = -(-len(REPLY_TEMPLATE) // state.chunks)
+        pieces = [REPLY_TEMPLATE[i:i + size] for i in range(0, len(REPLY_TEMPLATE), size)]
+        gap = max(state.latency - state.first_token_latency, 0) / max(len(pieces) - 1, 1)
+        for index, piece in enumerate(pieces):
+            if index:
+                state.delay(gap)
+            event = f"data: {json.dumps(response_body(piece, prompt_chars, final=index == len(pieces) - 1))}\r\n\r\n"
+            data = event.encode('utf-8')
+            self.wfile.write(f"{len(data):X}\r\n".encode('ascii') + data + b"\r\n")
+            self.wfile.flush()
+        self.wfile.write(b"0\r\n\r\n")
+
+
+def serve(host, port, state):
+    handler = type('Handler', (FakeGeminiHandler,), {'state': state})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.request_queue_size = 1024
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--latency', type=float, default=1.0, help='seconds until the full reply is sent')
+    parser.add_argument('--first-token-latency', type=float, default=0.3, help='seconds until the first streamed chunk')
+    parser.add_argument('--chunks', type=int, default=8, help='number of streamed chunks per reply')
+    parser.add_argument('--script', default='', help='comma-separated statuses for the first calls, e.g. 429,429,503')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of calls answered with a 429')
+    parser.add_argument('--rpm', type=int, default=0, help='calls per minute before 429s (0 = unlimited)')
+    parser.add_argument('--jitter', type=float, default=0.0, help='latency spread, e.g. 0.3 for +/-30%%')
+    args = parser.parse_args()
+
+    script = [int(status) for status in args.script.split(',') if status.strip()]
+    state = FakeGeminiState(
+        args.latency, args.first_token_latency, args.chunks, script,
+        error_rate=args.error_rate, rpm=args.rpm, jitter=args.jitter
+    )
+    server = serve(args.host, args.port, state)
+    print(f"Fake Gemini listening on http://{args.host}:{args.port} (latency {args.latency}s)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""
+Concurrent chat load test against a running instance backed by bench/fake_gemini.py.
+
+Fires --concurrency simultaneous /chat requests (unique prompts, so the response cache
+does not absorb them) while a side thread keeps calling /get_chat_list, then reports
+chat latency, sidebar latency during the burst, status codes and the fake server's
+peak number of simultaneous upstream calls.
+
+    python bench/fake_gemini.py --latency 2 &
+    SERVING_MODE=async GEMINI_BASE_URL=http://127.0.0.1:8089 GEMINI_API_KEY=fake PORT=5000 ./start.sh &
+    python bench/load_chat.py --base-url http://127.0.0.1:5000 --concurrency 300
+"""
+import argparse
+import statistics
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def logged_in_session(base_url, index):
+    """Registers (if needed) and logs in a load-test user; returns its cookie session."""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=4)
+    session.mount('http://', adapter)
+    username = f'load{index}'
+    session.post(f'{base_url}/register', json={
+        'name': f'Load {index}', 'username': username, 'email': f'{username}@example.com',
+        'password': 'load-test', 'age': 21, 'birthday': '2000-01-01'
+    })
+    response = session.post(f'{base_url}/login', json={'username': username, 'password': 'load-test'})
+    response.raise_for_status()
+    return session
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--base-url', default='http://127.0.0.1:5000')
+    parser.add_argument('--fake-url', default='http://127.0.0.1:8089', help='fake Gemini server, for its stats')
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--endpoint', default='/chat', choices=['/chat', '/chat/stream'])
+    args = parser.parse_args()
+
+    print(f'Logging in {args.users} users ...')
+    with ThreadPoolExecutor(max_workers=min(args.users, 32)) as pool:
+        sessions = list(pool.map(lambda index: logged_in_session(args.base_url, index), range(args.users)))
+
+    statuses = Counter()
+    chat_latencies = []
+    sidebar_latencies = []
+    lock = threading.Lock()
+    burst_done = threading.Event()
+
+    def one_chat(index):
+        session = sessions[index % len(sessions)]
+        started = time.perf_counter()
+        response = session.post(f'{args.base_url}{args.endpoint}', json={
+            'message': f'Recommend OPM songs like Buwan ({uuid.uuid4().hex[:8]})',
+            'session_id': f'load-{index}'
+        }, stream=args.endpoint == '/chat/stream')
+        body = response.content
+        elapsed = time.perf_counter() - started
+        with lock:
+            statuses[response.status_code] += 1
+            if response.status_code == 200 and body:
+                chat_latencies.append(elapsed)
+
+    def poll_sidebar():
+        session = sessions[0]
+        while not burst_done.is_set():
+            started = time.perf_counter()
+            session.get(f'{args.base_url}/get_chat_list')
+            sidebar_latencies.append(time.perf_counter() - started)
+            time.sleep(0.05)
+
+    poller = threading.Thread(target=poll_sidebar, daemon=True)
+    poller.start()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(one_chat, range(args.concurrency)))
+    wall = time.perf_counter() - started
+    burst_done.set()
+    poller.join()
+
+    print(f'\n{args.concurrency} concurrent {args.endpoint} requests in {wall:.2f}s '
+          f'({len(chat_latencies) / wall:.1f} successful chats/s)')
+    print('Status codes:', dict(statuses))
+    if chat_latencies:
+        print(f'Chat latency    p50 {statistics.median(chat_latencies):.2f}s  '
+              f'p95 {percentile(chat_latencies, 0.95):.2f}s  max {max(chat_latencies):.2f}s')
+    if sidebar_latencies:
+        print(f'Sidebar latency p50 {statistics.median(sidebar_latencies) * 1000:.0f}ms  '
+              f'p95 {percentile(sidebar_latencies, 0.95) * 1000:.0f}ms during the burst')
+    try:
+        print('Fake Gemini:', requests.get(f'{args.fake_url}/stats', timeout=2).json())
+    except requests.RequestException:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""
+Checks that a chat turn is saved whole or not at all, on the scratch SQLite database that
+pysqlite drives (it issues no BEGIN before a SAVEPOINT, so a savepoint opened as the first
+write of a transaction is committed by its RELEASE).
+
+Runs in-process and checks that:
+  - a ChatSession created by get_or_create is gone after a rollback
+  - a failing insert late in persist_turns leaves no ChatSession, Message or Artist rows
+  - get_or_create and get_or_create_all keep the existing rows when they lost the insert race
+  - the next turn of the same chat is saved normally
+
+    python bench/persistence_check.py
+"""
+import os
+import sys
+import tempfile
+from datetime import datetime
+from unittest import mock
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+scratch = tempfile.mkdtemp()
+os.environ.update({
+    'DATABASE_URL': 'sqlite:///' + os.path.join(scratch, 'persistence.db'),
+    'SHARED_STORE_PATH': os.path.join(scratch, 'shared_store.sqlite3'),
+    'GEMINI_API_KEY': 'fake',
+    'MESSAGE_WRITE_MODE': 'sync',
+})
+
+import app as application  # noqa: E402
+from app import Artist, ChatSession, ChatTurn, Message, User, db  # noqa: E402
+
+failures = []
+
+REPLY = "1. Buwan - Juan Karlos (2017). A slow-burning love song."
+
+
+def check(name, condition):
+    print(f"{'PASS' if condition else 'FAIL'}  {name}")
+    if not condition:
+        failures.append(name)
+
+
+def counts(user_id, session_id):
+    return (
+        ChatSession.query.filter_by(user_id=user_id, session_id=session_id).count(),
+        Message.query.filter_by(user_id=user_id, session_id=session_id).count(),
+        Artist.query.count()
+    )
+
+
+def main():
+    flask_app = application.app
+    with flask_app.app_context():
+        db.create_all()
+        user = User(name='Check', username='persist', email='persist@example.com', password='x',
+                    age=21, birthday=datetime(2000, 1, 1).date())
+        db.session.add(user)
+        db.session.commit()
+        user_id = user.id
+
+        application.get_or_create(ChatSession, {'user_id': user_id, 'session_id': 'rolled-back'}, {'title': 'Gone'})
+        db.session.rollback()
+        check('get_or_create row is undone by a rollback',
+              ChatSession.query.filter_by(user_id=user_id, session_id='rolled-back').count() == 0)
+
+        turn = ChatTurn(user_id, 'failing', 'Songs like Buwan', REPLY, datetime.utcnow())
+        with mock.patch.object(application, 'insert', side_effect=RuntimeError('recommendation insert failed')):
+            try:
+                application.persist_turns([turn])
+                check('failing insert raises from persist_turns', False)
+            except RuntimeError:
+                check('failing insert raises from persist_turns', True)
+        check('failed turn leaves no ChatSession, Message or Artist rows', counts(user_id, 'failing') == (0, 0, 0))
+        # What the end of the request does: forget the rows loaded inside the failed turn
+        db.session.remove()
+
+        db.session.add(ChatSession(user_id=user_id, session_id='raced', title='First'))
+        db.session.commit()
+        # The insert a request makes after losing the race to a concurrent one
+        application.insert_ignoring_conflicts(ChatSession, [{'user_id': user_id, 'session_id': 'raced', 'title': 'Second'}])
+        raced = ChatSession.query.filter_by(user_id=user_id, session_id='raced').one()
+        check('get_or_create keeps the row that won the race', raced.title == 'First')
+        artists = application.get_or_create_all(
+            Artist, Artist.name_key.in_(['first artist']), lambda artist: artist.name_key,
+            {'first artist': {'name': 'First Artist', 'name_key': 'first artist'}})
+        application.insert_ignoring_conflicts(Artist, [{'name': 'Other Spelling', 'name_key': 'first artist'}])
+        again = application.get_or_create_all(
+            Artist, Artist.name_key.in_(['first artist']), lambda artist: artist.name_key,
+            {'first artist': {'name': 'First Artist', 'name_key': 'first artist'}})
+        check('get_or_create_all skips rows that already exist',
+              again['first artist'].id == artists['first artist'].id and again['first artist'].name == 'First Artist')
+        db.session.rollback()
+        db.session.remove()
+
+        application.persist_turns([ChatTurn(user_id, 'failing', 'Songs like Buwan', REPLY, datetime.utcnow())])
+        chat_session = ChatSession.query.filter_by(user_id=user_id, session_id='failing').one()
+        check('retried turn is saved with its counters',
+              chat_session.message_count == 2 and counts(user_id, 'failing')[:2] == (1, 2))
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
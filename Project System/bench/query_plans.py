@@ -0,0 +1,135 @@
+"""
+Query-plan and latency benchmark for the Message table hot paths.
+
+Seeds N users x M messages into a scratch database, then runs the queries behind
+chat() history load, load_session(), delete_chat() and get_chat_list() twice:
+once with the Message indexes dropped ("before") and once with them built ("after").
+
+Usage (from the "Project System" folder):
+    python bench/query_plans.py --users 200 --sessions 20 --messages 20
+    DATABASE_URL=postgresql://... python bench/query_plans.py --reset --keep-data
+
+Without DATABASE_URL it uses a scratch SQLite file. Any other database is dropped and
+recreated, so the script refuses to touch one unless --reset is given.
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+SCRATCH_DATABASE = not os.environ.get('DATABASE_URL')
+if SCRATCH_DATABASE:
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'query_plans.db')
+
+from sqlalchemy import func, text  # noqa: E402
+
+from app import app, db, Message, ChatSession  # noqa: E402
+from seed import seed_database  # noqa: E402
+
+
+def hot_path_queries(user_id, session_id):
+    """The statements each route issues, keyed by route name."""
+    history = Message.query.filter_by(user_id=user_id, session_id=session_id).order_by(Message.timestamp.asc())
+    return {
+        'chat (history load)': history,
+        'load_session': Message.query.filter_by(user_id=user_id, session_id=session_id).order_by(
+            Message.timestamp.desc(), Message.id.desc()
+        ).limit(51),
+        'delete_chat': Message.query.filter_by(user_id=user_id, session_id=session_id),
+        'get_chat_list': ChatSession.query.filter_by(user_id=user_id).order_by(
+            ChatSession.last_message_at.desc(), ChatSession.id.desc()
+        ).limit(51),
+        'per-user session aggregate': db.session.query(
+            Message.session_id, func.min(Message.timestamp), func.max(Message.timestamp)
+        ).filter(Message.user_id == user_id).group_by(Message.session_id),
+    }
+
+
+def explain(query):
+    """Returns the database's query plan for a SQLAlchemy query as text."""
+    sql = str(query.statement.compile(db.engine, compile_kwargs={'literal_binds': True}))
+    if db.engine.dialect.name == 'sqlite':
+        rows = db.session.execute(text('EXPLAIN QUERY PLAN ' + sql)).all()
+        return '\n'.join(str(row[-1]) for row in rows)
+    rows = db.session.execute(text('EXPLAIN ANALYZE ' + sql)).all()
+    return '\n'.join(str(row[0]) for row in rows)
+
+
+def run_phase(label, samples, chats):
+    print(f'\n===== {label} =====')
+    timings = {}
+    plans = {}
+    for _ in range(samples):
+        user_id, session_id = random.choice(chats)
+        for route, query in hot_path_queries(user_id, session_id).items():
+            plans.setdefault(route, explain(query))
+            start = time.perf_counter()
+            if route == 'delete_chat':
+                query.delete(synchronize_session=False)
+                db.session.rollback()
+            else:
+                query.all()
+            timings.setdefault(route, []).append((time.perf_counter() - start) * 1000)
+
+    for route, values in timings.items():
+        values.sort()
+        p95 = values[int(len(values) * 0.95) - 1] if len(values) > 1 else values[0]
+        print(f'\n-- {route}: p50 {statistics.median(values):.2f} ms, p95 {p95:.2f} ms')
+        print('   ' + plans[route].replace('\n', '\n   '))
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--sessions', type=int, default=20, help='sessions per user')
+    parser.add_argument('--messages', type=int, default=20, help='messages per session')
+    parser.add_argument('--samples', type=int, default=50, help='random (user, session) lookups per phase')
+    parser.add_argument('--keep-data', action='store_true', help='do not drop the seeded tables afterwards')
+    parser.add_argument('--reset', action='store_true',
+                        help='allow dropping every table in the DATABASE_URL database (not needed for the scratch file)')
+    args = parser.parse_args()
+    if not SCRATCH_DATABASE and not args.reset:
+        parser.error('this drops and recreates every table in DATABASE_URL; pass --reset to confirm')
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        print(f'Seeding {args.users} users x {args.sessions * args.messages} messages '
+              f'into {db.engine.url.render_as_string(hide_password=True)} ...')
+        seed_database(args.users, args.sessions, args.messages)
+
+        chats = db.session.query(ChatSession.user_id, ChatSession.session_id).all()
+        message_indexes = list(Message.__table__.indexes)
+        # End the session's transaction so it sees the schema change (SQLite keeps a snapshot otherwise)
+        db.session.remove()
+        for index in message_indexes:
+            index.drop(bind=db.engine, checkfirst=True)
+        before = run_phase('BEFORE (no Message indexes)', args.samples, chats)
+
+        db.session.remove()
+        for index in message_indexes:
+            index.create(bind=db.engine, checkfirst=True)
+        if db.engine.dialect.name == 'postgresql':
+            db.session.execute(text('ANALYZE message'))
+            db.session.commit()
+        after = run_phase('AFTER (composite indexes)', args.samples, chats)
+
+        print('\n===== SPEEDUP (p50 before / after) =====')
+        for route in before:
+            ratio = statistics.median(before[route]) / max(statistics.median(after[route]), 1e-6)
+            print(f'{route:30s} {ratio:8.1f}x')
+
+        if not args.keep_data:
+            db.drop_all()
+
+
+if __name__ == '__main__':
+    main()
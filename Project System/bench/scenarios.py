@@ -0,0 +1,293 @@
+"""
+Scripted load scenarios against a running instance, with per-route latency percentiles
+written to a JSON results file that later runs can be compared against.
+
+Scenarios:
+  login_storm        many users logging in at once (bcrypt-bound)
+  sidebar_refresh    /get_chat_list polling: full loads, If-None-Match revalidations and since= deltas
+  long_session_chat  chats in each user's long seeded session, each followed by a /load_session page
+  preset_burst       everyone presses the same preset button at once (response cache and local recommender)
+
+Typical run (from the "Project System" folder):
+    DATABASE_URL=sqlite:////tmp/bench.db python bench/seed.py --reset --users 200 --recommendations
+    python bench/fake_gemini.py --latency 1.5 --jitter 0.3 --error-rate 0.02 &
+    DATABASE_URL=sqlite:////tmp/bench.db GEMINI_BASE_URL=http://127.0.0.1:8089 GEMINI_API_KEY=fake \\
+        PORT=5000 SERVING_MODE=async ./start.sh &
+    python bench/scenarios.py --output bench/results/baseline.json
+    ... change something, restart ...
+    python bench/scenarios.py --output bench/results/candidate.json --compare bench/results/baseline.json
+
+With --compare the script exits 1 if any route's p95 or a scenario's throughput
+regressed by more than --tolerance (default 20%).
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from load_chat import percentile  # noqa: E402
+
+BENCH_PASSWORD = 'bench-password'
+PRESETS = ["Chill", "Hugot", "Party", "Workout"]
+SCENARIOS = ['login_storm', 'sidebar_refresh', 'long_session_chat', 'preset_burst']
+
+
+class Recorder:
+    """Collects (route, status, latency) samples from every load thread."""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(Counter)
+        self.lock = threading.Lock()
+
+    def timed(self, route, call):
+        started = time.perf_counter()
+        response = None
+        try:
+            response = call()
+            response.content  # include the body download (streams and large pages)
+            status = response.status_code
+        except requests.RequestException:
+            status = 'error'
+        elapsed = time.perf_counter() - started
+        with self.lock:
+            self.latencies[route].append(elapsed)
+            self.statuses[route][status] += 1
+        return response
+
+    def summary(self, wall):
+        routes = {}
+        for route, values in sorted(self.latencies.items()):
+            statuses = self.statuses[route]
+            errors = sum(count for status, count in statuses.items() if status == 'error' or status >= 500)
+            routes[route] = {
+                'count': len(values),
+                'errors': errors,
+                'statuses': {str(status): count for status, count in statuses.items()},
+                'rps': round(len(values) / wall, 2) if wall else 0.0,
+                'mean_ms': round(statistics.mean(values) * 1000, 2),
+                'p50_ms': round(percentile(values, 0.50) * 1000, 2),
+                'p95_ms': round(percentile(values, 0.95) * 1000, 2),
+                'p99_ms': round(percentile(values, 0.99) * 1000, 2),
+            }
+        total = sum(len(values) for values in self.latencies.values())
+        return {
+            'wall_seconds': round(wall, 3),
+            'requests': total,
+            'throughput_rps': round(total / wall, 2) if wall else 0.0,
+            'routes': routes
+        }
+
+
+def new_session(pool_size=4):
+    session = requests.Session()
+    session.mount('http://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+    return session
+
+
+def log_in(base_url, user_number, password):
+    session = new_session()
+    response = session.post(f'{base_url}/login', json={'username': f'bench{user_number}', 'password': password})
+    response.raise_for_status()
+    return session
+
+
+def logged_in_sessions(args, count):
+    """Logs in `count` seeded users up front; their logins are not part of the measured scenario."""
+    with ThreadPoolExecutor(max_workers=min(count, 32)) as pool:
+        return list(pool.map(lambda index: log_in(args.base_url, index + 1, args.password), range(count)))
+
+
+def login_storm(args, recorder):
+    def one(index):
+        session = new_session()
+        user_number = index % args.users + 1
+        recorder.timed('POST /login', lambda: session.post(
+            f'{args.base_url}/login', json={'username': f'bench{user_number}', 'password': args.password}
+        ))
+
+    return one
+
+
+def sidebar_refresh(args, recorder):
+    sessions = logged_in_sessions(args, min(args.users, args.concurrency))
+    etags, latest = {}, {}
+
+    def one(index):
+        slot = index % len(sessions)
+        session = sessions[slot]
+        url = f'{args.base_url}/get_chat_list'
+        if slot not in etags or index % 10 == 0:
+            response = recorder.timed('GET /get_chat_list', lambda: session.get(url))
+            if response is not None and response.ok:
+                etags[slot] = response.headers.get('ETag')
+                latest[slot] = response.json().get('latest')
+        elif index % 3 == 0 and latest.get(slot):
+            recorder.timed('GET /get_chat_list?since=', lambda: session.get(url, params={'since': latest[slot]}))
+        else:
+            # What a browser tab does on every refresh once it has the list cached
+            recorder.timed('GET /get_chat_list (If-None-Match)',
+                           lambda: session.get(url, headers={'If-None-Match': etags[slot] or ''}))
+
+    return one
+
+
+def long_session_chat(args, recorder):
+    sessions = logged_in_sessions(args, min(args.users, args.concurrency))
+    endpoint = '/chat/stream' if args.stream else '/chat'
+
+    def one(index):
+        slot = index % len(sessions)
+        session = sessions[slot]
+        chat_id = f'{slot + 1}-0'
+        recorder.timed(f'POST {endpoint}', lambda: session.post(f'{args.base_url}{endpoint}', json={
+            'message': f'Recommend OPM songs like Buwan ({uuid.uuid4().hex[:8]})', 'session_id': chat_id
+        }, stream=args.stream))
+        recorder.timed('GET /load_session/<id>', lambda: session.get(f'{args.base_url}/load_session/{chat_id}'))
+
+    return one
+
+
+def preset_burst(args, recorder):
+    sessions = logged_in_sessions(args, min(args.users, args.concurrency))
+
+    def one(index):
+        session = sessions[index % len(sessions)]
+        preset = PRESETS[index % len(PRESETS)]
+        recorder.timed('POST /chat (preset)', lambda: session.post(f'{args.base_url}/chat', json={
+            'message': f'Recommend OPM music for a {preset} mood/playlist.',
+            'session_id': f'preset-{uuid.uuid4().hex[:12]}'
+        }))
+
+    return one
+
+
+def fake_gemini_stats(args):
+    try:
+        return requests.get(f'{args.fake_url}/stats', timeout=2).json()
+    except requests.RequestException:
+        return None
+
+
+def run_scenario(name, args):
+    recorder = Recorder()
+    one = globals()[name](args, recorder)
+    upstream_before = fake_gemini_stats(args)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(one, range(args.requests)))
+    result = recorder.summary(time.perf_counter() - started)
+    upstream_after = fake_gemini_stats(args)
+    if upstream_before and upstream_after:
+        result['upstream_requests'] = upstream_after['requests'] - upstream_before['requests']
+    return result
+
+
+def print_result(name, result):
+    print(f"\n== {name}: {result['requests']} requests in {result['wall_seconds']:.2f}s "
+          f"({result['throughput_rps']:.1f} req/s)"
+          + (f", {result['upstream_requests']} upstream calls" if 'upstream_requests' in result else ''))
+    for route, stats in result['routes'].items():
+        print(f"   {route:36s} n={stats['count']:<6d} p50 {stats['p50_ms']:8.1f}ms  p95 {stats['p95_ms']:8.1f}ms  "
+              f"p99 {stats['p99_ms']:8.1f}ms  statuses {stats['statuses']}")
+
+
+def change(old, new):
+    return (new - old) / old if old else 0.0
+
+
+def compare(results, baseline, tolerance):
+    """Prints per-route deltas against a baseline file; returns the regressions found."""
+    print(f"\n===== COMPARED WITH {baseline['meta'].get('commit') or 'baseline'} "
+          f"({baseline['meta'].get('started_at', '?')}) =====")
+    regressions = []
+    for name, result in results['scenarios'].items():
+        before = baseline['scenarios'].get(name)
+        if before is None:
+            continue
+        throughput = change(before['throughput_rps'], result['throughput_rps'])
+        print(f"\n{name}: throughput {before['throughput_rps']:.1f} -> {result['throughput_rps']:.1f} req/s "
+              f"({throughput:+.0%})")
+        if throughput < -tolerance:
+            regressions.append(f'{name} throughput {throughput:+.0%}')
+        for route, stats in result['routes'].items():
+            old = before['routes'].get(route)
+            if old is None:
+                continue
+            deltas = {key: change(old[key], stats[key]) for key in ('p50_ms', 'p95_ms', 'p99_ms')}
+            print(f"   {route:36s} p50 {deltas['p50_ms']:+6.0%}  p95 {deltas['p95_ms']:+6.0%}  "
+                  f"p99 {deltas['p99_ms']:+6.0%}   (p95 {old['p95_ms']:.1f} -> {stats['p95_ms']:.1f} ms)")
+            if deltas['p95_ms'] > tolerance:
+                regressions.append(f'{name} {route} p95 {deltas["p95_ms"]:+.0%}')
+    return regressions
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--base-url', default='http://127.0.0.1:5000')
+    parser.add_argument('--fake-url', default='http://127.0.0.1:8089', help='fake Gemini server, for its stats')
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS,
+                        help='run only these scenarios (repeatable); default: all')
+    parser.add_argument('--users', type=int, default=100, help='seeded users to log in as (bench1..benchN)')
+    parser.add_argument('--password', default=BENCH_PASSWORD)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--requests', type=int, default=500, help='requests (or chat turns) per scenario')
+    parser.add_argument('--stream', action='store_true', help='long_session_chat uses /chat/stream')
+    parser.add_argument('--output', default=os.path.join('bench', 'results', 'latest.json'))
+    parser.add_argument('--compare', help='earlier results file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed p95/throughput regression')
+    args = parser.parse_args()
+
+    results = {
+        'meta': {
+            'started_at': datetime.now().isoformat(timespec='seconds'),
+            'commit': git_commit(),
+            'base_url': args.base_url,
+            'users': args.users,
+            'concurrency': args.concurrency,
+            'requests': args.requests,
+            'stream': args.stream,
+        },
+        'scenarios': {}
+    }
+    for name in args.scenario or SCENARIOS:
+        results['scenarios'][name] = run_scenario(name, args)
+        print_result(name, results['scenarios'][name])
+    results['fake_gemini'] = fake_gemini_stats(args)
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w') as handle:
+        json.dump(results, handle, indent=2)
+    print(f'\nResults written to {args.output}')
+
+    if args.compare:
+        with open(args.compare) as handle:
+            regressions = compare(results, json.load(handle), args.tolerance)
+        if regressions:
+            print('\nREGRESSIONS (beyond {:.0%}):\n  '.format(args.tolerance) + '\n  '.join(regressions))
+            sys.exit(1)
+        print('\nNo regressions beyond {:.0%}.'.format(args.tolerance))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""
+Drives the upstream quota scheduler against bench/fake_gemini.py with scripted 429/5xx replies.
+
+Starts the fake server in-process, points the app at it, and checks that:
+  - transient 429/503 errors are retried and the call succeeds
+  - retries stop after GEMINI_MAX_RETRIES and the error surfaces
+  - the per-user RPM bucket throttles one user without affecting another
+  - long requests cannot drain the budget reserved for short ones
+  - /chat/stream retries a 429 that happens before the first chunk
+  - /quota reports the remaining budget
+
+    python bench/scheduler_check.py
+"""
+import os
+import sys
+import tempfile
+import threading
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_gemini import FakeGeminiState, serve  # noqa: E402
+
+state = FakeGeminiState(latency=0.01, first_token_latency=0.01, chunks=3)
+server = serve('127.0.0.1', 0, state)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+
+scratch = tempfile.mkdtemp()
+os.environ.update({
+    'DATABASE_URL': 'sqlite:///' + os.path.join(scratch, 'scheduler.db'),
+    'SHARED_STORE_PATH': os.path.join(scratch, 'shared_store.sqlite3'),
+    'GEMINI_API_KEY': 'fake',
+    'GEMINI_BASE_URL': f'http://127.0.0.1:{server.server_address[1]}',
+    'GEMINI_USER_RPM': '3',
+    'GEMINI_SCHEDULER_MAX_WAIT': '0',
+    'GEMINI_MAX_RETRIES': '3',
+    'GEMINI_BACKOFF_BASE': '0.01',
+    'RESPONSE_CACHE_ENABLED': '0',
+})
+
+import app as application  # noqa: E402
+from app import QuotaExceeded, UpstreamScheduler  # noqa: E402
+
+failures = []
+
+
+def check(name, condition):
+    print(f"{'PASS' if condition else 'FAIL'}  {name}")
+    if not condition:
+        failures.append(name)
+
+
+def main():
+    flask_app = application.app
+    services = flask_app.extensions['services']
+    with flask_app.app_context():
+        application.db.create_all()
+
+        state.script = [429, 429, 503]
+        response = application.gemini_send(1, [], 'Recommend OPM for a Chill mood')
+        check('retries transient 429/503 and succeeds', 'Buwan' in response.text and state.statuses.get(429) == 2)
+
+        state.script = [429] * 4
+        try:
+            application.gemini_send(2, [], 'hello')
+            check('gives up after GEMINI_MAX_RETRIES', False)
+        except Exception as e:
+            check('gives up after GEMINI_MAX_RETRIES', '429' in str(e) and not state.script)
+
+        try:
+            for _ in range(4):
+                application.gemini_send(3, [], 'one more')
+            check('per-user RPM throttles the chatty user', False)
+        except QuotaExceeded as e:
+            check('per-user RPM throttles the chatty user', e.scope == 'user')
+        application.gemini_send(4, [], 'another user')
+        check('other users are unaffected', True)
+
+        scheduler = UpstreamScheduler(
+            services['shared_store'],
+            limits={'global_rpm': 0, 'global_tpm': 10000, 'user_rpm': 0, 'user_tpm': 0},
+            max_wait=0, short_request_tokens=100, short_reserve=0.3, output_tokens=1000,
+            max_retries=0, backoff_base=0, backoff_cap=0
+        )
+        scheduler.store.execute("DELETE FROM rate_buckets WHERE name LIKE 'global:%'")
+        scheduler.acquire('priority', 5000)        # long request: 6000 tokens, leaves 4000
+        try:
+            scheduler.acquire('priority', 1000)    # long: would dip below the 3000-token reserve
+            check('long request blocked by the short-request reserve', False)
+        except QuotaExceeded:
+            check('long request blocked by the short-request reserve', True)
+        scheduler.acquire('priority', 50)          # short: 1050 tokens, allowed to use the reserve
+        check('short request may use the reserve', True)
+        scheduler.store.execute("DELETE FROM rate_buckets WHERE name LIKE 'global:%'")
+
+    client = flask_app.test_client()
+    client.post('/register', json={
+        'name': 'Check', 'username': 'check', 'email': 'check@example.com',
+        'password': 'pw', 'age': 20, 'birthday': '2000-01-01'
+    })
+    client.post('/login', json={'username': 'check', 'password': 'pw'})
+    state.script = [429]
+    body = client.post('/chat/stream', json={'message': 'Stream please', 'session_id': 'check'}).get_data(as_text=True)
+    check('/chat/stream retries a 429 before the first chunk', 'event: done' in body and 'Buwan' in body)
+
+    quota = client.get('/quota').get_json()['quota']
+    check('/quota reports remaining budget', quota['user_rpm']['limit'] == 3 and quota['user_rpm']['remaining'] < 3)
+    print('Scheduler counters:', services['upstream_scheduler'].stats())
+    print('Fake Gemini statuses:', state.statuses)
+
+    server.shutdown()
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
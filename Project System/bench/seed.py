@@ -0,0 +1,168 @@
+"""
+Seeds a database with benchmark users, chat sessions and reply-sized messages.
+
+Users are bench1..benchN, all with the same password, so the load scenarios can log in
+as any of them. Their ids are assigned by the database (so a Postgres sequence stays
+ahead of them); the numbers in their names only match the ids on an empty database.
+Session "<n>-0" is benchN's long chat (--long-messages); the others get --messages each. Replies are numbered OPM song lists like the real model's,
+so the recommendation extractor and local recommender have something to work on.
+
+Usage (from the "Project System" folder):
+    DATABASE_URL=sqlite:////tmp/bench.db python bench/seed.py --reset --users 1000 --long-messages 400
+    DATABASE_URL=postgresql://... python bench/seed.py --reset --users 5000 --recommendations
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+if not os.environ.get('DATABASE_URL'):
+    sys.exit('Set DATABASE_URL to the database to seed, e.g. sqlite:////tmp/bench.db or postgresql://...')
+
+from sqlalchemy import func, insert  # noqa: E402
+
+from app import app, db, bcrypt, User, Message, ChatSession  # noqa: E402
+
+SONGS = [
+    ("Buwan", "Juan Karlos", 2018), ("Kathang Isip", "Ben&Ben", 2017), ("Tadhana", "Up Dharma Down", 2012),
+    ("Hey Barbara", "IV of Spades", 2019), ("Mundo", "IV of Spades", 2019), ("Pagtingin", "Ben&Ben", 2019),
+    ("Sana", "Up Dharma Down", 2010), ("Binibini", "Zack Tabudlo", 2021), ("Dilaw", "Maki", 2023),
+    ("Araw-Araw", "Ben&Ben", 2019), ("Torete", "Moonstar88", 2001), ("With a Smile", "Eraserheads", 1994),
+    ("Ang Huling El Bimbo", "Eraserheads", 1995), ("Harana", "Parokya ni Edgar", 1998),
+    ("Pare Ko", "Eraserheads", 1993), ("Kisapmata", "Rivermaya", 1996), ("Huling Sayaw", "Kamikazee", 2012),
+    ("Tala", "Sarah Geronimo", 2016), ("Sining", "Dionela", 2023), ("Marilag", "Dionela", 2023),
+    ("Uhaw", "Dilaw", 2023), ("Museo", "Eliza Maturan", 2023), ("Pasilyo", "SunKissed Lola", 2022),
+    ("Palagi", "TJ Monterde", 2023), ("Maybe the Night", "Ben&Ben", 2018), ("Leaves", "Ben&Ben", 2019),
+    ("Raining in Manila", "Lola Amour", 2023), ("Tahanan", "Adie", 2022), ("Paraluman", "Adie", 2021),
+    ("Ere", "Juan Karlos", 2023),
+]
+MOODS = ["Chill", "Hugot", "Party", "Workout", "Rainy Day", "Road Trip", "Study", "Kilig"]
+REASONS = [
+    "A slow-burning anthem for late nights.", "Soft folk-pop for quiet moments.", "Dreamy and timeless.",
+    "Groovy retro vibes that never get old.", "A warm, swaying ballad.", "Perfect for singing along loudly.",
+    "Gentle guitars and honest lyrics.", "An upbeat track to lift the mood.",
+]
+BENCH_PASSWORD = 'bench-password'
+
+
+def user_prompt(rng):
+    if rng.random() < 0.6:
+        return f"Recommend OPM music for a {rng.choice(MOODS)} mood/playlist."
+    title, artist, _ = rng.choice(SONGS)
+    return rng.choice([f"Give me more like {title}", f"Songs similar to {title} by {artist} please",
+                       f"Anything from {artist}?"])
+
+
+def model_reply(rng):
+    """A reply shaped like the real model's: intro, five numbered songs with reasons, follow-up."""
+    picks = rng.sample(SONGS, 5)
+    lines = "".join(
+        f"{rank}. {title} - {artist} ({year}). {rng.choice(REASONS)}<br>"
+        for rank, (title, artist, year) in enumerate(picks, start=1)
+    )
+    return f"Here are some OPM picks for you!<br><br>{lines}<br>Want more songs like these?"
+
+
+def seed_database(users, sessions_per_user, messages_per_session, long_messages=None,
+                  password_hash='x', rng=None, batch_rows=5000):
+    """
+    Bulk-inserts users, their messages and ChatSession rows with core INSERTs, committing
+    every `batch_rows` messages. Returns (users, messages) inserted.
+    """
+    rng = rng or random.Random(0)
+    long_messages = messages_per_session if long_messages is None else long_messages
+    first_number = (db.session.query(func.max(User.id)).scalar() or 0) + 1
+    numbers = range(first_number, first_number + users)
+    started = datetime.utcnow() - timedelta(days=365)
+
+    db.session.execute(insert(User), [
+        {
+            'name': f'Bench {number}', 'username': f'bench{number}', 'email': f'bench{number}@example.com',
+            'password': password_hash, 'age': 20, 'birthday': datetime(2000, 1, 1).date()
+        }
+        for number in numbers
+    ])
+    user_ids = dict(db.session.query(User.username, User.id).filter(
+        User.username.in_([f'bench{number}' for number in numbers])
+    ).all())
+
+    messages, chat_sessions, total = [], [], 0
+    for number in numbers:
+        user_id = user_ids[f'bench{number}']
+        for session_index in range(sessions_per_user):
+            count = long_messages if session_index == 0 else messages_per_session
+            if count == 0:
+                continue
+            session_id = f'{number}-{session_index}'
+            first = started + timedelta(minutes=rng.randint(0, 500000))
+            title = None
+            for message_index in range(count):
+                content = user_prompt(rng) if message_index % 2 == 0 else model_reply(rng)
+                title = title or content
+                messages.append({
+                    'user_id': user_id, 'session_id': session_id,
+                    'role': 'user' if message_index % 2 == 0 else 'model',
+                    'content': content,
+                    'timestamp': first + timedelta(seconds=message_index * 30)
+                })
+            chat_sessions.append({
+                'user_id': user_id, 'session_id': session_id, 'title': title[:100],
+                'created_at': first,
+                'last_message_at': first + timedelta(seconds=(count - 1) * 30),
+                'message_count': count
+            })
+        if len(messages) >= batch_rows:
+            db.session.execute(insert(Message), messages)
+            db.session.execute(insert(ChatSession), chat_sessions)
+            db.session.commit()
+            total += len(messages)
+            messages, chat_sessions = [], []
+
+    if messages:
+        db.session.execute(insert(Message), messages)
+        db.session.execute(insert(ChatSession), chat_sessions)
+        total += len(messages)
+    db.session.commit()
+    return users, total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--sessions', type=int, default=10, help='sessions per user')
+    parser.add_argument('--messages', type=int, default=20, help='messages per session')
+    parser.add_argument('--long-messages', type=int, default=200, help="messages in each user's first session")
+    parser.add_argument('--password', default=BENCH_PASSWORD)
+    parser.add_argument('--seed', type=int, default=0, help='random seed, for repeatable datasets')
+    parser.add_argument('--reset', action='store_true', help='drop and recreate every table first')
+    parser.add_argument('--recommendations', action='store_true',
+                        help='also run extract-recommendations so the local recommender has data')
+    args = parser.parse_args()
+
+    with app.app_context():
+        if args.reset:
+            db.drop_all()
+        db.create_all()
+        print(f'Seeding {args.users} users x {args.sessions} sessions into '
+              f'{db.engine.url.render_as_string(hide_password=True)} ...')
+        started = time.perf_counter()
+        # One bcrypt hash for every user: hashing is deliberately slow
+        password_hash = bcrypt.generate_password_hash(args.password).decode('utf-8')
+        users, messages = seed_database(
+            args.users, args.sessions, args.messages,
+            long_messages=args.long_messages, password_hash=password_hash, rng=random.Random(args.seed)
+        )
+        print(f'Inserted {users} users and {messages} messages in {time.perf_counter() - started:.1f}s '
+              f'(password: {args.password!r})')
+
+    if args.recommendations:
+        print(app.test_cli_runner().invoke(args=['extract-recommendations']).output.strip())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+"""
+Measures what a cold start costs: importing app.py, a fresh interpreter's first requests,
+and gunicorn booting N workers with and without --preload.
+
+  import          wall time of "import app" in a fresh interpreter (median of --repeat runs)
+  first requests  in that same interpreter: GET /login, then the first and second /chat
+                  (the first chat pays for anything initialized lazily, e.g. the Gemini client)
+  gunicorn        time from spawning gunicorn to the first answered request, CPU seconds the
+                  master and workers spent booting, and the workers' PSS memory (pages shared
+                  copy-on-write with the master are split between the processes sharing them)
+
+Gemini is bench/fake_gemini.py, started in-process, so no quota is spent.
+
+    python bench/startup_time.py
+    python bench/startup_time.py --workers 4 --repeat 5 --output bench/results/startup.json
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_gemini import FakeGeminiState, serve  # noqa: E402
+
+# Runs in a fresh interpreter so nothing is already imported
+FIRST_REQUESTS = '''
+import json, time
+started = time.perf_counter()
+import app as module
+imported = time.perf_counter()
+client = module.app.test_client()
+timings = {'import_s': imported - started}
+begin = time.perf_counter(); client.get('/login'); timings['first_get_login_s'] = time.perf_counter() - begin
+client.post('/register', json={'name': 'Boot', 'username': 'boot', 'email': 'boot@example.com',
+                               'password': 'pw', 'age': 21, 'birthday': '2000-01-01'})
+client.post('/login', json={'username': 'boot', 'password': 'pw'})
+for label in ('first_chat_s', 'second_chat_s'):
+    begin = time.perf_counter()
+    status = client.post('/chat', json={'message': 'Songs like Buwan ' + label, 'session_id': label}).status_code
+    timings[label] = time.perf_counter() - begin
+    assert status == 200, status
+print(json.dumps(timings))
+'''
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def scratch_env(fake_url):
+    scratch = tempfile.mkdtemp()
+    env = dict(os.environ, **{
+        'DATABASE_URL': 'sqlite:///' + os.path.join(scratch, 'startup.db'),
+        'SHARED_STORE_PATH': os.path.join(scratch, 'shared_store.sqlite3'),
+        'GEMINI_API_KEY': 'fake',
+        'GEMINI_BASE_URL': fake_url,
+        'GEMINI_USER_RPM': '0',
+        'RESPONSE_CACHE_ENABLED': '0',
+        'LOCAL_RECOMMENDER_ENABLED': '0',
+    })
+    subprocess.run([sys.executable, '-m', 'flask', '--app', 'app', 'init-db'], cwd=BASE_DIR, env=env, check=True,
+                   capture_output=True)
+    return env
+
+
+def first_requests(fake_url):
+    output = subprocess.run([sys.executable, '-c', FIRST_REQUESTS], cwd=BASE_DIR, env=scratch_env(fake_url),
+                            check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def children(pid):
+    try:
+        with open(f'/proc/{pid}/task/{pid}/children') as handle:
+            return [int(child) for child in handle.read().split()]
+    except OSError:
+        return []
+
+
+def cpu_seconds(pid):
+    with open(f'/proc/{pid}/stat') as handle:
+        fields = handle.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')  # utime + stime
+
+
+def pss_mb(pid):
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as handle:
+            for line in handle:
+                if line.startswith('Pss:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def gunicorn_boot(fake_url, workers, preload):
+    env = scratch_env(fake_url)
+    port = free_port()
+    command = [sys.executable, '-m', 'gunicorn', '--workers', str(workers), '--bind', f'127.0.0.1:{port}',
+               f'{os.path.basename(BASE_DIR)}.app:app']
+    if preload:
+        command.insert(3, '--preload')
+    started = time.perf_counter()
+    process = subprocess.Popen(command, cwd=os.path.dirname(BASE_DIR), env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while True:
+            try:
+                requests.get(f'http://127.0.0.1:{port}/login', timeout=1)
+                break
+            except requests.RequestException:
+                if time.perf_counter() - started > 60:
+                    raise RuntimeError('gunicorn did not start')
+                time.sleep(0.01)
+        first_response = time.perf_counter() - started
+        # Let every worker finish booting, then make sure each has served something
+        deadline = time.perf_counter() + 30
+        while len(children(process.pid)) < workers and time.perf_counter() < deadline:
+            time.sleep(0.05)
+        time.sleep(1)
+        for _ in range(workers * 4):
+            requests.get(f'http://127.0.0.1:{port}/login', timeout=10)
+        worker_pids = children(process.pid)
+        worker_pss = [pss_mb(pid) for pid in worker_pids]
+        return {
+            'first_response_s': round(first_response, 3),
+            'boot_cpu_s': round(sum(cpu_seconds(pid) for pid in [process.pid] + worker_pids), 2),
+            'worker_pss_mb': round(sum(value for value in worker_pss if value), 1),
+            'master_pss_mb': round(pss_mb(process.pid) or 0, 1),
+        }
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--repeat', type=int, default=3, help='fresh interpreters to take the median of')
+    parser.add_argument('--output', help='also write the results to this JSON file')
+    args = parser.parse_args()
+
+    state = FakeGeminiState(latency=0.01, first_token_latency=0.01, chunks=2)
+    server = serve('127.0.0.1', 0, state)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    fake_url = f'http://127.0.0.1:{server.server_address[1]}'
+
+    runs = [first_requests(fake_url) for _ in range(args.repeat)]
+    results = {'in_process': {key: round(statistics.median(run[key] for run in runs), 3) for key in runs[0]}}
+    print(f'--- fresh interpreter (median of {args.repeat}) ---')
+    for key, value in results['in_process'].items():
+        print(f'   {key:22s} {value * 1000:8.1f} ms')
+
+    results['gunicorn'] = {}
+    for preload in (False, True):
+        label = 'preload' if preload else 'no_preload'
+        results['gunicorn'][label] = stats = gunicorn_boot(fake_url, args.workers, preload)
+        print(f'--- gunicorn, {args.workers} workers, {"--preload" if preload else "no --preload"} ---')
+        print(f"   first response {stats['first_response_s'] * 1000:8.1f} ms   boot CPU {stats['boot_cpu_s']:.2f} s   "
+              f"workers PSS {stats['worker_pss_mb']:.1f} MB (master {stats['master_pss_mb']:.1f} MB)")
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as handle:
+            json.dump(results, handle, indent=2)
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+"""
+Checks that chat turns survive a worker shutdown under MESSAGE_WRITE_MODE=write_behind.
+
+Starts bench/fake_gemini.py in-process and gunicorn on a scratch SQLite database with a
+flush interval long enough that nothing is written by the timer, sends --turns chats,
+then stops gunicorn and counts what reached the database:
+
+  - graceful stop (SIGTERM, what deploys and restarts send): every turn must be saved,
+    both messages of each turn, with matching ChatSession.message_count
+  - --kill also shows the cost of the durability trade-off: SIGKILL on the workers
+    loses whatever they still had queued (reported, not a failure)
+
+    python bench/write_behind_check.py --turns 200
+    python bench/write_behind_check.py --mode sync      # same checks against the default mode
+    python bench/write_behind_check.py --preload        # workers forked from a preloaded master
+"""
+import argparse
+import os
+import signal
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_gemini import FakeGeminiState, serve  # noqa: E402
+
+failures = []
+
+
+def check(name, condition):
+    print(f"{'PASS' if condition else 'FAIL'}  {name}")
+    if not condition:
+        failures.append(name)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_gunicorn(env, port, workers, preload):
+    # Create the schema once up front so the workers don't race each other doing it
+    subprocess.run([sys.executable, '-m', 'flask', '--app', 'app', 'init-db'], cwd=BASE_DIR, env=env, check=True,
+                   capture_output=True)
+    command = [sys.executable, '-m', 'gunicorn', '--workers', str(workers), '--bind', f'127.0.0.1:{port}',
+               '--graceful-timeout', '30', f'{os.path.basename(BASE_DIR)}.app:app']
+    if preload:
+        command.insert(3, '--preload')
+    process = subprocess.Popen(command, cwd=os.path.dirname(BASE_DIR), env=env)
+    for _ in range(300):
+        try:
+            requests.get(f'http://127.0.0.1:{port}/login', timeout=1)
+            return process
+        except requests.RequestException:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError('gunicorn did not start')
+
+
+def logged_in_session(base_url, index):
+    session = requests.Session()
+    username = f'wb{index}'
+    session.post(f'{base_url}/register', json={
+        'name': f'Write Behind {index}', 'username': username, 'email': f'{username}@example.com',
+        'password': 'pw', 'age': 21, 'birthday': '2000-01-01'
+    })
+    session.post(f'{base_url}/login', json={'username': username, 'password': 'pw'}).raise_for_status()
+    return session
+
+
+def send_turns(base_url, turns, users):
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        sessions = list(pool.map(lambda index: logged_in_session(base_url, index), range(users)))
+
+        def one_turn(index):
+            response = sessions[index % users].post(f'{base_url}/chat', json={
+                'message': f'Write-behind turn {index}', 'session_id': f'wb-{index % 10}'
+            })
+            return response.status_code
+
+        return list(pool.map(one_turn, range(turns)))
+
+
+def count_rows(database):
+    with sqlite3.connect(database) as connection:
+        messages = connection.execute('SELECT COUNT(*) FROM message').fetchone()[0]
+        counted = connection.execute('SELECT COALESCE(SUM(message_count), 0) FROM chat_session').fetchone()[0]
+        unanswered = connection.execute(
+            "SELECT COUNT(*) FROM message u WHERE u.role = 'user' AND NOT EXISTS ("
+            "SELECT 1 FROM message m WHERE m.role = 'model' AND m.user_id = u.user_id "
+            "AND m.session_id = u.session_id AND m.timestamp > u.timestamp)"
+        ).fetchone()[0]
+    return messages, counted, unanswered
+
+
+def run(args, fake_url, stop_signal):
+    scratch = tempfile.mkdtemp()
+    database = os.path.join(scratch, 'write_behind.db')
+    env = dict(os.environ, **{
+        'DATABASE_URL': 'sqlite:///' + database,
+        'SHARED_STORE_PATH': os.path.join(scratch, 'shared_store.sqlite3'),
+        'GEMINI_API_KEY': 'fake',
+        'GEMINI_BASE_URL': fake_url,
+        'GEMINI_GLOBAL_RPM': '0',
+        'GEMINI_USER_RPM': '0',
+        'RESPONSE_CACHE_ENABLED': '0',
+        'MESSAGE_WRITE_MODE': args.mode,
+        # Only the shutdown flush may write: no timer or size flushes during the run
+        'MESSAGE_FLUSH_INTERVAL': '3600',
+        'MESSAGE_BATCH_SIZE': str(args.turns * 10),
+    })
+    port = free_port()
+    process = start_gunicorn(env, port, args.workers, args.preload)
+    try:
+        statuses = send_turns(f'http://127.0.0.1:{port}', args.turns, args.users)
+        answered = statuses.count(200)
+        before, _, _ = count_rows(database)
+        print(f'{answered}/{args.turns} turns answered; {before // 2} written before shutdown')
+    finally:
+        if stop_signal == signal.SIGKILL:
+            # Kill the workers outright (the master would otherwise just replace them)
+            subprocess.run(['pkill', '-KILL', '-P', str(process.pid)])
+        process.send_signal(signal.SIGTERM if stop_signal == signal.SIGKILL else stop_signal)
+        process.wait(timeout=60)
+
+    messages, counted, unanswered = count_rows(database)
+    return answered, before, messages, counted, unanswered
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mode', default='write_behind', choices=['write_behind', 'sync'])
+    parser.add_argument('--turns', type=int, default=200)
+    # A user's next request writes that user's queued turns first (read-your-writes),
+    # so spreading turns over many users keeps them queued until shutdown
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--kill', action='store_true', help='also show what SIGKILL loses')
+    parser.add_argument('--preload', action='store_true', help='run gunicorn with --preload, as start.sh does')
+    args = parser.parse_args()
+
+    state = FakeGeminiState(latency=0.01, first_token_latency=0.01, chunks=2)
+    server = serve('127.0.0.1', 0, state)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    fake_url = f'http://127.0.0.1:{server.server_address[1]}'
+
+    print(f'--- {args.mode}: graceful shutdown (SIGTERM) ---')
+    answered, before, messages, counted, unanswered = run(args, fake_url, signal.SIGTERM)
+    if args.mode == 'write_behind':
+        check('turns were held in memory until shutdown', before < answered * 2)
+    check('every answered turn is saved after SIGTERM', messages == answered * 2)
+    check('ChatSession.message_count matches the saved messages', counted == messages)
+    check('no user message was saved without its reply', unanswered == 0)
+
+    if args.kill:
+        print(f'\n--- {args.mode}: workers killed (SIGKILL) ---')
+        answered, _, messages, _, _ = run(args, fake_url, signal.SIGKILL)
+        print(f'{answered - messages // 2} of {answered} answered turns lost '
+              f'({"expected for write_behind" if args.mode == "write_behind" else "sync mode should lose none"})')
+
+    server.shutdown()
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,5 +2,28 @@
 #!/usr/bin/env bash
 set -o errexit
 
+# SERVING_MODE=sync  : 4 sync workers, one request per worker at a time (original behaviour)
+# SERVING_MODE=async : threaded workers; Gemini calls go through client.aio on one event loop
+#                      per worker, so a slow upstream no longer blocks the other routes.
+#                      Concurrency is capped per worker by MAX_INFLIGHT_CHATS / MAX_QUEUED_CHATS.
+SERVING_MODE=${SERVING_MODE:-sync}
+
+# Create missing tables, columns and indexes once, before the workers start (importing the
+# app no longer does it). upgrade-db is idempotent and also brings databases from earlier
+# deploys up to date, which init-db (create_all only) would not.
+flask --app 'Project System/app.py' upgrade-db
+# Give chats saved before the chat_session table existed their row (and repair rows a later
+# turn created for them), so /sessions lists them without a manual step. Also idempotent.
+flask --app 'Project System/app.py' backfill-chat-sessions
+
+# --preload imports the app once in the master; workers fork from it and share those pages
+# copy-on-write. The Gemini client, DB connections and background threads are created per
+# worker on first use.
 # Use the full path here: FolderName.Filename:AppInstanceName
-gunicorn --workers 4 --bind 0.0.0.0:$PORT 'Project System.app:app'
\ No newline at end of file
+if [ "$SERVING_MODE" = "async" ]; then
+    export GEMINI_ASYNC=1
+    gunicorn --preload --workers ${WEB_CONCURRENCY:-4} --worker-class gthread --threads ${GUNICORN_THREADS:-100} \
+        --timeout 180 --bind 0.0.0.0:$PORT 'Project System.app:app'
+else
+    gunicorn --preload --workers 4 --bind 0.0.0.0:$PORT 'Project System.app:app'
+fi
@@ -151,18 +151,30 @@ document.addEventListener('DOMContentLoaded', async () => {
         });
     }
     
+    // Cursor of the next older history page (message id), or null when the top is reached
+    let historyBefore = null;
+    let historyLoading = false;
+
+    function renderHistoryBubble(msg) {
+        const messageElement = document.createElement('div');
+        messageElement.classList.add('chat-bubble', msg.sender === 'user' ? 'chat-bubble-user' : 'chat-bubble-bot');
+        messageElement.innerHTML = msg.content;
+        return messageElement;
+    }
+
+    // Loads the latest page of a session; older pages are fetched as the user scrolls up
     async function loadSession(sessionId) {
         if (!chatLog) return false; 
         try {
-            const response = await fetch(`/load_session/${sessionId}`);
+            // cache: 'no-cache' revalidates with If-None-Match, so an unchanged history is a 304
+            const response = await fetch(`/load_session/${sessionId}`, { cache: 'no-cache' });
             if (!response.ok) return false;
             const data = await response.json();
             if (data.history && data.history.length > 0) {
                 chatLog.innerHTML = ''; 
-                data.history.forEach(msg => {
-                    const senderClass = msg.sender === 'user' ? 'user' : 'bot';
-                    displayMessage(msg.content, senderClass);
-                });
+                data.history.forEach(msg => chatLog.appendChild(renderHistoryBubble(msg)));
+                historyBefore = data.has_more ? data.next_before : null;
+                scrollToBottom();
                 return true; 
             } 
             return false;
@@ -172,47 +184,144 @@ document.addEventListener('DOMContentLoaded', async () => {
         }
     }
 
-    async function renderSidebarHistory() {
+    async function loadOlderMessages() {
+        if (!chatLog || historyBefore === null || historyLoading || !currentSessionId) return;
+        historyLoading = true;
+        try {
+            const response = await fetch(`/load_session/${currentSessionId}?before=${historyBefore}`, { cache: 'no-cache' });
+            if (!response.ok) return;
+            const data = await response.json();
+            // Prepend without moving what the user is looking at
+            const previousHeight = chatLog.scrollHeight;
+            const fragment = document.createDocumentFragment();
+            data.history.forEach(msg => fragment.appendChild(renderHistoryBubble(msg)));
+            chatLog.insertBefore(fragment, chatLog.firstChild);
+            chatLog.scrollTop += chatLog.scrollHeight - previousHeight;
+            historyBefore = data.has_more ? data.next_before : null;
+        } catch (error) {
+            console.error('Error loading older messages:', error);
+        } finally {
+            historyLoading = false;
+        }
+    }
+
+    // Offset of the next sidebar page, or null when every session is already shown
+    let sidebarNextOffset = null;
+    let sidebarLoading = false;
+    // ETag of the first page currently rendered, and the newest/total seen, for delta refreshes
+    let sidebarEtag = null;
+    let sidebarLatest = null;
+    let sidebarTotal = 0;
+
+    function renderSidebarItem(session) {
+        const itemContainer = document.createElement('div');
+        itemContainer.className = 'history-item';
+        itemContainer.dataset.sessionId = session.id;
+        if (session.id === currentSessionId) itemContainer.classList.add('active'); 
+        
+        const titleSpan = document.createElement('span');
+        titleSpan.className = 'history-title';
+        titleSpan.textContent = session.title || 'New Chat';
+        
+        const deleteBtn = document.createElement('button');
+        deleteBtn.className = 'delete-chat-btn';
+        deleteBtn.innerHTML = '&times;'; 
+        deleteBtn.title = 'Delete chat';
+
+        itemContainer.addEventListener('click', () => {
+            if (session.id !== currentSessionId) {
+                sessionStorage.setItem('current_chat_session', session.id);
+                window.location.reload();
+            }
+        });
+
+        deleteBtn.addEventListener('click', (e) => {
+            e.stopPropagation(); 
+            deleteSession(session.id);
+        });
+        
+        itemContainer.appendChild(titleSpan);
+        itemContainer.appendChild(deleteBtn);
+        return itemContainer;
+    }
+
+    function findSidebarItem(sessionId) {
+        return Array.from(historyList.children).find(item => item.dataset.sessionId === sessionId);
+    }
+
+    async function renderSidebarHistory(append = false) {
         if (!historyList) return;
+        if (append && (sidebarNextOffset === null || sidebarLoading)) return;
+        sidebarLoading = true;
         try {
-            const response = await fetch('/get_chat_list');
+            const offset = append ? sidebarNextOffset : 0;
+            const response = await fetch(`/get_chat_list?offset=${offset}`, { cache: 'no-cache' });
             if (response.status === 401) return; 
             if (!response.ok) throw new Error(`Failed to load chat list: ${response.status}`);
+            const etag = response.headers.get('ETag');
+            // Same first page as the one on screen: only the highlight may need to move
+            if (!append && etag && etag === sidebarEtag) {
+                Array.from(historyList.children).forEach(item => {
+                    item.classList.toggle('active', item.dataset.sessionId === currentSessionId);
+                });
+                return;
+            }
             const data = await response.json();
-            historyList.innerHTML = '';
+            if (!append) {
+                historyList.innerHTML = '';
+                sidebarEtag = etag;
+            }
+            sidebarNextOffset = data.has_more ? data.next_offset : null;
+            sidebarLatest = data.latest;
+            sidebarTotal = data.total;
             
             data.sessions.forEach(session => {
-                const itemContainer = document.createElement('div');
-                itemContainer.className = 'history-item';
-                if (session.id === currentSessionId) itemContainer.classList.add('active'); 
-                
-                const titleSpan = document.createElement('span');
-                titleSpan.className = 'history-title';
-                titleSpan.textContent = session.title || 'New Chat';
-                
-                const deleteBtn = document.createElement('button');
-                deleteBtn.className = 'delete-chat-btn';
-                deleteBtn.innerHTML = '&times;'; 
-                deleteBtn.title = 'Delete chat';
-
-                itemContainer.addEventListener('click', () => {
-                    if (session.id !== currentSessionId) {
-                        sessionStorage.setItem('current_chat_session', session.id);
-                        window.location.reload();
-                    }
-                });
-
-                deleteBtn.addEventListener('click', (e) => {
-                    e.stopPropagation(); 
-                    deleteSession(session.id);
-                });
-                
-                itemContainer.appendChild(titleSpan);
-                itemContainer.appendChild(deleteBtn);
-                historyList.appendChild(itemContainer);
+                if (!findSidebarItem(session.id)) historyList.appendChild(renderSidebarItem(session));
             });
         } catch (error) {
             console.error('Error fetching chat list:', error);
+        } finally {
+            sidebarLoading = false;
+        }
+    }
+
+    // Moves sessions with new messages to the top instead of refetching the whole sidebar
+    async function refreshSidebar() {
+        if (!historyList) return;
+        if (!sidebarLatest || sidebarLoading) return renderSidebarHistory();
+        sidebarLoading = true;
+        let fullReload = false;
+        try {
+            const response = await fetch(`/get_chat_list?since=${encodeURIComponent(sidebarLatest)}`, { cache: 'no-cache' });
+            if (response.status === 401) return;
+            if (!response.ok) throw new Error(`Failed to refresh chat list: ${response.status}`);
+            const data = await response.json();
+            if (data.has_more || data.total < sidebarTotal) {
+                // Too much changed, or sessions were deleted elsewhere
+                fullReload = true;
+                return;
+            }
+            data.sessions.slice().reverse().forEach(session => {
+                const existing = findSidebarItem(session.id);
+                if (existing) {
+                    existing.remove();
+                } else if (sidebarNextOffset !== null) {
+                    // The item moved into the loaded pages, so the next page starts one later
+                    sidebarNextOffset += 1;
+                }
+                historyList.insertBefore(renderSidebarItem(session), historyList.firstChild);
+            });
+            if (data.latest) sidebarLatest = data.latest;
+            sidebarTotal = data.total;
+            sidebarEtag = null;
+        } catch (error) {
+            console.error('Error refreshing chat list:', error);
+        } finally {
+            sidebarLoading = false;
+            if (fullReload) {
+                sidebarEtag = null;
+                renderSidebarHistory();
+            }
         }
     }
 
@@ -249,6 +358,30 @@ document.addEventListener('DOMContentLoaded', async () => {
         }
     }
 
+    // Parses a fetch() body of Server-Sent Events and calls onEvent(name, data) per event
+    async function readEventStream(response, onEvent) {
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+            let boundary;
+            while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                const rawEvent = buffer.slice(0, boundary);
+                buffer = buffer.slice(boundary + 2);
+                let eventName = 'message';
+                let dataLines = [];
+                rawEvent.split('\n').forEach(line => {
+                    if (line.startsWith('event:')) eventName = line.slice(6).trim();
+                    else if (line.startsWith('data:')) dataLines.push(line.slice(5).trim());
+                });
+                if (dataLines.length) onEvent(eventName, JSON.parse(dataLines.join('\n')));
+            }
+        }
+    }
+
     async function sendMessage(message) {
         if (message.trim() === "") return;
         startChatSession(true); 
@@ -257,7 +390,7 @@ document.addEventListener('DOMContentLoaded', async () => {
         toggleInputState(true);
 
         try {
-            const response = await fetch('/chat', {
+            const response = await fetch('/chat/stream', {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
                 body: JSON.stringify({ message: message, session_id: currentSessionId })
@@ -271,21 +404,38 @@ document.addEventListener('DOMContentLoaded', async () => {
             return; // Exit the function after displaying the message
             }
 
-            const data = await response.json();
-            if (!response.ok) throw new Error(data.response || `HTTP error! status: ${response.status}`);
-
-            // Update Session ID if new
-            if (data.session_id && data.session_id !== currentSessionId) {
-                 currentSessionId = data.session_id;
-                 sessionStorage.setItem('current_chat_session', currentSessionId);
+            if (!response.ok) {
+                const data = await response.json();
+                throw new Error(data.response || `HTTP error! status: ${response.status}`);
             }
+
+            // Render the reply chunk by chunk into a single bot bubble
+            displayMessage('', 'bot');
+            const botBubble = chatLog ? chatLog.lastElementChild : null;
+            let replyText = '';
+
+            await readEventStream(response, (eventName, data) => {
+                if (eventName === 'start' || eventName === 'done') {
+                    // Update Session ID if new
+                    if (data.session_id && data.session_id !== currentSessionId) {
+                        currentSessionId = data.session_id;
+                        sessionStorage.setItem('current_chat_session', currentSessionId);
+                    }
+                } else if (eventName === 'error') {
+                    replyText += (replyText ? '<br><br>' : '') + (data.response || 'An API error occurred.');
+                } else if (data.delta) {
+                    replyText += data.delta;
+                }
+                if (botBubble) {
+                    botBubble.innerHTML = replyText;
+                    scrollToBottom();
+                }
+            });
             
             // --- FIX: ALWAYS UPDATE HISTORY AFTER MESSAGE ---
             // This ensures the title updates from "New Chat" to the specific topic immediately
-            renderSidebarHistory(); 
+            refreshSidebar(); 
             // ------------------------------------------------
-
-            displayMessage(data.response, 'bot');
         } catch (error) {
             console.error('Fetch error:', error);
             displayMessage(error.message || "🤖 Error: Could not connect to the recommender service.", 'bot');
@@ -345,6 +495,22 @@ document.addEventListener('DOMContentLoaded', async () => {
         if (newChatBtn) {
             newChatBtn.addEventListener('click', startNewChat);
         }
+
+        if (chatLog) {
+            // Fetch older messages when the user scrolls near the top of a long chat
+            chatLog.addEventListener('scroll', () => {
+                if (chatLog.scrollTop <= 40) loadOlderMessages();
+            });
+        }
+
+        if (historyList) {
+            // Fetch the next sidebar page when the user scrolls near the bottom
+            historyList.addEventListener('scroll', () => {
+                if (historyList.scrollTop + historyList.clientHeight >= historyList.scrollHeight - 40) {
+                    renderSidebarHistory(true);
+                }
+            });
+        }
         
         if (presetButtonsContainer) {
             presetButtonsContainer.addEventListener('click', function(e) {